@@ -0,0 +1,61 @@
+import threading
+import time
+from config import ACCESS_STATS_FLUSH_SECONDS
+from metadata_writer import writer
+
+class AccessStats:
+    """
+    Cheap per-file download counters
+
+    Downloads only bump an in-memory counter; the counts are written to
+    file_access_stats at most every ACCESS_STATS_FLUSH_SECONDS, in the
+    background through the group-commit writer.
+    """
+
+    def __init__(self, flush_seconds=ACCESS_STATS_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, file_id):
+        """Count one download of a file"""
+        now = time.time()
+        with self._lock:
+            count, _ = self._pending.get(file_id, (0, now))
+            self._pending[file_id] = (count + 1, now)
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """Write buffered counts to the database"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        rows = [(file_id, count, count, last_access) for file_id, (count, last_access) in pending.items()]
+
+        def write(cursor):
+            cursor.executemany("""
+                INSERT INTO file_access_stats (file_id, access_count, recent_count, last_access)
+                VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+                ON CONFLICT(file_id) DO UPDATE SET
+                    access_count = access_count + excluded.access_count,
+                    recent_count = recent_count + excluded.recent_count,
+                    last_access = excluded.last_access
+            """, rows)
+
+        future = writer.submit(write)
+        if wait:
+            future.result()
+
+    def decay(self, factor):
+        """Scale down recent download counts so files can cool down again"""
+        writer.execute(lambda cursor: cursor.execute(
+            "UPDATE file_access_stats SET recent_count = recent_count * ?", (factor,)))
+
+access_stats = AccessStats()
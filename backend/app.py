@@ -1,39 +1,128 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, request, jsonify, g, Response
 from flask_cors import CORS
 import os
-import sqlite3
-from auth import auth_bp, get_jwt_identity, jwt_required, token_required, admin_required
-from routes import file_bp
+import time
+import db
+from metrics import registry, REQUEST_LATENCY, REQUESTS_IN_FLIGHT, BYTES_IN, BYTES_OUT
+from profiling import profiler
+from auth import auth_bp, get_jwt_identity, jwt_required, token_required, admin_required, metrics_access_required
+from routes import file_bp, not_modified, with_validators
+from conditional import get_counter, make_etag, user_scope
+from tiering import tiering_job
+from node_client import get_node_client
+from bootstrap import bootstrap
 import config
 
-app = Flask(__name__)
-app.config.from_object(config)
-# Enable CORS for all routes
-CORS(app, resources={r"/*": {"origins": "*"}})
+system_bp = Blueprint('system', __name__)
 
-# Register blueprints
-app.register_blueprint(auth_bp)
-app.register_blueprint(file_bp)
+_jobs_pid = None
 
-# Create node directories if they don't exist
-for i in range(1, config.NODE_COUNT + 1):
-    node_path = os.path.join(config.NODES_DIR, f"node{i}")
-    if not os.path.exists(node_path):
-        os.makedirs(node_path)
+def start_background_jobs():
+    """Start this process's background threads; threads don't survive fork, so each worker starts its own"""
+    global _jobs_pid
+    if _jobs_pid == os.getpid():
+        return
+    _jobs_pid = os.getpid()
+    # Move replicas between fast and bulk nodes in the background
+    tiering_job.start()
 
-@app.route('/')
+def create_app(run_bootstrap=True):
+    """
+    Create the Flask application
+
+    Args:
+        run_bootstrap: Set up node directories, schema and secret first (skip when
+                       a pre-fork server's master process already did)
+
+    Returns:
+        Flask app
+    """
+    if run_bootstrap:
+        bootstrap()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    # Enable CORS for all routes
+    CORS(app, resources={r"/*": {"origins": "*"}})
+
+    # Register blueprints
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(file_bp)
+    app.register_blueprint(system_bp)
+    return app
+
+class CountedStream:
+    """Counts bytes of a streamed response body as they are sent"""
+
+    def __init__(self, chunks, endpoint):
+        self.chunks = chunks
+        self.endpoint = endpoint
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            BYTES_OUT.inc(len(chunk), endpoint=self.endpoint)
+            yield chunk
+
+    def close(self):
+        # Let the wrapped body release its file or reader
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+@system_bp.before_app_request
+def start_request_timer():
+    # Cheap after the first request; started lazily so forking a worker stays fast
+    start_background_jobs()
+    g.request_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    profiler.start_request(request.endpoint, request.method, request.path)
+
+@system_bp.after_app_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_LATENCY.observe(time.perf_counter() - g.request_start,
+                            method=request.method, endpoint=endpoint, status=response.status_code)
+    profiler.finish_request(response.status_code)
+    if request.content_length:
+        BYTES_IN.inc(request.content_length, endpoint=endpoint)
+    if response.content_length is not None:
+        BYTES_OUT.inc(response.content_length, endpoint=endpoint)
+    elif response.is_streamed:
+        response.response = CountedStream(response.response, endpoint)
+    return response
+
+@system_bp.teardown_app_request
+def finish_request(exc):
+    if 'request_start' in g:
+        REQUESTS_IN_FLIGHT.dec()
+        # No-op if after_request already finished the trace
+        profiler.finish_request(500)
+
+@system_bp.route('/metrics')
+@metrics_access_required
+def metrics():
+    """Metrics of this worker process in Prometheus text exposition format"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@system_bp.route('/')
 def home():
     return jsonify({"message": "Distributed File Storage System API"})
 
-@app.route('/storage')
+@system_bp.route('/storage')
 @jwt_required
 def user_storage():
     """Get storage information for the authenticated user"""
     user_id = get_jwt_identity()
     
+    # Usage only changes when the user's files do
+    counter, _ = get_counter(user_scope(user_id))
+    etag = make_etag('storage', user_id, counter)
+    response = not_modified(etag)
+    if response:
+        return response
+    
     # Get user files from database
     try:
-        conn = sqlite3.connect(config.DATABASE_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
         
         # Get file count for this user
@@ -49,45 +138,26 @@ def user_storage():
         # Get user's storage limit
         storage_limit_bytes = config.DEFAULT_STORAGE_LIMIT_BYTES
         
-        return jsonify({
+        return with_validators(jsonify({
             "user_id": user_id,
             "files_count": files_count,
             "used_storage_bytes": total_size,
             "storage_limit_bytes": storage_limit_bytes
-        })
+        }), etag)
     except Exception as e:
         return jsonify({"message": f"Error retrieving storage info: {str(e)}"}), 500
 
-@app.route('/status')
+@system_bp.route('/status')
 @token_required
 def get_status():
     """Get system status - accessible by all authenticated users"""
     user_id = get_jwt_identity()
     
-    # Get basic system status with nodes
-    nodes_info = []
-    for i in range(1, config.NODE_COUNT + 1):
-        node_path = os.path.join(config.NODES_DIR, f"node{i}")
-        
-        # Check node status
-        if not os.path.exists(node_path):
-            # Look for failed node directory
-            failed_node_path = os.path.join(config.NODES_DIR, f"node{i}_failed")
-            if os.path.exists(failed_node_path):
-                nodes_info.append({
-                    "node_id": i,
-                    "status": "failed"
-                })
-            else:
-                nodes_info.append({
-                    "node_id": i,
-                    "status": "unknown"
-                })
-        else:
-            nodes_info.append({
-                "node_id": i,
-                "status": "healthy"
-            })
+    # Ask each node through the node client, so daemons are checked too. Not
+    # conditional: health changes without any write recording it (a daemon
+    # stops, a directory disappears), so every poll asks the nodes
+    client = get_node_client()
+    nodes_info = [{"node_id": i, "status": client.health(i)} for i in range(1, config.NODE_COUNT + 1)]
     
     return jsonify({
         "status": "healthy",
@@ -95,12 +165,12 @@ def get_status():
         "user_id": user_id
     })
 
-@app.route('/admin/system')
+@system_bp.route('/admin/system')
 @admin_required
 def admin_system():
     """Admin-only endpoint for system information"""
     # Get database statistics
-    conn = sqlite3.connect(config.DATABASE_PATH)
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Get total users
@@ -125,4 +195,4 @@ def admin_system():
     })
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
@@ -2,15 +2,26 @@ from flask import Blueprint, request, jsonify, current_app
 import jwt
 from functools import wraps
 import datetime
+import hmac
+import os
+import secrets
 import sqlite3
+import db
 import bcrypt
-from config import DATABASE_PATH,  ROLES, JWT_SECRET_KEY
+from conditional import bump, user_scope, GLOBAL_SCOPE
+from config import ROLES, JWT_SECRET_KEY, JWT_SECRET_FILE, METRICS_TOKEN
 
 auth_bp = Blueprint('auth', __name__)
 
+def _add_column(cursor, table, column, definition):
+    """Add a column to an existing table if it isn't there yet"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def init_db():
-    """Initialize the database if it doesn't exist"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    """Initialize the database if it doesn't exist (run once from bootstrap, not on import)"""
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Create users table
@@ -50,6 +61,86 @@ def init_db():
     )
     ''')
     
+    # Create file_access_stats table (download counts used for storage tiering)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_access_stats (
+        file_id INTEGER PRIMARY KEY,
+        access_count INTEGER NOT NULL DEFAULT 0,
+        recent_count REAL NOT NULL DEFAULT 0,
+        last_access TIMESTAMP,
+        FOREIGN KEY (file_id) REFERENCES files (id)
+    )
+    ''')
+    
+    # Create versioning tables (content-defined chunks shared between versions)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (file_id, version),
+        FOREIGN KEY (file_id) REFERENCES files (id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chunks (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chunk_locations (
+        chunk_hash TEXT NOT NULL,
+        node_id INTEGER NOT NULL,
+        file_path TEXT NOT NULL,
+        PRIMARY KEY (chunk_hash, node_id),
+        FOREIGN KEY (chunk_hash) REFERENCES chunks (hash)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS version_chunks (
+        version_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        chunk_hash TEXT NOT NULL,
+        PRIMARY KEY (version_id, seq),
+        FOREIGN KEY (version_id) REFERENCES file_versions (id),
+        FOREIGN KEY (chunk_hash) REFERENCES chunks (hash)
+    )
+    ''')
+    
+    # Create change_counters table (ETags of listings, usage and status)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_counters (
+        scope TEXT PRIMARY KEY,
+        counter INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    
+    # Create job_status table (admin-started background jobs, read by every worker)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS job_status (
+        name TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    
+    # Replication policy overrides (NULL = inherit) and extra read replicas
+    _add_column(cursor, 'users', 'replication_factor', 'INTEGER')
+    _add_column(cursor, 'files', 'replication_factor', 'INTEGER')
+    _add_column(cursor, 'file_locations', 'extra', 'INTEGER NOT NULL DEFAULT 0')
+    
+    # Latest version of a versioned file (NULL = stored as a whole-file blob in file_locations)
+    _add_column(cursor, 'files', 'current_version', 'INTEGER')
+    
+    # SHA-256 of the content, used as the ETag of downloads (NULL for files stored before it was recorded)
+    _add_column(cursor, 'files', 'content_hash', 'TEXT')
+    _add_column(cursor, 'file_versions', 'content_hash', 'TEXT')
+    
     # Create an admin user if not exists
     cursor.execute("SELECT * FROM users WHERE username = 'admin'")
     if not cursor.fetchone():
@@ -62,8 +153,35 @@ def init_db():
     conn.commit()
     conn.close()
 
-# Initialize the database
-init_db()
+_jwt_secret = None
+
+def _load_secret_file(path):
+    """Read the shared secret, creating it with a random one if it doesn't exist yet"""
+    if not os.path.exists(path):
+        # Write a private temp file and link it into place; if another process got there first, use theirs
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+
+    with open(path) as f:
+        secret = f.read().strip()
+    if not secret:
+        raise RuntimeError(f"JWT secret file {path} is empty")
+    return secret
+
+def get_jwt_secret():
+    """Get the secret tokens are signed with: JWT_SECRET_KEY, else the one shared through JWT_SECRET_FILE"""
+    global _jwt_secret
+    if _jwt_secret is None:
+        _jwt_secret = JWT_SECRET_KEY or _load_secret_file(JWT_SECRET_FILE)
+    return _jwt_secret
 
 def get_jwt_identity():
     """Get the user ID from the token in the request"""
@@ -77,11 +195,15 @@ def get_jwt_identity():
         # Check if token is in query parameters (for direct downloads)
         token = request.args.get('token')
         
+    return decode_token(token)
+
+def decode_token(token):
+    """Get the user ID from a raw JWT, or None if it is missing or invalid"""
     if not token:
         return None
         
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+        payload = jwt.decode(token, get_jwt_secret(), algorithms=['HS256'])
         return payload['user_id']
     except jwt.ExpiredSignatureError:
         return None
@@ -106,7 +228,7 @@ def admin_required(f):
         if not user_id:
             return jsonify({'message': 'Authentication required!'}), 401
         
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
         cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
         user = cursor.fetchone()
@@ -118,6 +240,17 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+def metrics_access_required(f):
+    """Decorator for routes open to scrapers sending METRICS_TOKEN as a bearer token, and to admins"""
+    admin_view = admin_required(f)
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        if METRICS_TOKEN and hmac.compare_digest(auth_header.encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+            return f(*args, **kwargs)
+        return admin_view(*args, **kwargs)
+    return decorated
+
 def jwt_required(f):
     """Alias for token_required for clarity"""
     return token_required(f)
@@ -140,7 +273,7 @@ def register():
     # Hash the password
     hashed_password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt())
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     cursor = conn.cursor()
     
     try:
@@ -167,7 +300,7 @@ def login():
     if not data or 'username' not in data or 'password' not in data:
         return jsonify({'message': 'Username and password required'}), 400
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row  # Enable column access by name
     cursor = conn.cursor()
     
@@ -185,7 +318,7 @@ def login():
         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
     }
     
-    token = jwt.encode(token_payload, JWT_SECRET_KEY, algorithm='HS256')
+    token = jwt.encode(token_payload, get_jwt_secret(), algorithm='HS256')
     
     return jsonify({
         'message': 'Login successful',
@@ -199,7 +332,7 @@ def login():
 @admin_required
 def get_users():
     """Get all users - admin only endpoint"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -213,7 +346,7 @@ def get_users():
 @admin_required
 def get_user(user_id):
     """Get a specific user - admin only endpoint"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -232,7 +365,7 @@ def delete_user(user_id):
     if user_id == 1:  # Protect the default admin
         return jsonify({'message': 'Cannot delete the default admin'}), 400
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Check if user exists
@@ -243,6 +376,8 @@ def delete_user(user_id):
     
     # Delete the user
     cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    # Their files drop out of the admin listing (and out of every worker's metadata cache)
+    bump(cursor, GLOBAL_SCOPE, user_scope(user_id))
     conn.commit()
     conn.close()
     
@@ -254,7 +389,7 @@ def get_profile():
     """Get the current user's profile"""
     user_id = get_jwt_identity()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -273,7 +408,7 @@ def update_profile():
     user_id = get_jwt_identity()
     data = request.get_json()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Check if user exists
@@ -304,6 +439,8 @@ def update_profile():
     
     # Execute the update
     cursor.execute(query, list(update_data.values()) + [user_id])
+    # The admin listing shows usernames
+    bump(cursor, GLOBAL_SCOPE, user_scope(user_id))
     conn.commit()
     conn.close()
     
@@ -0,0 +1,385 @@
+"""
+Offline load and throughput benchmark for the API
+
+Runs the Flask app in-process against a throwaway NODES_DIR and
+DATABASE_PATH, seeds users and files, then drives a concurrent mixed
+workload (uploads and downloads of varied sizes, listings, file info and
+optionally node fail/repair cycles) and reports throughput and latency
+percentiles per operation as JSON.
+
+    python benchmark.py --users 20 --files-per-user 50 --concurrency 16 --ops 5000 --output result.json
+    python benchmark.py ... --baseline result.json --tolerance 0.15
+
+With --baseline, exits with status 1 if any operation's p95 latency or
+throughput regressed by more than the tolerance. Exits with status 2 if an
+operation takes longer than --op-timeout, e.g. when a request deadlocks.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+OPERATIONS = ('upload', 'download', 'list', 'info', 'fail_repair')
+
+def parse_size(text):
+    """Parse sizes like 512, 64k or 4m into bytes"""
+    text = text.strip().lower()
+    units = {'k': 1024, 'm': 1024 * 1024}
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_mix(text):
+    """Parse an operation mix like upload=2,download=5,list=2,info=1"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{name}'. Choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return mix
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def setup_environment(work_dir):
+    """Point the app at a throwaway database and node directory before it is imported"""
+    os.environ['DFSS_DATABASE_PATH'] = os.path.join(work_dir, 'metadata.sqlite')
+    os.environ['DFSS_NODES_DIR'] = os.path.join(work_dir, 'nodes')
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def seed(args, rng):
+    """
+    Create users and files directly through the storage and metadata layers
+
+    Returns:
+        Tuple of (admin token, list of user dicts with 'id', 'token' and 'files')
+    """
+    import bcrypt
+    import datetime
+    import jwt
+    import db
+    from auth import get_jwt_secret
+    from file_utils import store_file_with_replication
+    from metadata import record_files
+
+    def token_for(user_id, role):
+        payload = {
+            'user_id': user_id,
+            'role': role,
+            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        }
+        return jwt.encode(payload, get_jwt_secret(), algorithm='HS256')
+
+    # One hash for everyone; hashing is not what we are measuring
+    password = bcrypt.hashpw(b'benchmark', bcrypt.gensalt(rounds=4)).decode('utf-8')
+
+    conn = db.connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE username = 'admin'")
+    admin_id = cursor.fetchone()[0]
+
+    users = []
+    for i in range(args.users):
+        cursor.execute(
+            "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
+            (f'bench{i}', f'bench{i}@dfss.test', password, 'user')
+        )
+        users.append({'id': cursor.lastrowid, 'files': []})
+    conn.commit()
+    conn.close()
+
+    payload_dir = tempfile.mkdtemp(prefix='dfss-bench-payload-')
+    try:
+        for user in users:
+            user['token'] = token_for(user['id'], 'user')
+            entries = []
+            for j in range(args.files_per_user):
+                size = rng.choice(args.sizes)
+                path = os.path.join(payload_dir, f'seed_{user["id"]}_{j}')
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(size))
+                unique_filename = f"{uuid.uuid4()}_seed_{j}.bin"
+                entries.append({
+                    'filename': unique_filename,
+                    'original_filename': f'seed_{j}.bin',
+                    'user_id': user['id'],
+                    'size': size,
+                    'storage_info': store_file_with_replication(path, unique_filename, user['id'])
+                })
+                os.remove(path)
+            user['files'] = record_files(entries)
+    finally:
+        shutil.rmtree(payload_dir, ignore_errors=True)
+
+    return token_for(admin_id, 'admin'), users
+
+class Worker(threading.Thread):
+    """Runs operations from the shared budget and records their latencies"""
+
+    def __init__(self, app, args, users, admin_token, seed_value, state):
+        super().__init__(daemon=True)
+        self.client = app.test_client()
+        self.args = args
+        self.users = users
+        self.admin_token = admin_token
+        self.rng = random.Random(seed_value)
+        self.state = state
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.ops, self.weights = zip(*args.mix.items())
+        # Operation in progress and when it started, watched by main() for stuck requests
+        self.current = None
+
+    def run(self):
+        while self.state.take():
+            op = self.rng.choices(self.ops, self.weights)[0]
+            user = self.rng.choice(self.users)
+            start = time.perf_counter()
+            self.current = (op, start)
+            try:
+                ok = getattr(self, f'do_{op}')(user)
+            except Exception:
+                ok = False
+            self.current = None
+            elapsed = time.perf_counter() - start
+            self.latencies[op].append(elapsed)
+            if not ok:
+                self.errors[op] += 1
+
+    def headers(self, token):
+        return {'Authorization': f'Bearer {token}'}
+
+    def do_upload(self, user):
+        size = self.rng.choice(self.args.sizes)
+        data = {'file': (io.BytesIO(os.urandom(size)), f'bench_{size}.bin')}
+        with self.client.post('/upload', data=data, headers=self.headers(user['token']),
+                              content_type='multipart/form-data') as response:
+            if response.status_code == 201:
+                with self.state.lock:
+                    user['files'].append(response.get_json()['file_id'])
+                return True
+            return False
+
+    def do_download(self, user):
+        if not user['files']:
+            return True
+        file_id = self.rng.choice(user['files'])
+        with self.client.get(f'/download/{file_id}', headers=self.headers(user['token'])) as response:
+            response.get_data()
+            return response.status_code == 200
+
+    def do_list(self, user):
+        with self.client.get('/files', headers=self.headers(user['token'])) as response:
+            return response.status_code == 200
+
+    def do_info(self, user):
+        if not user['files']:
+            return True
+        file_id = self.rng.choice(user['files'])
+        with self.client.get(f'/files/{file_id}', headers=self.headers(user['token'])) as response:
+            return response.status_code == 200
+
+    def do_fail_repair(self, user):
+        # Only one fail/repair cycle at a time, so reads always have a healthy replica
+        if not self.state.repair_lock.acquire(blocking=False):
+            return True
+        try:
+            import config
+            node_id = self.rng.randint(1, config.NODE_COUNT)
+            headers = self.headers(self.admin_token)
+            with self.client.post(f'/admin/system/fail-node/{node_id}', headers=headers) as failed:
+                if failed.status_code != 200:
+                    return False
+            with self.client.post(f'/admin/system/repair-node/{node_id}', headers=headers) as repaired:
+                return repaired.status_code == 200
+        finally:
+            self.state.repair_lock.release()
+
+class SharedState:
+    """Operation budget shared by all workers"""
+
+    def __init__(self, ops, duration):
+        self.remaining = ops
+        self.deadline = time.perf_counter() + duration if duration else None
+        self.lock = threading.Lock()
+        self.repair_lock = threading.Lock()
+
+    def take(self):
+        if self.deadline and time.perf_counter() >= self.deadline:
+            return False
+        with self.lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+def find_stuck(workers, timeout):
+    """Get (operation, seconds) of the first worker busy with one operation for longer than timeout, or None"""
+    now = time.perf_counter()
+    for worker in workers:
+        current = worker.current
+        if current and now - current[1] > timeout:
+            return current[0], now - current[1]
+    return None
+
+def wait_for(workers, timeout):
+    """
+    Wait for all workers to finish
+
+    Returns:
+        None, or (operation, seconds) of an operation that has been running for longer than timeout
+    """
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+            stuck = find_stuck(workers, timeout)
+            if stuck:
+                return stuck
+    return None
+
+def summarize(workers, wall_time):
+    results = {}
+    for op in OPERATIONS:
+        latencies = sorted(l for worker in workers for l in worker.latencies[op])
+        if not latencies:
+            continue
+        errors = sum(worker.errors[op] for worker in workers)
+        results[op] = {
+            'count': len(latencies),
+            'errors': errors,
+            'throughput_ops_s': round(len(latencies) / wall_time, 2),
+            'mean_ms': round(1000 * sum(latencies) / len(latencies), 3),
+            'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+            'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+            'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+            'max_ms': round(1000 * latencies[-1], 3)
+        }
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline run
+
+    Returns:
+        List of regression descriptions (empty if none)
+    """
+    regressions = []
+    for op, current in results.items():
+        previous = baseline.get('results', {}).get(op)
+        if not previous:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{op}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['throughput_ops_s'] < previous['throughput_ops_s'] * (1 - tolerance):
+            regressions.append(f"{op}: throughput {previous['throughput_ops_s']} -> {current['throughput_ops_s']} ops/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the API against a throwaway data directory')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--files-per-user', type=int, default=20)
+    parser.add_argument('--sizes', type=lambda s: [parse_size(x) for x in s.split(',')], default='4k,64k,1m',
+                        help='Comma-separated file sizes to draw from (default: 4k,64k,1m)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=2000, help='Total operations to run')
+    parser.add_argument('--duration', type=float, help='Stop after this many seconds instead of --ops')
+    parser.add_argument('--mix', type=parse_mix, default='upload=2,download=5,list=2,info=1',
+                        help='Operation weights (default: upload=2,download=5,list=2,info=1; add fail_repair=N)')
+    parser.add_argument('--op-timeout', type=float, default=60,
+                        help='Abort if one operation takes longer than this many seconds (default: 60)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed regression as a fraction (default: 0.10)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary data directory')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='dfss-bench-')
+    setup_environment(work_dir)
+    rng = random.Random(args.seed)
+
+    try:
+        from app import create_app
+        app = create_app()
+
+        seed_start = time.perf_counter()
+        admin_token, users = seed(args, rng)
+        seed_time = time.perf_counter() - seed_start
+
+        state = SharedState(None if args.duration else args.ops, args.duration)
+        workers = [Worker(app, args, users, admin_token, args.seed * 1000 + i, state)
+                   for i in range(args.concurrency)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        stuck = wait_for(workers, args.op_timeout)
+        if stuck:
+            # Workers are daemon threads, so exiting doesn't wait for the stuck one
+            print(f"Aborted: a {stuck[0]} operation has been running for {stuck[1]:.0f}s "
+                  f"(--op-timeout {args.op_timeout:g}s)", file=sys.stderr)
+            return 2
+        wall_time = time.perf_counter() - start
+
+        results = summarize(workers, wall_time)
+        total = sum(r['count'] for r in results.values())
+        report = {
+            'config': {
+                'users': args.users,
+                'files_per_user': args.files_per_user,
+                'sizes': args.sizes,
+                'concurrency': args.concurrency,
+                'ops': args.ops,
+                'duration': args.duration,
+                'mix': args.mix,
+                'seed': args.seed
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            },
+            'seed_seconds': round(seed_time, 3),
+            'wall_seconds': round(wall_time, 3),
+            'total_ops': total,
+            'throughput_ops_s': round(total / wall_time, 2) if wall_time else None,
+            'results': results
+        }
+
+        exit_code = 0
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.tolerance)
+            report['regressions'] = regressions
+            exit_code = 1 if regressions else 0
+
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+        return exit_code
+    finally:
+        if args.keep:
+            print(f"Data kept in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""
+One-time setup shared by every process of a deployment
+
+Importing the backend has no side effects. The node directories, database
+schema, default admin user and JWT secret are set up by bootstrap(), which
+runs before anything is served: from create_app, or once in a pre-fork
+server's master process so forked workers have nothing left to do. It is
+idempotent and serialized with a lock file, so several processes starting at
+the same time are safe.
+
+    python bootstrap.py
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from auth import init_db, get_jwt_secret
+from config import DATABASE_PATH, NODES_DIR, NODE_COUNT
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a lock file, across processes"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def ensure_node_dirs():
+    """Create the nodes directory and one directory per node if they don't exist"""
+    for i in range(1, NODE_COUNT + 1):
+        os.makedirs(os.path.join(NODES_DIR, f"node{i}"), exist_ok=True)
+
+def bootstrap():
+    """Create node directories, the database schema, the default admin user and the JWT secret"""
+    os.makedirs(os.path.dirname(os.path.abspath(DATABASE_PATH)), exist_ok=True)
+    with file_lock(f"{DATABASE_PATH}.init.lock"):
+        ensure_node_dirs()
+        init_db()
+        get_jwt_secret()
+
+if __name__ == '__main__':
+    bootstrap()
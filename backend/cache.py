@@ -0,0 +1,176 @@
+import threading
+from collections import OrderedDict
+from metrics import registry
+from config import (FILE_CACHE_MAX_BYTES, FILE_CACHE_MAX_ITEM_BYTES, FILE_CACHE_ADMISSION_HITS,
+                    METADATA_CACHE_MAX_ENTRIES)
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by a total size budget
+
+    Every entry is charged `sizeof(value)` against the budget. With the default
+    sizeof (len) the budget is in bytes; with a constant sizeof it becomes an
+    entry count. When `admission_hits` is greater than 1, a key is only admitted
+    after it has missed that many times, so one-off reads don't evict hot entries.
+    """
+
+    def __init__(self, max_size, max_item_size=None, admission_hits=1, sizeof=len):
+        self.max_size = max_size
+        self.max_item_size = max_item_size if max_item_size is not None else max_size
+        self.admission_hits = admission_hits
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._doorkeeper = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Cache a value if it fits the budget and passes the admission filter
+
+        Returns:
+            bool: True if the value was stored
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            if size > self.max_item_size or size > self.max_size:
+                self.rejections += 1
+                return False
+
+            if key not in self._entries and not self._admit(key):
+                self.rejections += 1
+                return False
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+
+            self._entries[key] = (value, size)
+            self._size += size
+
+            # Evict least recently used entries until we are back under budget
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+            return True
+
+    def admits(self, key, size):
+        """
+        Check whether a value of this size for key would be stored, so callers
+        can skip reading a body the cache would turn away
+
+        Counts as the key's miss for the admission filter; when it returns
+        True, the next put of key is let through.
+
+        Returns:
+            bool: True if put(key, value) should follow
+        """
+        with self._lock:
+            if size > self.max_item_size or size > self.max_size:
+                self.rejections += 1
+                return False
+            if key in self._entries:
+                return True
+            if not self._admit(key):
+                self.rejections += 1
+                return False
+            # Remember the admission for the put that follows
+            if self.admission_hits > 1:
+                self._doorkeeper[key] = self.admission_hits
+            return True
+
+    def _admit(self, key):
+        """Count a miss for key and report whether it has been seen often enough"""
+        if self.admission_hits <= 1:
+            return True
+
+        seen = self._doorkeeper.pop(key, 0) + 1
+        if seen >= self.admission_hits:
+            return True
+
+        self._doorkeeper[key] = seen
+        # Keep the doorkeeper itself bounded
+        while len(self._doorkeeper) > max(1024, len(self._entries) * 2):
+            self._doorkeeper.popitem(last=False)
+        return False
+
+    def invalidate(self, key):
+        """Drop a single key from the cache"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+            self._doorkeeper.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._doorkeeper.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current usage"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rejections': self.rejections
+            }
+
+# Small, hot file bodies keyed by file ID. A stored file's content never changes
+# (new versions are served from chunks) and downloads look up the file's
+# metadata first, so other processes deleting or versioning it can't make a
+# cached body stale
+file_cache = LRUCache(FILE_CACHE_MAX_BYTES, FILE_CACHE_MAX_ITEM_BYTES, FILE_CACHE_ADMISSION_HITS)
+
+# (value, owner ID, owner's change counter) keyed by ('file', id) / ('locations', id) /
+# ('replication', user_id); metadata.py checks the counter before trusting an entry
+metadata_cache = LRUCache(METADATA_CACHE_MAX_ENTRIES, sizeof=lambda value: 1)
+
+def invalidate_file(file_id):
+    """Drop everything cached for a file after it changes or is deleted"""
+    file_cache.invalidate(file_id)
+    metadata_cache.invalidate(('file', file_id))
+    metadata_cache.invalidate(('locations', file_id))
+
+def cache_stats():
+    """Return stats for both caches"""
+    return {
+        'file_cache': file_cache.stats(),
+        'metadata_cache': metadata_cache.stats()
+    }
+
+def _collect_cache_metrics():
+    samples = {'hits': [], 'misses': [], 'evictions': [], 'size': []}
+    for cache_name, stats in cache_stats().items():
+        for key in samples:
+            samples[key].append(({'cache': cache_name}, stats[key]))
+    return [
+        ('dfss_cache_hits_total', 'counter', 'Cache hits', samples['hits']),
+        ('dfss_cache_misses_total', 'counter', 'Cache misses', samples['misses']),
+        ('dfss_cache_evictions_total', 'counter', 'Cache evictions', samples['evictions']),
+        ('dfss_cache_size', 'gauge', 'Cache usage (bytes for file_cache, entries for metadata_cache)', samples['size'])
+    ]
+
+registry.register_collector(_collect_cache_metrics)
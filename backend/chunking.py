@@ -0,0 +1,119 @@
+"""
+Content-defined chunking with a gear rolling hash
+
+A chunk boundary is placed wherever the hash of the last few dozen bytes
+matches a bit pattern, so boundaries depend only on nearby content. Editing
+part of a file changes the chunks around the edit, while chunks elsewhere
+(even if shifted by inserted or removed bytes) come out identical and can be
+shared between versions.
+
+Chunking runs on the request thread. With numpy installed the hash is
+computed a block at a time in C, at roughly 60-80 MB/s. Without it, a
+per-byte Python loop manages only about 6 MB/s, so versioned files are
+capped at VERSION_MAX_FILE_SIZE_PURE_PYTHON instead (see MAX_VERSION_SIZE).
+Both place the same boundaries.
+"""
+import random
+from config import (CHUNK_MIN_SIZE, CHUNK_AVG_SIZE, CHUNK_MAX_SIZE, VERSION_MAX_FILE_SIZE,
+                    VERSION_MAX_FILE_SIZE_PURE_PYTHON)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MASK64 = (1 << 64) - 1
+
+# Fixed pseudo-random table so every process cuts the same content the same way
+_rng = random.Random(0x6765617263646320)
+GEAR = [_rng.getrandbits(64) for _ in range(256)]
+del _rng
+
+# Bytes hashed per numpy step; a boundary usually turns up within the first block
+SCAN_BLOCK_SIZE = 16 * 1024
+
+# Largest file that can be versioned, since it is chunked on a request thread
+MAX_VERSION_SIZE = VERSION_MAX_FILE_SIZE if numpy is not None else VERSION_MAX_FILE_SIZE_PURE_PYTHON
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+def _boundary_mask(avg_size):
+    # The high bits of a gear hash depend on the most bytes, so test those
+    bits = avg_size.bit_length() - 1
+    return ((1 << bits) - 1) << (64 - bits)
+
+def find_cut(data, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE, max_size=CHUNK_MAX_SIZE):
+    """
+    Find the length of the first chunk of data
+
+    Args:
+        data: Buffer starting at a chunk boundary
+        min_size: No boundary before this many bytes
+        avg_size: Boundaries are placed every avg_size bytes past min_size on average
+        max_size: Force a boundary after this many bytes
+
+    Returns:
+        int: Length of the chunk
+    """
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+
+    mask = _boundary_mask(avg_size)
+    if numpy is not None:
+        return _scan_blocks(data, min_size, end, mask)
+
+    gear = GEAR
+    h = 0
+    for i, byte in enumerate(memoryview(data)[min_size:end], min_size):
+        h = ((h << 1) + gear[byte]) & _MASK64
+        if not h & mask:
+            return i + 1
+    return end
+
+def _scan_blocks(data, start, end, mask):
+    """find_cut's scan of data[start:end], a block at a time with numpy"""
+    # The hash at i is sum(GEAR[byte at i - k] << k) over k < 64 and bytes since
+    # start; older bytes are shifted out of the 64 bits. Doubling the window six
+    # times builds it with a handful of array operations per block.
+    view = memoryview(data)
+    # The mask covers the top bits, so a boundary is a hash below its lowest bit
+    limit = numpy.uint64(mask & -mask)
+    for block_start in range(start, end, SCAN_BLOCK_SIZE):
+        block_end = min(end, block_start + SCAN_BLOCK_SIZE)
+        # Rehash up to 63 bytes before the block, which its first hashes depend on
+        lo = max(start, block_start - 63)
+        h = _GEAR_ARRAY.take(numpy.frombuffer(view[lo:block_end], dtype=numpy.uint8))
+        shifted = numpy.empty_like(h)
+        width = 1
+        while width < 64:
+            numpy.left_shift(h[:-width], numpy.uint64(width), out=shifted[width:])
+            h[width:] += shifted[width:]
+            width *= 2
+        hits = h[block_start - lo:] < limit
+        first = int(hits.argmax())
+        if hits[first]:
+            return block_start + first + 1
+    return end
+
+def iter_chunks(f, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE, max_size=CHUNK_MAX_SIZE):
+    """
+    Split a file-like object into content-defined chunks
+
+    Yields:
+        bytes for each chunk, in order
+    """
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = f.read(max_size * 4)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        cut = find_cut(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
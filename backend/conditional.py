@@ -0,0 +1,126 @@
+"""
+Change counters and conditional request checks
+
+Responses that are polled (file listings, file details, storage usage) are
+tagged with an ETag built from change counters instead of from their content.
+Every write that changes them bumps the counters in the same transaction:
+'user:<id>' when one of the user's files changes (uploads, deletes, new
+versions, replica moves and counts) plus 'global' for any file change. A poll
+that sends back its ETag (If-None-Match) is answered with 304 after one
+primary-key lookup. Counters can move twice within a second, so these
+responses carry no Last-Modified time for If-Modified-Since.
+
+File bodies are tagged with their SHA-256 content hash, and ones that never
+change also with their upload time.
+"""
+import datetime
+import time
+from email.utils import parsedate_to_datetime
+import db
+
+GLOBAL_SCOPE = 'global'
+
+def user_scope(user_id):
+    return f"user:{user_id}"
+
+def user_counter_sql(user_id_column):
+    """SQL expression for the change counter of the user in a column, to read it in the same query as their rows"""
+    return f"COALESCE((SELECT counter FROM change_counters WHERE scope = 'user:' || {user_id_column}), 0)"
+
+def bump(cursor, *scopes):
+    """Bump change counters as part of the caller's transaction"""
+    now = time.time()
+    cursor.executemany("""
+        INSERT INTO change_counters (scope, counter, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(scope) DO UPDATE SET counter = counter + 1, updated_at = excluded.updated_at
+    """, [(scope, now) for scope in dict.fromkeys(scopes)])
+
+def bump_file_owners(cursor, file_ids):
+    """Bump the counters of the users owning some files (and the global counter)"""
+    placeholders = ','.join('?' * len(file_ids))
+    cursor.execute(f"SELECT DISTINCT user_id FROM files WHERE id IN ({placeholders})", list(file_ids))
+    bump(cursor, GLOBAL_SCOPE, *(user_scope(row[0]) for row in cursor.fetchall()))
+
+def get_counter(scope):
+    """
+    Get a change counter
+
+    Returns:
+        Tuple of (counter, time of the last change or None)
+    """
+    conn = db.connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT counter, updated_at FROM change_counters WHERE scope = ?", (scope,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    return (row[0], row[1]) if row else (0, None)
+
+def make_etag(*parts):
+    """Build a strong ETag from its parts"""
+    return '"' + '-'.join(str(part) for part in parts) + '"'
+
+def file_etag(cursor, file, version=None):
+    """
+    Get the ETag of a file's content (a version of it, or the current one)
+
+    Returns:
+        The ETag, or None if the version doesn't exist
+    """
+    current = file['current_version'] or 1
+    if version is None or version == current:
+        content_hash, version = file['content_hash'], current
+    elif file['current_version'] is None:
+        return None
+    else:
+        cursor.execute("SELECT content_hash FROM file_versions WHERE file_id = ? AND version = ?",
+                       (file['id'], version))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        content_hash = row[0]
+    # Files stored before content hashes were recorded; their content never changes either
+    return make_etag(content_hash) if content_hash else make_etag(file['id'], 'v', version)
+
+def parse_timestamp(value):
+    """Parse a SQLite CURRENT_TIMESTAMP value (UTC) into a Unix time, or None"""
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def is_not_modified(if_none_match, if_modified_since, etag, last_modified=None):
+    """
+    Check a request's validators against the current ETag and modification time
+
+    If-None-Match takes precedence over If-Modified-Since when both are sent.
+
+    Args:
+        if_none_match: If-None-Match header value, or None
+        if_modified_since: If-Modified-Since header value, or None
+        etag: Current ETag
+        last_modified: Current modification time as a Unix time, or None
+
+    Returns:
+        bool: True if the client's copy is current and a 304 can be sent
+    """
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have one-second resolution
+        return int(last_modified) <= since
+    return False
@@ -1,30 +1,132 @@
 import os
-import secrets
 
 # Directory for the application
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # JWT Configuration
-JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', secrets.token_hex(32))
+# Every worker process has to sign tokens with the same secret: set JWT_SECRET_KEY,
+# or one is generated on first start and kept in JWT_SECRET_FILE
+JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
+JWT_SECRET_FILE = os.environ.get('DFSS_JWT_SECRET_FILE', os.path.join(BASE_DIR, '.jwt_secret'))
 
 # Database configuration
-DATABASE_PATH = os.path.join(BASE_DIR, 'metadata.sqlite')
+DATABASE_PATH = os.environ.get('DFSS_DATABASE_PATH', os.path.join(BASE_DIR, 'metadata.sqlite'))
 
 # Storage configurations
-NODES_DIR = os.path.join(BASE_DIR, 'nodes')
+NODES_DIR = os.environ.get('DFSS_NODES_DIR', os.path.join(BASE_DIR, 'nodes'))
 NODE_COUNT = 3  # Number of storage nodes
 REPLICATION_FACTOR = 2  # Each file is stored on this many different nodes
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB max file size
 DEFAULT_STORAGE_LIMIT_BYTES = 100 * 1024 * 1024  # 100MB default storage limit per user
 
+# Storage tiering (tiering.py)
+# Class of each node: 'ssd' nodes are fast, 'bulk' nodes are cheap
+NODE_CLASSES = {1: 'ssd', 2: 'bulk', 3: 'bulk'}
+FAST_NODE_CLASS = 'ssd'
+ACCESS_STATS_FLUSH_SECONDS = 10  # How often buffered download counts are written to the database
+TIERING_INTERVAL_SECONDS = 15 * 60  # How often the tiering job runs (0 = only when triggered by an admin)
+TIERING_HOT_THRESHOLD = 20  # Decayed download count above which a file is promoted to a fast node
+TIERING_COLD_AGE_DAYS = 7  # Files not downloaded for this long are demoted to bulk nodes
+TIERING_DECAY = 0.5  # Recent download counts are multiplied by this after every run
+TIERING_MAX_MOVES_PER_RUN = 100  # Replica moves per run, to bound the I/O each run causes
+
+# Per-file and per-user replica counts (replication.py)
+# Files and users can override REPLICATION_FACTOR; with adaptive replication,
+# frequently downloaded files also get extra read replicas on lightly loaded nodes
+ADAPTIVE_REPLICATION = True
+ADAPTIVE_REPLICA_THRESHOLD = 50  # Decayed download count that earns a file one extra replica
+ADAPTIVE_RETIRE_FRACTION = 0.5  # Extra replicas are retired once demand falls below this fraction of what earned them
+ADAPTIVE_MAX_EXTRA_REPLICAS = 2  # Extra replicas per file
+REPLICATION_MAX_CHANGES_PER_RUN = 100  # Replicas added or removed per run
+
+# File versioning (versions.py)
+# Versions are split into content-defined chunks; unchanged chunks are shared between versions
+CHUNK_MIN_SIZE = 4 * 1024
+CHUNK_AVG_SIZE = 16 * 1024  # Must be a power of two
+CHUNK_MAX_SIZE = 64 * 1024
+VERSION_MAX_FILE_SIZE = MAX_FILE_SIZE  # Largest file that can be versioned
+VERSION_MAX_FILE_SIZE_PURE_PYTHON = 8 * 1024 * 1024  # Lower cap when numpy is missing and chunking runs at ~6 MB/s
+
+# Orphan reconciliation (reconcile.py)
+RECONCILE_MIN_AGE_SECONDS = 60 * 60  # Unreferenced blobs younger than this may belong to writes in progress
+RECONCILE_MAX_RECLAIM_BYTES = 1024 * 1024 * 1024  # Bytes reclaimed per run
+RECONCILE_OPS_PER_SECOND = 2000  # Directory entries examined per second (0 = unlimited)
+RECONCILE_MAX_REPORTED = 100  # Names listed per category and node in a report
+
+# Transfer admission control and bandwidth shaping (qos.py, per worker process)
+QOS_MAX_TRANSFERS = 64  # Uploads and downloads running at once; more wait in a queue
+QOS_MAX_TRANSFERS_PER_USER = 4  # Transfers one user can run at once
+QOS_MAX_QUEUED = 256  # Transfers waiting for a slot before new ones are rejected with 429
+QOS_MAX_QUEUED_PER_USER = 16  # Transfers one user can have waiting
+QOS_QUEUE_TIMEOUT_SECONDS = 10  # Longest a transfer waits for a slot before it is rejected
+# A queued API transfer holds one of the worker's WORKER_THREADS while it waits, so
+# only a few may wait at once; the data plane's async queue is bounded by QOS_MAX_QUEUED*
+QOS_MAX_WAITING_THREADS = 2  # Worker threads that may wait for a slot at once
+QOS_MAX_WAITING_THREADS_PER_USER = 1  # Worker threads one user's transfers may hold while waiting
+QOS_USER_BYTES_PER_SECOND = 50 * 1024 * 1024  # Bandwidth of one user's transfers (0 = unlimited)
+QOS_TOTAL_BYTES_PER_SECOND = 0  # Bandwidth of all transfers together (0 = unlimited)
+QOS_BURST_BYTES = 4 * 1024 * 1024  # Bytes sent at full speed after a bandwidth bucket has been idle
+
+# Replica copy mode (copy_engine.py)
+# 'auto': reflink clone, else in-kernel copy_file_range/sendfile, else user-space copy
+# 'hardlink': hard-link replicas to one inode when nodes share a filesystem (no extra
+#             redundancy on that disk; opt in only for immutable blobs)
+# 'copy': plain user-space copy
+COPY_MODE = os.environ.get('DFSS_COPY_MODE', 'auto')
+
+# Group-commit metadata writer (metadata_writer.py)
+METADATA_GROUP_COMMIT = True  # Batch metadata writes from concurrent requests into shared commits
+METADATA_GROUP_COMMIT_MAX_DELAY_MS = 2  # Max time a write waits for others to join its batch
+METADATA_GROUP_COMMIT_MAX_BATCH = 256  # Max writes per commit
+METADATA_WRITE_TIMEOUT_SECONDS = 30  # Longest a request waits for its write to commit
+
+# Batch API configurations
+BATCH_MAX_ITEMS = 1000  # Max files per batch upload or delete request
+BATCH_IO_WORKERS = 8  # Replica copies/deletes run concurrently on this many threads
+
+# Metrics (metrics.py); every worker process keeps and serves its own
+METRICS_TOKEN = os.environ.get('DFSS_METRICS_TOKEN')  # Bearer token scrapers send to /metrics (unset = admins only)
+
+# Request profiling (profiling.py)
+PROFILING_SAMPLE_INTERVAL_MS = 5  # Stack sampling interval for profiled requests
+SLOW_REQUEST_THRESHOLD_MS = None  # Capture SQL/I-O traces for requests slower than this (None = off)
+SLOW_REQUEST_MAX_TRACES = 50  # Slow-request traces kept in memory
+
+# In-memory cache configurations
+FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Total RAM budget for cached file bodies
+FILE_CACHE_MAX_ITEM_BYTES = 1024 * 1024  # Only files up to this size are cached
+FILE_CACHE_ADMISSION_HITS = 2  # A file is cached once it has been downloaded this many times
+METADATA_CACHE_MAX_ENTRIES = 10000  # Max cached file/location rows
+
+# Storage node configurations
+# 'local' writes node directories directly; 'http' talks to node_server.py daemons
+NODE_BACKEND = os.environ.get('DFSS_NODE_BACKEND', 'local')
+NODE_BASE_PORT = 7000  # Node N's daemon listens on NODE_BASE_PORT + N by default
+NODE_ADDRESSES = {
+    i: os.environ.get(f'DFSS_NODE{i}_URL', f'http://127.0.0.1:{NODE_BASE_PORT + i}')
+    for i in range(1, NODE_COUNT + 1)
+}
+# Shared secret node daemons require from the API (sent as X-Node-Secret); daemons
+# without one only accept connections on the loopback interface
+NODE_SECRET = os.environ.get('DFSS_NODE_SECRET')
+NODE_SECRET_HEADER = 'X-Node-Secret'
+NODE_CLIENT_TIMEOUT = 10  # Seconds before a node request is abandoned
+NODE_CLIENT_RETRIES = 2  # Extra attempts after a connection error
+NODE_CLIENT_POOL_SIZE = 8  # Idle keep-alive connections kept per node
+
+# Asyncio data-plane server (data_plane.py) configurations
+DATA_PLANE_HOST = '0.0.0.0'
+DATA_PLANE_PORT = 5002
+DATA_PLANE_IO_WORKERS = 32  # Threads available for blocking file and database I/O
+DATA_PLANE_MAX_TRANSFERS = 4096  # Concurrent transfers before new ones wait for a slot
+DATA_PLANE_CHUNK_SIZE = 64 * 1024  # Bytes read from the socket or disk per step
+DATA_PLANE_IDLE_TIMEOUT = 60  # Seconds to wait on a silent client before dropping it
+
+# Multi-process deployment (gunicorn.conf.py)
+WORKERS = int(os.environ.get('DFSS_WORKERS', os.cpu_count() or 1))  # One worker process per core by default
+WORKER_THREADS = 8  # Threads per worker, for requests waiting on disk or the network
+BIND_ADDRESS = os.environ.get('DFSS_BIND', '0.0.0.0:5001')
+
 # User roles
 ROLES = ['admin', 'user']
 
-# Create necessary directories
-if not os.path.exists(NODES_DIR):
-    os.makedirs(NODES_DIR)
-
-for i in range(1, NODE_COUNT + 1):
-    node_path = os.path.join(NODES_DIR, f"node{i}")
-    if not os.path.exists(node_path):
-        os.makedirs(node_path)
\ No newline at end of file
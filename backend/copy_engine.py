@@ -0,0 +1,126 @@
+import errno
+import os
+import shutil
+import sys
+import threading
+import uuid
+from config import COPY_MODE
+from metrics import registry
+
+# ioctl request number for FICLONE on Linux (btrfs, XFS with reflink=1, ...)
+FICLONE = 0x40049409
+
+# Errors that mean "this method doesn't work for these files", as opposed to real I/O errors
+_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EBADF, errno.EPERM, errno.ETXTBSY}
+
+# Methods that failed with ENOSYS/EOPNOTSUPP once are skipped from then on
+_disabled = set()
+_lock = threading.Lock()
+copy_stats = {'reflink': 0, 'copy_file_range': 0, 'sendfile': 0, 'userspace': 0, 'hardlink': 0}
+
+def _count(method):
+    with _lock:
+        copy_stats[method] += 1
+
+def _unsupported(method, error):
+    if error.errno in (errno.ENOSYS, errno.EOPNOTSUPP):
+        _disabled.add(method)
+    return error.errno in _UNSUPPORTED
+
+def _reflink(src_fd, dst_fd, size):
+    import fcntl
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+def _sendfile(src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if n == 0:
+            break
+        offset += n
+
+_KERNEL_METHODS = [
+    ('reflink', _reflink, lambda: sys.platform.startswith('linux')),
+    ('copy_file_range', _copy_file_range, lambda: hasattr(os, 'copy_file_range')),
+    # File-to-file sendfile only works on Linux
+    ('sendfile', _sendfile, lambda: hasattr(os, 'sendfile') and sys.platform.startswith('linux')),
+]
+
+def _copy_data(src, dst):
+    """Copy file contents, trying in-kernel methods before a user-space copy"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+
+        for method, func, available in _KERNEL_METHODS:
+            if method in _disabled or not available():
+                continue
+            try:
+                func(fsrc.fileno(), fdst.fileno(), size)
+            except OSError as e:
+                if not _unsupported(method, e):
+                    raise
+                # Start over cleanly for the next method
+                fdst.seek(0)
+                fdst.truncate()
+                continue
+            _count(method)
+            return
+
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        _count('userspace')
+
+def copy_file(src, dst, mode=None):
+    """
+    Copy a blob's contents from src to dst as cheaply as the filesystem allows
+
+    Unlike shutil.copy2 this doesn't copy metadata, and the data never passes
+    through user space unless every in-kernel method is unsupported.
+
+    Args:
+        src: Path of the file to copy
+        dst: Path to write; replaced if it exists
+        mode: 'auto' (reflink, then copy_file_range, then sendfile, then a
+              user-space copy), 'hardlink' (link dst to src's inode, falling
+              back to 'auto'), or 'copy' (user-space copy only).
+              Defaults to COPY_MODE.
+    """
+    mode = mode or COPY_MODE
+
+    if mode == 'hardlink':
+        # Blobs are immutable, so sharing the inode is safe; link to a temp
+        # name and rename so an existing dst is replaced atomically
+        temp = os.path.join(os.path.dirname(dst), f".link_{uuid.uuid4()}")
+        try:
+            os.link(src, temp)
+            os.replace(temp, dst)
+            _count('hardlink')
+            return
+        except OSError as e:
+            if os.path.exists(temp):
+                os.remove(temp)
+            if e.errno not in _UNSUPPORTED | {errno.EMLINK}:
+                raise
+
+    if mode == 'copy':
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        _count('userspace')
+        return
+
+    _copy_data(src, dst)
+
+def _collect_copy_metrics():
+    with _lock:
+        samples = [({'method': method}, count) for method, count in copy_stats.items()]
+    return [('dfss_replica_copies_total', 'counter', 'Replica copies by copy method', samples)]
+
+registry.register_collector(_collect_copy_metrics)
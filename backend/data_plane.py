@@ -0,0 +1,497 @@
+"""
+Asyncio data-plane server for uploads and downloads
+
+The Flask app holds one thread per request for the whole transfer, so a few
+slow clients can exhaust it. This server handles `/upload` and
+`/download/<id>` with non-blocking sockets instead: only disk and database
+work is handed to a bounded thread pool, and each transfer only reads the
+next chunk once the previous one has been written out (backpressure).
+
+Run it next to the API server:
+    python data_plane.py
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import db
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, quote
+import werkzeug
+from auth import decode_token
+from bootstrap import bootstrap
+from cache import file_cache
+from access_stats import access_stats
+from qos import AdmissionController, bandwidth, user_priority, Overloaded
+from conditional import file_etag, parse_timestamp, is_not_modified
+from file_utils import store_file_with_replication, find_replica
+from node_client import get_node_client, blob_name
+from metrics import TRANSFERS_IN_FLIGHT, BYTES_IN, BYTES_OUT
+from versions import open_version
+from metadata import is_admin_user, get_file_record, get_file_locations, get_user_replication_factor, record_file
+from config import (MAX_FILE_SIZE, DATA_PLANE_HOST, DATA_PLANE_PORT,
+                    DATA_PLANE_IO_WORKERS, DATA_PLANE_MAX_TRANSFERS, DATA_PLANE_CHUNK_SIZE, DATA_PLANE_IDLE_TIMEOUT)
+
+MAX_HEADER_BYTES = 16 * 1024
+
+REASONS = {
+    200: 'OK', 201: 'Created', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized',
+    403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+    413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error'
+}
+
+class HTTPError(Exception):
+    """Error that is reported to the client as a JSON message"""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+def parse_int(value):
+    """Parse a header or query value made only of ASCII digits, else return None"""
+    if value is None or not (value.isascii() and value.isdigit()):
+        return None
+    return int(value)
+
+class Request:
+    """Parsed request line and headers of an HTTP/1.1 request"""
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        url = urlsplit(target)
+        self.path = url.path
+        self.args = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def user_id(self):
+        """Authenticate the request the same way the Flask API does"""
+        auth_header = self.headers.get('authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            return decode_token(auth_header.split(' ')[1])
+        return decode_token(self.args.get('token'))
+
+class DataPlaneServer:
+    """Serves uploads and downloads on a single event loop"""
+
+    def __init__(self, host=DATA_PLANE_HOST, port=DATA_PLANE_PORT):
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=DATA_PLANE_IO_WORKERS, thread_name_prefix='data-plane-io')
+        self.transfers = None
+        # Same per-user limits as the API, but this server is built to keep many more transfers going
+        self.admission = AdmissionController(max_active=DATA_PLANE_MAX_TRANSFERS)
+
+    async def run_io(self, func, *args):
+        """Run blocking file or database work on the bounded I/O pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def serve(self):
+        self.transfers = asyncio.Semaphore(DATA_PLANE_MAX_TRANSFERS)
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES)
+        print(f"Data plane listening on http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+
+                try:
+                    async with self.transfers:
+                        keep_alive = await self.dispatch(request, reader, writer)
+                except HTTPError as e:
+                    # The rest of the body may still be unread, so don't reuse the connection
+                    await self.send_json(writer, e.status, {'message': e.message}, keep_alive=False, headers=e.headers)
+                    keep_alive = False
+                except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except Exception as e:
+                    await self.send_json(writer, 500, {'message': f'Internal error: {str(e)}'}, keep_alive=False)
+                    keep_alive = False
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def read_request(self, reader):
+        """Read the request line and headers, or return None when the client is done"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), DATA_PLANE_IDLE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            return None
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return Request(method.upper(), target, version, headers)
+
+    async def dispatch(self, request, reader, writer):
+        """Route a request and return whether the connection can be kept alive"""
+        if request.method == 'OPTIONS':
+            await self.send_head(writer, 204, {
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Authorization, Content-Type',
+                'Content-Length': '0'
+            }, request.keep_alive)
+            return request.keep_alive
+
+        if request.path == '/upload':
+            if request.method != 'POST':
+                raise HTTPError(405, 'Method not allowed')
+            with TRANSFERS_IN_FLIGHT.track(direction='upload'):
+                status, body = await self.upload_file(request, reader)
+            BYTES_IN.inc(int(request.headers.get('content-length', 0)), endpoint='data_plane.upload')
+            await self.send_json(writer, status, body, request.keep_alive)
+            return request.keep_alive
+
+        parts = request.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'download' and parse_int(parts[1]) is not None:
+            if request.method != 'GET':
+                raise HTTPError(405, 'Method not allowed')
+            with TRANSFERS_IN_FLIGHT.track(direction='download'):
+                await self.download_file(request, writer, int(parts[1]))
+            return request.keep_alive
+
+        raise HTTPError(404, 'Not found')
+
+    async def admit(self, user_id):
+        """Wait for an admission slot for a user's transfer, or reject it with 429"""
+        try:
+            priority = await self.run_io(user_priority, user_id)
+            return await self.admission.acquire_async(user_id, priority)
+        except Overloaded as e:
+            raise HTTPError(429, str(e), {'Retry-After': str(e.retry_after)})
+
+    async def throttle(self, user_id, nbytes):
+        """Pace a user's transfer to its bandwidth share"""
+        delay = bandwidth.delay(user_id, nbytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def upload_file(self, request, reader):
+        """Stream a multipart upload to a temp file, then replicate it"""
+        user_id = request.user_id()
+        if not user_id:
+            raise HTTPError(401, 'Authentication required!')
+
+        if 'content-length' not in request.headers:
+            raise HTTPError(411, 'Content-Length required')
+        length = parse_int(request.headers['content-length'])
+        if length is None:
+            raise HTTPError(400, 'Invalid Content-Length')
+
+        content_type = request.headers.get('content-type', '')
+        boundary = None
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'boundary':
+                boundary = value.strip('"')
+        if not content_type.startswith('multipart/form-data') or not boundary:
+            raise HTTPError(400, 'No file part in the request')
+
+        with await self.admit(user_id):
+            return await self.receive_upload(reader, user_id, length, boundary)
+
+    async def receive_upload(self, reader, user_id, length, boundary):
+        """Receive an admitted upload and replicate it"""
+        temp_path = os.path.join(tempfile.gettempdir(), f"upload_{uuid.uuid4()}")
+        out = await self.run_io(open, temp_path, 'wb')
+        try:
+            try:
+                filename, file_size, content_hash = await self.receive_multipart_file(
+                    reader, length, boundary.encode('latin-1'), out, user_id)
+            finally:
+                await self.run_io(out.close)
+
+            if filename is None:
+                raise HTTPError(400, 'No file part in the request')
+            if filename == '':
+                raise HTTPError(400, 'No file selected')
+
+            # Generate a unique filename
+            orig_filename = werkzeug.utils.secure_filename(filename)
+            unique_filename = f"{uuid.uuid4()}_{orig_filename}"
+
+            try:
+                replication_factor = await self.run_io(get_user_replication_factor, user_id)
+                storage_info = await self.run_io(store_file_with_replication, temp_path, unique_filename, user_id,
+                                                 replication_factor)
+                file_id = await self.run_io(record_file, unique_filename, orig_filename, user_id, file_size, storage_info,
+                                            content_hash)
+            except Exception as e:
+                return 500, {'message': f'Error uploading file: {str(e)}'}
+
+            return 201, {
+                'message': 'File uploaded successfully',
+                'file_id': file_id,
+                'replicas': len(storage_info)
+            }
+        finally:
+            if os.path.exists(temp_path):
+                await self.run_io(os.remove, temp_path)
+
+    async def receive_multipart_file(self, reader, length, boundary, out, user_id):
+        """
+        Parse a multipart body from the socket, writing the `file` part to out
+
+        Only a window of at most one chunk plus the boundary is held in memory.
+
+        Returns:
+            Tuple of (client filename or None if there was no file part, bytes written,
+            SHA-256 hex digest of the file part)
+        """
+        # The first boundary has no leading CRLF; prepend one so every boundary looks the same
+        delimiter = b'\r\n--' + boundary
+        buf = bytearray(b'\r\n')
+        remaining = length
+        written = 0
+        digest = hashlib.sha256()
+
+        async def fill():
+            nonlocal remaining
+            if remaining <= 0:
+                raise HTTPError(400, 'Malformed multipart body')
+            chunk = await asyncio.wait_for(reader.read(min(DATA_PLANE_CHUNK_SIZE, remaining)), DATA_PLANE_IDLE_TIMEOUT)
+            if not chunk:
+                raise ConnectionError('Client closed the connection')
+            remaining -= len(chunk)
+            buf.extend(chunk)
+            await self.throttle(user_id, len(chunk))
+
+        # Skip the preamble up to the first boundary
+        while True:
+            idx = buf.find(delimiter)
+            if idx >= 0:
+                del buf[:idx + len(delimiter)]
+                break
+            del buf[:max(0, len(buf) - len(delimiter))]
+            await fill()
+
+        filename = None
+        while True:
+            while len(buf) < 2:
+                await fill()
+            if buf[:2] == b'--':
+                break
+            del buf[:2]
+
+            # Part headers
+            while b'\r\n\r\n' not in buf:
+                if len(buf) > MAX_HEADER_BYTES:
+                    raise HTTPError(400, 'Multipart headers too large')
+                await fill()
+            idx = buf.find(b'\r\n\r\n')
+            part_headers = bytes(buf[:idx]).decode('utf-8', 'replace')
+            del buf[:idx + 4]
+
+            disposition = {}
+            for line in part_headers.split('\r\n'):
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-disposition':
+                    for param in value.split(';')[1:]:
+                        key, _, val = param.strip().partition('=')
+                        disposition[key.lower()] = val.strip('"')
+            is_file = filename is None and disposition.get('name') == 'file' and 'filename' in disposition
+            if is_file:
+                filename = disposition['filename']
+
+            # Part body, streamed until the next boundary
+            while True:
+                idx = buf.find(delimiter)
+                end = idx if idx >= 0 else max(0, len(buf) - len(delimiter))
+                if is_file and end:
+                    written += end
+                    if written > MAX_FILE_SIZE:
+                        raise HTTPError(400, f'File too large. Maximum size: {MAX_FILE_SIZE/1024/1024:.2f} MB')
+                    data = bytes(buf[:end])
+                    digest.update(data)
+                    await self.run_io(out.write, data)
+                if idx >= 0:
+                    del buf[:idx + len(delimiter)]
+                    break
+                del buf[:end]
+                await fill()
+
+        # Drain any epilogue so the connection can be reused
+        while remaining > 0:
+            chunk = await reader.read(min(DATA_PLANE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+        return filename, written, digest.hexdigest()
+
+    def lookup_download(self, user_id, file_id, version):
+        """
+        Run the same permission, version and location checks as the Flask download route
+
+        Returns:
+            Tuple of (file record, locations, ETag of the requested content)
+        """
+        conn = db.connect()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        try:
+            is_admin = is_admin_user(cursor, user_id)
+            file = get_file_record(cursor, file_id)
+            if not file:
+                raise HTTPError(404, 'File not found')
+            if not is_admin and file['user_id'] != user_id:
+                raise HTTPError(403, 'Access denied')
+            etag = file_etag(cursor, file, version)
+            if etag is None:
+                raise HTTPError(404, 'Version not found')
+            return file, get_file_locations(cursor, file_id), etag
+        finally:
+            conn.close()
+
+    async def download_file(self, request, writer, file_id):
+        """Stream a file from any available replica"""
+        user_id = request.user_id()
+        if not user_id:
+            raise HTTPError(401, 'Authentication required!')
+
+        with await self.admit(user_id):
+            await self.send_download(request, writer, user_id, file_id)
+
+    async def send_download(self, request, writer, user_id, file_id):
+        """Send an admitted download"""
+        version = request.args.get('version')
+        if version is not None:
+            version = parse_int(version)
+            if version is None:
+                raise HTTPError(400, 'Invalid version')
+
+        file, locations, etag = await self.run_io(self.lookup_download, user_id, file_id, version)
+        validators = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        last_modified = parse_timestamp(file['upload_date']) if file['current_version'] is None else None
+        if last_modified is not None:
+            validators['Last-Modified'] = formatdate(last_modified, usegmt=True)
+
+        # The client's copy is current; nothing needs to be read from a replica
+        if is_not_modified(request.headers.get('if-none-match'), request.headers.get('if-modified-since'),
+                           etag, last_modified):
+            await self.send_head(writer, 304, validators, request.keep_alive)
+            return
+
+        access_stats.record(file_id)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(file['original_filename'])}",
+            **validators
+        }
+
+        # Versioned files (and older versions) are reassembled from their chunks
+        if file['current_version'] is not None:
+            reader = await self.run_io(open_version, file_id, version)
+            if reader is None:
+                raise HTTPError(404, 'Version not found')
+            headers['Content-Length'] = str(reader.size)
+            await self.send_stream(writer, reader, headers, request.keep_alive, user_id)
+            return
+
+        # Serve hot files straight from memory
+        body = file_cache.get(file_id)
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+            await self.send_head(writer, 200, headers, request.keep_alive)
+            await self.throttle(user_id, len(body))
+            writer.write(body)
+            await writer.drain()
+            BYTES_OUT.inc(len(body), endpoint='data_plane.download')
+            return
+
+        if not locations:
+            raise HTTPError(404, 'File has no storage locations')
+
+        location = await self.run_io(find_replica, locations)
+        if location is None:
+            raise HTTPError(500, 'Error retrieving file: Could not retrieve file from any node')
+
+        client = get_node_client()
+        f = await self.run_io(client.open, location['node_id'], blob_name(location['file_path']))
+        size = file['size']
+        headers['Content-Length'] = str(size)
+
+        cached = [] if file_cache.admits(file_id, size) else None
+        await self.send_stream(writer, f, headers, request.keep_alive, user_id, cached)
+        if cached is not None:
+            file_cache.put(file_id, b''.join(cached))
+
+    async def send_stream(self, writer, f, headers, keep_alive, user_id, cached=None):
+        """Send a 200 response streaming a reader, then close the reader"""
+        try:
+            await self.send_head(writer, 200, headers, keep_alive)
+            while True:
+                try:
+                    chunk = await self.run_io(f.read, DATA_PLANE_CHUNK_SIZE)
+                except Exception as e:
+                    # Headers are already sent, so all we can do is cut the response short
+                    raise ConnectionError(f'Replica read failed: {e}')
+                if not chunk:
+                    break
+                if cached is not None:
+                    cached.append(chunk)
+                await self.throttle(user_id, len(chunk))
+                writer.write(chunk)
+                BYTES_OUT.inc(len(chunk), endpoint='data_plane.download')
+                # Wait for the socket buffer to empty before reading more from the node
+                await writer.drain()
+        finally:
+            await self.run_io(f.close)
+
+    async def send_head(self, writer, status, headers, keep_alive):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+        headers = dict(headers)
+        headers['Access-Control-Allow-Origin'] = '*'
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_json(self, writer, status, body, keep_alive, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        await self.send_head(writer, status, {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(payload)),
+            **(headers or {})
+        }, keep_alive)
+        writer.write(payload)
+        await writer.drain()
+
+if __name__ == '__main__':
+    bootstrap()
+    asyncio.run(DataPlaneServer().serve())
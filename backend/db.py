@@ -0,0 +1,50 @@
+import sqlite3
+import time
+from config import DATABASE_PATH
+from metrics import DB_QUERY_LATENCY
+from profiling import record_sql
+
+def _statement_type(sql):
+    """Label queries by their leading keyword to keep metric cardinality low"""
+    parts = sql.lstrip().split(None, 1)
+    return parts[0].upper() if parts else 'UNKNOWN'
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_QUERY_LATENCY.observe(elapsed, statement=_statement_type(sql))
+            record_sql(sql, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_QUERY_LATENCY.observe(elapsed, statement=_statement_type(sql))
+            record_sql(sql, elapsed)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors and commits are timed"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_QUERY_LATENCY.observe(elapsed, statement='COMMIT')
+            record_sql('COMMIT', elapsed)
+
+def connect(database_path=None):
+    """Open a connection to the metadata database"""
+    return sqlite3.connect(database_path or DATABASE_PATH, factory=InstrumentedConnection)
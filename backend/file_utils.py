@@ -1,9 +1,17 @@
+import hashlib
+import io
 import os
 import random
 import shutil
-from config import NODES_DIR, NODE_COUNT, REPLICATION_FACTOR
+import sqlite3
+import zipfile
+import db
+from config import NODES_DIR, NODE_COUNT, NODE_BACKEND, REPLICATION_FACTOR, NODE_CLASSES, FAST_NODE_CLASS
+from node_client import get_node_client, blob_name, NodeError
+import node_layout
+from metrics import REPLICA_FALLBACKS, REPAIR_COPY_FAILURES
 
-def store_file_with_replication(file_path, filename, user_id):
+def store_file_with_replication(file_path, filename, user_id, replication_factor=None):
     """
     Store a file with replication across multiple nodes
     
@@ -11,23 +19,25 @@ def store_file_with_replication(file_path, filename, user_id):
         file_path: Path to the file to be stored
         filename: Original filename for reference
         user_id: ID of the user who owns the file
+        replication_factor: Number of replicas (default: REPLICATION_FACTOR)
         
     Returns:
         List of dictionaries containing file storage info
     """
     file_size = os.path.getsize(file_path)
     storage_info = []
+    client = get_node_client()
     
     # Select random nodes for replication
-    selected_nodes = random.sample(range(1, NODE_COUNT + 1), min(REPLICATION_FACTOR, NODE_COUNT))
+    selected_nodes = random.sample(range(1, NODE_COUNT + 1), min(replication_factor or REPLICATION_FACTOR, NODE_COUNT))
     
     # Store the file on each selected node
     for node_id in selected_nodes:
         node_filename = f"user_{user_id}_{filename}"
-        node_path = os.path.join(NODES_DIR, f"node{node_id}", node_filename)
+        node_path = node_layout.blob_path(os.path.join(NODES_DIR, f"node{node_id}"), node_filename)
         
-        # Copy file to the node's directory
-        shutil.copy2(file_path, node_path)
+        # Send the file to the node
+        client.put(node_id, node_filename, file_path)
         
         # Store file location info
         storage_info.append({
@@ -38,6 +48,78 @@ def store_file_with_replication(file_path, filename, user_id):
     
     return storage_info
 
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 content hash of a file
+    
+    Args:
+        file_path: Path to the file
+        chunk_size: Bytes read per step
+        
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def delete_replicas(file_locations):
+    """
+    Delete stored replicas, ignoring ones that are already gone
+    
+    Args:
+        file_locations: List of file location information from database
+        
+    Returns:
+        int: Number of replicas that could not be deleted
+    """
+    client = get_node_client()
+    failures = 0
+    for location in file_locations:
+        try:
+            client.delete(location['node_id'], blob_name(location['file_path']))
+        except Exception:
+            failures += 1
+    return failures
+
+def prefer_fast_nodes(file_locations):
+    """
+    Order replicas so those on fast-class nodes are tried first and reads spread over the rest
+    
+    Args:
+        file_locations: List of file location information from database
+        
+    Returns:
+        The same locations, fast nodes first, in random order within each class
+    """
+    # Shuffle first so reads spread over all replicas of the same class
+    shuffled = random.sample(file_locations, len(file_locations))
+    return sorted(shuffled, key=lambda location: NODE_CLASSES.get(location['node_id']) != FAST_NODE_CLASS)
+
+def find_replica(file_locations):
+    """
+    Find a replica that is currently readable
+    
+    Args:
+        file_locations: List of file location information from database
+        
+    Returns:
+        The first location whose node has the replica, or None
+    """
+    client = get_node_client()
+    for location in prefer_fast_nodes(file_locations):
+        try:
+            if client.stat(location['node_id'], blob_name(location['file_path'])) is not None:
+                return location
+        except NodeError:
+            continue
+    return None
+
 def retrieve_file(file_locations, output_path):
     """
     Retrieve a file from any available node
@@ -49,19 +131,103 @@ def retrieve_file(file_locations, output_path):
     Returns:
         Path to the retrieved file
     """
-    # Try each replica until one works
-    for location in file_locations:
+    client = get_node_client()
+    
+    # Try each replica until one works, fast nodes first
+    for location in prefer_fast_nodes(file_locations):
         try:
-            # Check if the file exists on this node
-            if os.path.exists(location['file_path']):
-                shutil.copy2(location['file_path'], output_path)
-                return output_path
+            client.get(location['node_id'], blob_name(location['file_path']), output_path)
+            return output_path
         except Exception as e:
+            REPLICA_FALLBACKS.inc()
             continue
     
     # If we get here, no replica was available
     raise Exception("Could not retrieve file from any node")
 
+class _ZipStream(io.RawIOBase):
+    """Write-only, unseekable sink that hands written bytes to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(members, compress=False, chunk_size=64 * 1024):
+    """
+    Generate a ZIP archive of stored files on the fly
+    
+    Each member is read straight from a healthy replica and written into the
+    archive chunk by chunk, so memory use stays constant and nothing is
+    staged on disk.
+    
+    Args:
+        members: List of dicts with 'arcname', 'size', 'date_time' (6-tuple)
+                 and 'locations' (file location information from database),
+                 or instead of 'locations' an 'open' callable returning a reader
+        compress: Deflate members instead of storing them
+        chunk_size: Bytes read from a replica per step
+        
+    Yields:
+        Chunks of the ZIP archive
+    """
+    client = get_node_client()
+    sink = _ZipStream()
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    errors = []
+    
+    with zipfile.ZipFile(sink, 'w', compression=compression, allowZip64=True) as archive:
+        for member in members:
+            # Open the first replica that is readable (versioned files bring their own reader)
+            reader = None
+            if 'open' in member:
+                try:
+                    reader = member['open']()
+                except Exception:
+                    pass
+            else:
+                for location in prefer_fast_nodes(member['locations']):
+                    try:
+                        reader = client.open(location['node_id'], blob_name(location['file_path']))
+                        break
+                    except Exception:
+                        REPLICA_FALLBACKS.inc()
+                        continue
+            
+            if reader is None:
+                errors.append(f"{member['arcname']}: could not retrieve file from any node")
+                continue
+            
+            info = zipfile.ZipInfo(member['arcname'], date_time=member['date_time'])
+            info.compress_type = compression
+            info.file_size = member['size']
+            
+            with reader, archive.open(info, 'w', force_zip64=member['size'] >= zipfile.ZIP64_LIMIT) as entry:
+                while True:
+                    chunk = reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+        
+        # Report members that could not be read instead of failing the whole archive
+        if errors:
+            archive.writestr('_errors.txt', '\n'.join(errors) + '\n')
+    
+    yield sink.drain()
+
 def simulate_node_failure(node_id):
     """
     Simulate failure of a node by temporarily renaming its directory
@@ -123,14 +289,13 @@ def repair_node(node_id, database_path):
     Returns:
         int: Number of files repaired
     """
-    import sqlite3
-    
+    client = get_node_client()
     node_path = os.path.join(NODES_DIR, f"node{node_id}")
-    if not os.path.exists(node_path):
+    if NODE_BACKEND == 'local' and not os.path.exists(node_path):
         os.makedirs(node_path)
     
     # Connect to database
-    conn = sqlite3.connect(database_path)
+    conn = db.connect(database_path)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -146,15 +311,15 @@ def repair_node(node_id, database_path):
     repaired_count = 0
     
     for file in files_to_repair:
-        file_path = file['file_path']
+        name = blob_name(file['file_path'])
         
         # If file already exists, skip
-        if os.path.exists(file_path):
+        if client.stat(node_id, name) is not None:
             continue
         
         # Find a replica of this file on another node
         cursor.execute("""
-            SELECT file_path
+            SELECT node_id, file_path
             FROM file_locations
             WHERE file_id = ? AND node_id != ?
         """, (file['id'], node_id))
@@ -163,14 +328,36 @@ def repair_node(node_id, database_path):
         
         # Try to copy from each replica until success
         for replica in replicas:
-            source_path = replica['file_path']
-            if os.path.exists(source_path):
-                try:
-                    shutil.copy2(source_path, file_path)
-                    repaired_count += 1
-                    break
-                except:
-                    continue
+            try:
+                client.copy(replica['node_id'], node_id, blob_name(replica['file_path']))
+                repaired_count += 1
+                break
+            except:
+                REPAIR_COPY_FAILURES.inc()
+                continue
+    
+    # Chunks of versioned files are repaired the same way
+    cursor.execute("SELECT chunk_hash, file_path FROM chunk_locations WHERE node_id = ?", (node_id,))
+    for chunk in cursor.fetchall():
+        name = blob_name(chunk['file_path'])
+        if client.stat(node_id, name) is not None:
+            continue
+        
+        # Other copies of a chunk have their own blob names, so copy the content
+        cursor.execute("""
+            SELECT node_id, file_path
+            FROM chunk_locations
+            WHERE chunk_hash = ? AND node_id != ?
+        """, (chunk['chunk_hash'], node_id))
+        for replica in cursor.fetchall():
+            try:
+                with client.open(replica['node_id'], blob_name(replica['file_path'])) as reader:
+                    client.put_bytes(node_id, name, reader.read())
+                repaired_count += 1
+                break
+            except Exception:
+                REPAIR_COPY_FAILURES.inc()
+                continue
     
     conn.close()
     return repaired_count 
\ No newline at end of file
@@ -0,0 +1,20 @@
+"""
+gunicorn settings for running one API worker per core
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported and bootstrapped once in the master process
+(preload_app), so each worker is a cheap fork that can serve right away.
+Background threads don't survive fork and are started in each worker.
+"""
+from config import WORKERS, WORKER_THREADS, BIND_ADDRESS
+
+bind = BIND_ADDRESS
+workers = WORKERS
+worker_class = 'gthread'
+threads = WORKER_THREADS
+preload_app = True
+
+def post_fork(server, worker):
+    from app import start_background_jobs
+    start_background_jobs()
@@ -0,0 +1,93 @@
+"""
+Status of admin-started background jobs, shared by all worker processes
+
+A job started through one worker runs on a thread of that worker, but the
+next status request or start may be answered by any other. While a job runs
+it holds an exclusive lock file (<DATABASE_PATH>.<name>.lock), so only one
+run happens at a time across the deployment, and it keeps its status in the
+job_status table. A status still saying 'running' while nobody holds the lock
+belongs to a process that died mid-run and reads as 'interrupted'.
+"""
+import fcntl
+import json
+import time
+import db
+from metadata_writer import writer
+from config import DATABASE_PATH
+
+class JobLock:
+    """Exclusive lock file held for the duration of a job run, across processes"""
+
+    def __init__(self, name):
+        self.path = f"{DATABASE_PATH}.{name}.lock"
+        self._file = None
+
+    def acquire(self):
+        """
+        Take the lock without waiting
+
+        Returns:
+            bool: False if a run holds it already (in this process or another)
+        """
+        # Each attempt opens its own file, so a second run in this process conflicts too
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def is_held(self):
+        """Check whether a run holds the lock right now"""
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+def save_status(name, status):
+    """Store a job's status for every worker to read"""
+    payload = json.dumps(status)
+    writer.execute(lambda cursor: cursor.execute("""
+        INSERT INTO job_status (name, status, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+    """, (name, payload, time.time())))
+
+def _load(name):
+    conn = db.connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status FROM job_status WHERE name = ?", (name,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+def load_status(name, default, lock=None):
+    """
+    Get a job's last stored status
+
+    Args:
+        name: Job name
+        default: Status to report if the job never ran
+        lock: The job's JobLock, to tell a running job from one whose process died
+
+    Returns:
+        dict: The status
+    """
+    status = _load(name)
+    if status is None:
+        return default
+    if lock is not None and status.get('state') == 'running' and not lock.is_held():
+        # It may have just finished; only a run that is still 'running' was cut short
+        status = _load(name)
+        if status.get('state') == 'running':
+            status['state'] = 'interrupted'
+    return status
@@ -0,0 +1,181 @@
+import db
+from metadata_writer import writer
+from cache import metadata_cache, invalidate_file
+from file_utils import delete_replicas
+from versions import release_chunks
+from conditional import bump, bump_file_owners, user_scope, user_counter_sql, GLOBAL_SCOPE
+from config import REPLICATION_FACTOR
+
+def is_admin_user(cursor, user_id):
+    """Check whether a user has the admin role"""
+    cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
+    user = cursor.fetchone()
+    return bool(user) and user[0] == 'admin'
+
+def _cache_get(cursor, key):
+    """
+    Get a cached metadata value if it is still current
+
+    Other worker processes (and the data plane and CLI tools) change metadata
+    without touching this process's cache, so entries are tagged with their
+    owner's change counter as read along with them, and only trusted while
+    the counter hasn't moved.
+
+    Returns:
+        The cached value, or None on a miss or if it went stale
+    """
+    entry = metadata_cache.get(key)
+    if entry is None:
+        return None
+    value, user_id, counter = entry
+    cursor.execute("SELECT counter FROM change_counters WHERE scope = ?", (user_scope(user_id),))
+    row = cursor.fetchone()
+    if (row[0] if row else 0) != counter:
+        metadata_cache.invalidate(key)
+        return None
+    return value
+
+def get_file_record(cursor, file_id):
+    """Get a file row (with owner username) through the metadata cache"""
+    file = _cache_get(cursor, ('file', file_id))
+    if file is None:
+        cursor.execute(f"""
+            SELECT f.*, u.username, {user_counter_sql('f.user_id')} AS cache_counter
+            FROM files f
+            JOIN users u ON f.user_id = u.id
+            WHERE f.id = ?
+        """, (file_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        file = dict(row)
+        counter = file.pop('cache_counter')
+        metadata_cache.put(('file', file_id), (file, file['user_id'], counter))
+    return file
+
+def get_file_locations(cursor, file_id):
+    """Get the replica locations of a file through the metadata cache"""
+    locations = _cache_get(cursor, ('locations', file_id))
+    if locations is None:
+        cursor.execute(f"""
+            SELECT l.id, l.node_id, l.file_path, l.size, l.extra,
+                   f.user_id AS owner_id, {user_counter_sql('f.user_id')} AS cache_counter
+            FROM file_locations l
+            JOIN files f ON f.id = l.file_id
+            WHERE l.file_id = ?
+        """, (file_id,))
+        locations = [dict(row) for row in cursor.fetchall()]
+        for location in locations:
+            owner_id, counter = location.pop('owner_id'), location.pop('cache_counter')
+        # Without any locations there is no owner to tag the entry with
+        if locations:
+            metadata_cache.put(('locations', file_id), (locations, owner_id, counter))
+    return locations
+
+def get_user_replication_factor(user_id):
+    """Get the number of replicas new uploads of a user get, through the metadata cache"""
+    conn = db.connect()
+    try:
+        cursor = conn.cursor()
+        factor = _cache_get(cursor, ('replication', user_id))
+        if factor is None:
+            cursor.execute(f"SELECT replication_factor, {user_counter_sql('id')} FROM users WHERE id = ?", (user_id,))
+            row = cursor.fetchone()
+            factor = row[0] if row and row[0] else REPLICATION_FACTOR
+            if row:
+                metadata_cache.put(('replication', user_id), (factor, user_id, row[1]))
+    finally:
+        conn.close()
+    return factor
+
+def record_file(unique_filename, orig_filename, user_id, file_size, storage_info, content_hash=None):
+    """
+    Store metadata for a newly replicated file
+    
+    Args:
+        unique_filename: Unique name the file was stored under
+        orig_filename: Sanitized name the user uploaded
+        user_id: ID of the user who owns the file
+        file_size: Size of the file in bytes
+        storage_info: Replica locations returned by store_file_with_replication
+        content_hash: SHA-256 hex digest of the content
+        
+    Returns:
+        int: ID of the new file record
+    """
+    return record_files([{
+        'filename': unique_filename,
+        'original_filename': orig_filename,
+        'user_id': user_id,
+        'size': file_size,
+        'storage_info': storage_info,
+        'content_hash': content_hash
+    }])[0]
+
+def record_files(entries):
+    """
+    Store metadata for many newly replicated files in a single transaction
+    
+    The write goes through the group-commit writer, so concurrent uploads
+    share one commit; this returns once the rows are durable.
+    
+    Args:
+        entries: List of dicts with 'filename', 'original_filename', 'user_id',
+                 'size', 'storage_info' and optionally 'content_hash' (as in record_file)
+        
+    Returns:
+        List of new file IDs, in the same order as entries
+    """
+    def write(cursor):
+        file_ids = []
+        for entry in entries:
+            # Insert file record
+            cursor.execute(
+                "INSERT INTO files (filename, original_filename, user_id, size, content_hash) VALUES (?, ?, ?, ?, ?)",
+                (entry['filename'], entry['original_filename'], entry['user_id'], entry['size'], entry.get('content_hash'))
+            )
+            file_id = cursor.lastrowid
+            file_ids.append(file_id)
+            
+            # Insert file location records
+            cursor.executemany(
+                "INSERT INTO file_locations (file_id, node_id, file_path, size) VALUES (?, ?, ?, ?)",
+                [(file_id, location['node_id'], location['file_path'], location['size'])
+                 for location in entry['storage_info']]
+            )
+        bump(cursor, GLOBAL_SCOPE, *(user_scope(entry['user_id']) for entry in entries))
+        return file_ids
+    
+    file_ids = writer.execute(write)
+    
+    for file_id in file_ids:
+        invalidate_file(file_id)
+    return file_ids
+
+def delete_file_records(file_ids):
+    """
+    Delete the file and location rows of many files in a single transaction
+    
+    Versions are dropped too, and chunks no longer used by any version are
+    deleted from the nodes once the transaction has committed.
+    
+    Args:
+        file_ids: IDs of the files to delete
+    """
+    if not file_ids:
+        return
+    
+    placeholders = ','.join('?' * len(file_ids))
+    
+    def write(cursor):
+        bump_file_owners(cursor, file_ids)
+        cursor.execute(f"DELETE FROM file_locations WHERE file_id IN ({placeholders})", file_ids)
+        cursor.execute(f"DELETE FROM file_access_stats WHERE file_id IN ({placeholders})", file_ids)
+        cursor.execute(f"DELETE FROM files WHERE id IN ({placeholders})", file_ids)
+        return release_chunks(cursor, file_ids)
+    
+    unused_chunks = writer.execute(write)
+    
+    for file_id in file_ids:
+        invalidate_file(file_id)
+    delete_replicas(unused_chunks)
@@ -0,0 +1,179 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import db
+from metrics import registry
+from config import (METADATA_GROUP_COMMIT, METADATA_GROUP_COMMIT_MAX_DELAY_MS, METADATA_GROUP_COMMIT_MAX_BATCH,
+                    METADATA_WRITE_TIMEOUT_SECONDS)
+
+class MetadataWriter:
+    """
+    Single writer thread that applies metadata writes in group commits
+
+    Each write is a function taking a cursor. Writes submitted by concurrent
+    requests are collected for up to a few milliseconds and run in one
+    transaction, each inside its own savepoint so one failing write doesn't
+    undo the others. Callers get their result once the batch has committed,
+    so many uploads share one fsync instead of paying for one each.
+
+    If the writer thread can't open the database or dies, every write it
+    still holds fails with that error and the next submit starts a new one.
+    """
+
+    def __init__(self, max_delay_ms=METADATA_GROUP_COMMIT_MAX_DELAY_MS, max_batch=METADATA_GROUP_COMMIT_MAX_BATCH):
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self.batches = 0
+        self.writes = 0
+
+    def _enqueue(self, item):
+        # Threads don't survive fork, so each worker process starts its own. Queueing
+        # under the lock means a dying writer can't miss a write handed to it.
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                                name='metadata-writer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            self._queue.put(item)
+
+    def submit(self, write):
+        """
+        Queue a write for the next group commit
+
+        Args:
+            write: Callable taking a cursor; its return value becomes the future's result
+
+        Returns:
+            Future resolved once the write's batch is durable
+        """
+        future = Future()
+        if not METADATA_GROUP_COMMIT:
+            # Group commit disabled: run the write in its own transaction
+            try:
+                future.set_result(self._run_alone(write))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._enqueue((write, future))
+        return future
+
+    def execute(self, write, timeout=METADATA_WRITE_TIMEOUT_SECONDS):
+        """
+        Run a write through the group commit and wait for its result
+
+        Raises:
+            concurrent.futures.TimeoutError: If it hasn't committed within timeout
+                seconds; it may still commit later
+        """
+        return self.submit(write).result(timeout=timeout)
+
+    def _run_alone(self, write):
+        conn = db.connect()
+        try:
+            result = write(conn.cursor())
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def _collect(self, pending):
+        """Block for one write, then gather more for up to max_delay"""
+        batch = [pending.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(pending.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending):
+        conn = None
+        batch = []
+        try:
+            conn = db.connect()
+            # Explicit transactions only; WAL lets readers keep going during commits
+            conn.isolation_level = None
+            conn.cursor().execute("PRAGMA journal_mode=WAL")
+            while True:
+                batch = self._collect(pending)
+                self._commit(conn, batch)
+                batch = []
+        except Exception as e:
+            with self._lock:
+                # Nothing more reaches this queue; the next submit starts a new writer
+                if self._queue is pending:
+                    self._thread = None
+            while True:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _commit(self, conn, batch):
+        """Apply a batch in one transaction and resolve its futures"""
+        cursor = conn.cursor()
+        results = []
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for write, future in batch:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    results.append((future, write(cursor), None))
+                    cursor.execute("RELEASE write")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write")
+                    cursor.execute("RELEASE write")
+                    results.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # The whole batch failed to commit
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            # A connection that can't roll back is unusable; let the writer restart
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+writer = MetadataWriter()
+
+def _collect_writer_metrics():
+    return [
+        ('dfss_metadata_group_commits_total', 'counter', 'Group commits by the metadata writer', [({}, writer.batches)]),
+        ('dfss_metadata_group_commit_writes_total', 'counter', 'Writes applied through group commits', [({}, writer.writes)])
+    ]
+
+registry.register_collector(_collect_writer_metrics)
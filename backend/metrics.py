@@ -0,0 +1,190 @@
+"""
+Minimal in-process metrics registry rendered in Prometheus text exposition format
+
+Metrics are plain dicts keyed by label values behind one lock each, so
+recording a sample costs a dict lookup and an add.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    """Base class holding one value per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the block as in flight while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (non-cumulative), then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value[0], value[1], value[2]
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    """Collection of metrics plus callbacks that report externally kept counters"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """
+        Register a callable run at scrape time
+
+        It returns a list of (name, type, documentation, [(labels dict, value), ...]).
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {value}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# HTTP
+REQUEST_LATENCY = registry.histogram(
+    'dfss_http_request_duration_seconds', 'Request latency by route', ('method', 'endpoint', 'status'))
+REQUESTS_IN_FLIGHT = registry.gauge('dfss_http_requests_in_flight', 'Requests being handled')
+BYTES_IN = registry.counter('dfss_http_bytes_received_total', 'Request body bytes received', ('endpoint',))
+BYTES_OUT = registry.counter('dfss_http_bytes_sent_total', 'Response body bytes sent', ('endpoint',))
+TRANSFERS_IN_FLIGHT = registry.gauge('dfss_transfers_in_flight', 'Uploads and downloads in progress', ('direction',))
+TRANSFERS_QUEUED = registry.gauge('dfss_transfers_queued', 'Transfers waiting for an admission slot')
+TRANSFERS_REJECTED = registry.counter(
+    'dfss_transfers_rejected_total', 'Transfers rejected with 429 by admission control', ('reason',))
+THROTTLE_SECONDS = registry.counter(
+    'dfss_transfer_throttle_seconds_total', 'Time transfers were delayed by bandwidth shaping')
+
+# Storage nodes
+NODE_OP_LATENCY = registry.histogram(
+    'dfss_node_operation_duration_seconds', 'Storage node operation latency', ('node', 'op'))
+NODE_OP_ERRORS = registry.counter('dfss_node_operation_errors_total', 'Failed storage node operations', ('node', 'op'))
+REPLICA_FALLBACKS = registry.counter(
+    'dfss_replica_fallbacks_total', 'Reads that had to skip an unreadable replica')
+REPAIR_COPY_FAILURES = registry.counter(
+    'dfss_repair_copy_failures_total', 'Replica copies that failed during node repair')
+
+# Database
+DB_QUERY_LATENCY = registry.histogram(
+    'dfss_db_query_duration_seconds', 'SQLite statement latency by statement type', ('statement',))
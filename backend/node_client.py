@@ -0,0 +1,336 @@
+import http.client
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from functools import partial
+from urllib.parse import urlsplit, quote
+import node_layout
+from copy_engine import copy_file
+from metrics import NODE_OP_LATENCY, NODE_OP_ERRORS
+from profiling import record_io
+from config import (NODES_DIR, COPY_MODE, NODE_BACKEND, NODE_ADDRESSES, NODE_SECRET, NODE_SECRET_HEADER,
+                    NODE_CLIENT_TIMEOUT, NODE_CLIENT_RETRIES, NODE_CLIENT_POOL_SIZE)
+
+CHUNK_SIZE = 64 * 1024
+
+class NodeError(Exception):
+    """Raised when a storage node cannot complete an operation"""
+
+def blob_name(file_path):
+    """Get the blob name a node stores a replica under from its recorded file path"""
+    return os.path.basename(file_path)
+
+class LocalNodeClient:
+    """Talks to nodes that are directories under NODES_DIR in this process"""
+
+    def node_path(self, node_id):
+        return os.path.join(NODES_DIR, f"node{node_id}")
+
+    def blob_path(self, node_id, name):
+        return node_layout.resolve(self.node_path(node_id), name)
+
+    def apply(self, node_id, name, action):
+        """Run action(path) on blob `name`, following it if the layout migrator moves it"""
+        return node_layout.apply(self.node_path(node_id), name, action)
+
+    def put(self, node_id, name, src_path):
+        """Store the file at src_path on a node as blob `name`"""
+        self._store(node_id, name, partial(copy_file, src_path))
+
+    def put_bytes(self, node_id, name, data):
+        """Store `data` on a node as blob `name`"""
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        self._store(node_id, name, write)
+
+    def _store(self, node_id, name, write):
+        node_path = self.node_path(node_id)
+        if not os.path.isdir(node_path):
+            raise NodeError(f"Node {node_id} is unavailable")
+        dest = node_layout.prepare(node_path, name)
+        # Write under a hidden name and rename, so readers never see a partial or
+        # truncated blob, even when an existing blob is overwritten
+        temp = os.path.join(node_path, f".tmp_{uuid.uuid4()}")
+        try:
+            write(temp)
+            os.replace(temp, dest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def get(self, node_id, name, dest_path):
+        """Copy blob `name` from a node to dest_path"""
+        # Staging copies for downloads are never hard-linked, since callers may modify them
+        mode = 'auto' if COPY_MODE == 'hardlink' else None
+        self.apply(node_id, name, lambda path: copy_file(path, dest_path, mode=mode))
+
+    def open(self, node_id, name):
+        """Open blob `name` for streaming reads"""
+        return self.apply(node_id, name, lambda path: open(path, 'rb'))
+
+    def stat(self, node_id, name):
+        """Return the size of blob `name`, or None if the node doesn't have it"""
+        try:
+            return self.apply(node_id, name, os.path.getsize)
+        except OSError:
+            return None
+
+    def delete(self, node_id, name):
+        """Delete blob `name`; returns False if it wasn't there"""
+        try:
+            self.apply(node_id, name, os.remove)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def copy(self, src_node_id, dst_node_id, name):
+        """Copy a blob from one node to another"""
+        self.apply(src_node_id, name, lambda path: self.put(dst_node_id, name, path))
+
+    def health(self, node_id):
+        """Return 'healthy', 'failed' (a simulated failure) or 'unknown'"""
+        if os.path.isdir(self.node_path(node_id)):
+            return 'healthy'
+        if os.path.isdir(f"{self.node_path(node_id)}_failed"):
+            return 'failed'
+        return 'unknown'
+
+class BlobReader:
+    """File-like wrapper around a streamed GET that returns its connection to the pool"""
+
+    def __init__(self, client, node_id, conn, response):
+        self.client = client
+        self.node_id = node_id
+        self.conn = conn
+        self.response = response
+        self.size = int(response.getheader('Content-Length', 0))
+
+    def read(self, size=-1):
+        return self.response.read(None if size < 0 else size)
+
+    def close(self):
+        if self.conn is None:
+            return
+        # Only fully read responses leave the connection reusable
+        reusable = self.response.isclosed()
+        self.response.close()
+        self.client.release(self.node_id, self.conn, reusable)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class HttpNodeClient:
+    """Talks to node_server.py daemons over HTTP with pooled keep-alive connections"""
+
+    def __init__(self, addresses=NODE_ADDRESSES, timeout=NODE_CLIENT_TIMEOUT, retries=NODE_CLIENT_RETRIES,
+                 pool_size=NODE_CLIENT_POOL_SIZE, secret=NODE_SECRET):
+        self.addresses = {node_id: urlsplit(address) for node_id, address in addresses.items()}
+        self.auth_headers = {NODE_SECRET_HEADER: secret} if secret else {}
+        self.timeout = timeout
+        self.retries = retries
+        self.pools = {node_id: queue.LifoQueue(maxsize=pool_size) for node_id in addresses}
+
+    def connect(self, node_id):
+        """Open a new connection to a node"""
+        if node_id not in self.addresses:
+            raise NodeError(f"Unknown node {node_id}")
+        address = self.addresses[node_id]
+        return http.client.HTTPConnection(address.hostname, address.port, timeout=self.timeout)
+
+    def acquire(self, node_id):
+        """Take an idle connection from the node's pool, or open a new one"""
+        if node_id not in self.addresses:
+            raise NodeError(f"Unknown node {node_id}")
+        try:
+            return self.pools[node_id].get_nowait()
+        except queue.Empty:
+            return self.connect(node_id)
+
+    def discard_pool(self, node_id):
+        """Close every idle connection to a node, e.g. after it restarted and they all went stale"""
+        pool = self.pools[node_id]
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def release(self, node_id, conn, reusable=True):
+        """Return a connection to the pool, closing it if it is broken or the pool is full"""
+        if not reusable:
+            conn.close()
+            return
+        try:
+            self.pools[node_id].put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, node_id, method, name, body=None, headers=None, stream=False):
+        """
+        Send a blob request to a node, retrying on connection errors
+
+        Returns:
+            (response, body bytes) or, with stream=True and a 200 response, (response, BlobReader)
+        """
+        path = '/blobs/' + quote(name) if name is not None else '/blobs'
+        return self.send(node_id, method, path, body, headers, stream)
+
+    def send(self, node_id, method, path, body=None, headers=None, stream=False, retries=None):
+        """
+        Send a request to a node, retrying on connection errors (see request)
+        """
+        # A streamed body can't be rewound, so it only gets one attempt, on a new connection
+        rewindable = body is None or isinstance(body, bytes) or hasattr(body, 'seek')
+        retries = (self.retries if retries is None else retries) if rewindable else 0
+        last_error = None
+
+        for attempt in range(retries + 1):
+            # Only the first attempt may use a pooled connection; retries get a new one
+            conn = self.acquire(node_id) if attempt == 0 and rewindable else self.connect(node_id)
+            try:
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn.request(method, path, body=body, headers={**self.auth_headers, **(headers or {})})
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # A node that restarted left every pooled connection stale, not just this one
+                self.discard_pool(node_id)
+                last_error = e
+                if attempt < retries:
+                    time.sleep(0.05 * (2 ** attempt))
+                continue
+
+            if stream and response.status == 200:
+                return response, BlobReader(self, node_id, conn, response)
+
+            data = response.read()
+            self.release(node_id, conn, not response.will_close)
+            return response, data
+
+        raise NodeError(f"Node {node_id} is unreachable: {last_error}")
+
+    def put(self, node_id, name, src_path):
+        with open(src_path, 'rb') as f:
+            headers = {'Content-Length': str(os.fstat(f.fileno()).st_size)}
+            response, data = self.request(node_id, 'PUT', name, body=f, headers=headers)
+        if response.status not in (200, 201):
+            raise NodeError(f"Node {node_id} rejected {name}: {response.status} {data[:200]!r}")
+
+    def put_bytes(self, node_id, name, data):
+        response, body = self.request(node_id, 'PUT', name, body=data, headers={'Content-Length': str(len(data))})
+        if response.status not in (200, 201):
+            raise NodeError(f"Node {node_id} rejected {name}: {response.status} {body[:200]!r}")
+
+    def open(self, node_id, name):
+        response, reader = self.request(node_id, 'GET', name, stream=True)
+        if response.status != 200:
+            raise NodeError(f"Node {node_id} could not read {name}: {response.status}")
+        return reader
+
+    def get(self, node_id, name, dest_path):
+        with self.open(node_id, name) as reader, open(dest_path, 'wb') as out:
+            shutil.copyfileobj(reader, out, CHUNK_SIZE)
+
+    def stat(self, node_id, name):
+        # Only a 404 means the blob is absent; an unreachable or failed node raises
+        response, _ = self.request(node_id, 'HEAD', name)
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise NodeError(f"Node {node_id} could not stat {name}: {response.status}")
+        return int(response.getheader('Content-Length', 0))
+
+    def delete(self, node_id, name):
+        response, _ = self.request(node_id, 'DELETE', name)
+        if response.status == 404:
+            return False
+        if response.status not in (200, 204):
+            raise NodeError(f"Node {node_id} could not delete {name}: {response.status}")
+        return True
+
+    def copy(self, src_node_id, dst_node_id, name):
+        # Stream straight from one node to the other without a temp file
+        with self.open(src_node_id, name) as reader:
+            headers = {'Content-Length': str(reader.size)}
+            response, _ = self.request(dst_node_id, 'PUT', name, body=reader, headers=headers)
+        if response.status not in (200, 201):
+            raise NodeError(f"Node {dst_node_id} rejected {name}: {response.status}")
+
+    def health(self, node_id):
+        """Return 'healthy', 'failed' (the daemon reports its directory is gone) or 'unreachable'"""
+        try:
+            # One retry, on a new connection, gets past a pooled one left stale by a restart
+            response, _ = self.send(node_id, 'GET', '/health', retries=1)
+        except NodeError:
+            return 'unreachable'
+        return 'healthy' if response.status == 200 else 'failed'
+
+class InstrumentedNodeClient:
+    """Wraps a node client to record per-node latency and error counts"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _call(self, op, node_id, func, *args):
+        start = time.perf_counter()
+        error = None
+        try:
+            return func(*args)
+        except Exception as e:
+            NODE_OP_ERRORS.inc(node=node_id, op=op)
+            error = str(e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            NODE_OP_LATENCY.observe(elapsed, node=node_id, op=op)
+            record_io(op, node_id, elapsed, error)
+
+    def put(self, node_id, name, src_path):
+        return self._call('put', node_id, self.client.put, node_id, name, src_path)
+
+    def put_bytes(self, node_id, name, data):
+        return self._call('put', node_id, self.client.put_bytes, node_id, name, data)
+
+    def get(self, node_id, name, dest_path):
+        return self._call('get', node_id, self.client.get, node_id, name, dest_path)
+
+    def open(self, node_id, name):
+        return self._call('open', node_id, self.client.open, node_id, name)
+
+    def stat(self, node_id, name):
+        return self._call('stat', node_id, self.client.stat, node_id, name)
+
+    def delete(self, node_id, name):
+        return self._call('delete', node_id, self.client.delete, node_id, name)
+
+    def copy(self, src_node_id, dst_node_id, name):
+        # Attributed to the node being written
+        return self._call('copy', dst_node_id, self.client.copy, src_node_id, dst_node_id, name)
+
+    def health(self, node_id):
+        return self._call('health', node_id, self.client.health, node_id)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_node_client():
+    """Get the process-wide node client for the configured NODE_BACKEND"""
+    global _client, _client_pid
+    # Pooled connections can't be shared with a forked worker, so each process makes its own
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                client = HttpNodeClient() if NODE_BACKEND == 'http' else LocalNodeClient()
+                _client = InstrumentedNodeClient(client)
+                _client_pid = os.getpid()
+    return _client
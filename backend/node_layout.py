@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+import threading
+from job_status import JobLock, save_status, load_status
+
+# Blobs live under two levels of hex-prefix directories, e.g. node1/3f/a2/<name>,
+# so no directory grows past a few thousand entries however large a node gets
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+_UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+_SHARD_RE = re.compile(r'^[0-9a-f]{%d}$' % SHARD_WIDTH)
+
+def shard_key(name):
+    """
+    Get the hex digits used to shard a blob
+
+    Blob names embed the file's UUID (user_{id}_{uuid}_{name}), which is
+    already uniformly random. Names without one are hashed instead.
+    """
+    match = _UUID_RE.search(name)
+    if match:
+        return match.group(0).replace('-', '')
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+def shard_dirs(name):
+    """Get the shard subdirectories for a blob, e.g. ['3f', 'a2']"""
+    key = shard_key(name)
+    return [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+
+def blob_path(node_root, name):
+    """Get the sharded path a blob is written to"""
+    return os.path.join(node_root, *shard_dirs(name), name)
+
+def resolve(node_root, name):
+    """
+    Find where a blob currently lives on a node
+
+    Looks at the sharded path first and falls back to the legacy flat path for
+    files the migrator hasn't moved yet. A blob found at neither path may have
+    been moved from flat to sharded between the two checks, so the sharded
+    path is what's returned then.
+
+    The blob can still move after this returns; use apply() to act on it.
+
+    Returns:
+        Path of the blob, or its sharded path if it doesn't exist anywhere
+    """
+    sharded = blob_path(node_root, name)
+    if os.path.exists(sharded):
+        return sharded
+    flat = os.path.join(node_root, name)
+    if os.path.exists(flat):
+        return flat
+    return sharded
+
+def apply(node_root, name, action):
+    """
+    Run action(path) on a blob wherever it lives on a node
+
+    The migrator may move a blob from its flat to its sharded path between
+    resolve() and the action, so an action failing with FileNotFoundError is
+    retried once against the other location.
+
+    Returns:
+        Whatever action returns
+    """
+    path = resolve(node_root, name)
+    try:
+        return action(path)
+    except FileNotFoundError:
+        sharded = blob_path(node_root, name)
+        other = os.path.join(node_root, name) if path == sharded else sharded
+        return action(other)
+
+def prepare(node_root, name):
+    """Create the shard directories for a blob and return the path to write it to"""
+    path = blob_path(node_root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def iter_blobs(node_root, include_temp=False):
+    """
+    Stream the blobs stored on a node, in both flat and sharded layout
+
+    Args:
+        node_root: Directory of the node
+        include_temp: Also yield temp files of in-progress (or abandoned) writes, whose names start with '.'
+
+    Yields:
+        os.DirEntry for each blob
+    """
+    yield from _iter_level(node_root, 0, include_temp)
+
+def _iter_level(path, level, include_temp):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') and not include_temp:
+                # Temp files from in-progress writes
+                continue
+            if entry.is_file(follow_symlinks=False):
+                yield entry
+            elif level < SHARD_LEVELS and entry.is_dir(follow_symlinks=False) and _SHARD_RE.match(entry.name):
+                yield from _iter_level(entry.path, level + 1, include_temp)
+
+def migrate_node(node_root, should_stop=None):
+    """
+    Move every flat blob on a node into its sharded directory
+
+    Moves are atomic renames within the node, so readers going through
+    resolve() always find the blob during migration.
+
+    Args:
+        node_root: Directory of the node to migrate
+        should_stop: Optional callable; migration stops early when it returns True
+
+    Returns:
+        int: Number of blobs moved
+    """
+    moved = 0
+    with os.scandir(node_root) as entries:
+        for entry in entries:
+            if should_stop and should_stop():
+                break
+            if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                continue
+            os.replace(entry.path, prepare(node_root, entry.name))
+            moved += 1
+    return moved
+
+class LayoutMigrator:
+    """Runs migrate_node over a set of nodes on a background thread, one run at a time across worker processes"""
+
+    name = 'migrate-layout'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._job_lock = JobLock(self.name)
+
+    @property
+    def status(self):
+        """Progress of the last migration, whichever worker ran it"""
+        return load_status(self.name, {'state': 'idle', 'moved': {}, 'errors': {}}, self._job_lock)
+
+    def start(self, node_roots):
+        """
+        Start migrating the given nodes in the background
+
+        Args:
+            node_roots: Dict of node ID to node directory
+
+        Returns:
+            bool: False if a migration is already running
+        """
+        with self._lock:
+            if not self._job_lock.acquire():
+                return False
+            self._stop.clear()
+            try:
+                save_status(self.name, {'state': 'running', 'moved': {}, 'errors': {}})
+            except Exception:
+                self._job_lock.release()
+                raise
+            self._thread = threading.Thread(target=self._run, args=(node_roots,), daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, node_roots):
+        status = {'state': 'running', 'moved': {}, 'errors': {}}
+        try:
+            for node_id, node_root in node_roots.items():
+                if self._stop.is_set():
+                    break
+                if not os.path.isdir(node_root):
+                    # Failed nodes are migrated once they are repaired
+                    status['errors'][node_id] = 'node unavailable'
+                    continue
+                try:
+                    status['moved'][node_id] = migrate_node(node_root, self._stop.is_set)
+                except OSError as e:
+                    status['errors'][node_id] = str(e)
+                # Progress so far, for status requests answered by other workers
+                save_status(self.name, status)
+            status['state'] = 'stopped' if self._stop.is_set() else 'finished'
+            save_status(self.name, status)
+        finally:
+            self._job_lock.release()
+
+migrator = LayoutMigrator()
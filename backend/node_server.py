@@ -0,0 +1,247 @@
+"""
+Standalone storage node daemon
+
+Serves the blobs of one node over HTTP so nodes can run as separate processes
+or on separate machines:
+
+    PUT    /blobs/<name>   store a blob (body streamed to disk, then renamed into its shard)
+    GET    /blobs/<name>   stream a blob
+    HEAD   /blobs/<name>   blob size via Content-Length
+    DELETE /blobs/<name>   delete a blob
+    GET    /blobs          JSON list of blob names and sizes
+    GET    /health         node status
+
+Every request except /health must carry the shared secret (DFSS_NODE_SECRET)
+in the X-Node-Secret header. Without a secret the daemon only listens on the
+loopback interface.
+
+Run one per node, e.g. for local testing:
+    python node_server.py --node-id 1
+"""
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+import node_layout
+from config import NODES_DIR, NODE_BASE_PORT, NODE_SECRET, NODE_SECRET_HEADER
+
+CHUNK_SIZE = 64 * 1024
+
+class NodeRequestHandler(BaseHTTPRequestHandler):
+    """Request handler for a single node's blob store"""
+
+    # Keep-alive so the API's pooled connections can be reused
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def root(self):
+        return self.server.root
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # Clients drop pooled connections whenever they abandon a read
+            pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def reject(self, status, message):
+        """
+        Send an error before the request body was read
+
+        Leftover body bytes would be parsed as the next request on a kept-alive
+        connection, so the connection is closed whenever a body may follow.
+        """
+        headers = None
+        if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+            headers = {'Connection': 'close'}
+            self.close_connection = True
+        self.send_json(status, {'message': message}, headers)
+
+    def authorized(self):
+        """Check the shared secret, sending a 401 if it's wrong"""
+        secret = self.server.secret
+        if secret is None or hmac.compare_digest(self.headers.get(NODE_SECRET_HEADER, ''), secret):
+            return True
+        self.reject(401, 'Invalid node secret')
+        return False
+
+    def blob_name(self):
+        """
+        Get the blob name from the request path
+
+        Returns:
+            Blob name, or None after sending an error response
+        """
+        if not self.authorized():
+            return None
+
+        if not os.path.isdir(self.root):
+            # The node directory is gone, e.g. a simulated failure
+            self.reject(503, 'Node unavailable')
+            return None
+
+        if not self.path.startswith('/blobs/'):
+            self.reject(404, 'Not found')
+            return None
+
+        name = unquote(self.path[len('/blobs/'):])
+        if not name or '/' in name or '\\' in name or name in ('.', '..'):
+            self.reject(400, 'Invalid blob name')
+            return None
+
+        return name
+
+    def do_GET(self):
+        if self.path == '/health':
+            status = 'healthy' if os.path.isdir(self.root) else 'failed'
+            self.send_json(200 if status == 'healthy' else 503, {'status': status})
+            return
+
+        if self.path == '/blobs':
+            if not self.authorized():
+                return
+            if not os.path.isdir(self.root):
+                self.send_json(503, {'message': 'Node unavailable'})
+                return
+            blobs = [{'name': entry.name, 'size': entry.stat().st_size}
+                     for entry in node_layout.iter_blobs(self.root)]
+            self.send_json(200, blobs)
+            return
+
+        self.send_blob(include_body=True)
+
+    def do_HEAD(self):
+        self.send_blob(include_body=False)
+
+    def send_blob(self, include_body):
+        name = self.blob_name()
+        if name is None:
+            return
+        try:
+            f = node_layout.apply(self.root, name, lambda path: open(path, 'rb'))
+        except FileNotFoundError:
+            self.send_json(404, {'message': 'Blob not found'})
+            return
+
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if include_body:
+                # Zero-copy from the page cache to the socket where the OS supports it
+                self.connection.sendfile(f)
+
+    def do_PUT(self):
+        name = self.blob_name()
+        if name is None:
+            return
+
+        if 'Content-Length' not in self.headers:
+            self.reject(411, 'Content-Length required')
+            return
+        try:
+            remaining = int(self.headers['Content-Length'])
+        except ValueError:
+            remaining = -1
+        if remaining < 0:
+            self.reject(400, 'Invalid Content-Length')
+            return
+
+        # Write to a temp name and rename so readers never see a partial blob
+        temp_path = os.path.join(self.root, f".tmp_{uuid.uuid4()}")
+        try:
+            try:
+                out = open(temp_path, 'wb')
+            except OSError:
+                # The node directory went away after the check in blob_name
+                self.reject(503, 'Node unavailable')
+                return
+            with out:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ConnectionError('Client closed the connection')
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            os.replace(temp_path, node_layout.prepare(self.root, name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.send_json(201, {'message': 'Blob stored'})
+
+    def do_DELETE(self):
+        name = self.blob_name()
+        if name is None:
+            return
+
+        try:
+            node_layout.apply(self.root, name, os.remove)
+        except FileNotFoundError:
+            self.send_json(404, {'message': 'Blob not found'})
+            return
+
+        self.send_json(200, {'message': 'Blob deleted'})
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def run_node(node_id, host='127.0.0.1', port=None, root=None, secret=NODE_SECRET):
+    """
+    Serve a node's blobs until interrupted
+
+    Args:
+        node_id: ID of the node to serve
+        host: Interface to bind
+        port: Port to listen on (default NODE_BASE_PORT + node_id)
+        root: Directory holding the node's blobs (default NODES_DIR/node<id>)
+        secret: Shared secret clients must send (required unless host is loopback)
+    """
+    if not secret and not _is_loopback(host):
+        raise SystemExit(f"Refusing to serve blobs on {host} without DFSS_NODE_SECRET set")
+    port = port or NODE_BASE_PORT + node_id
+    server = ThreadingHTTPServer((host, port), NodeRequestHandler)
+    server.daemon_threads = True
+    server.secret = secret or None
+    server.root = root or os.path.join(NODES_DIR, f"node{node_id}")
+    print(f"Node {node_id} serving {server.root} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a storage node daemon')
+    parser.add_argument('--node-id', type=int, required=True)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Interface to bind (anything but loopback needs DFSS_NODE_SECRET)')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--root')
+    args = parser.parse_args()
+    run_node(args.node_id, args.host, args.port, args.root)
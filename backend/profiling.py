@@ -0,0 +1,206 @@
+"""
+On-demand request profiling and slow-request capture
+
+Admins can arm the sampling profiler for the next N requests (optionally only
+those matching an endpoint name or path prefix). While a selected request
+runs, a background thread samples its stack every few milliseconds and the
+samples are aggregated per endpoint in collapsed-stack format, ready for
+flamegraph tools.
+
+Independently, when a slow-request threshold is set, every request records
+the SQL statements and node I/O it performs; requests slower than the
+threshold keep their trace in a bounded ring buffer.
+
+When nothing is armed and no threshold is set, each request only pays for a
+couple of attribute checks.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+from config import PROFILING_SAMPLE_INTERVAL_MS, SLOW_REQUEST_THRESHOLD_MS, SLOW_REQUEST_MAX_TRACES
+
+MAX_STACK_DEPTH = 64
+MAX_TRACE_EVENTS = 500
+
+_local = threading.local()
+
+class Profiler:
+    """Process-wide profiling state"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.remaining = 0
+        self.match = None
+        self.interval = PROFILING_SAMPLE_INTERVAL_MS / 1000.0
+        self.slow_threshold = SLOW_REQUEST_THRESHOLD_MS / 1000.0 if SLOW_REQUEST_THRESHOLD_MS else None
+        self.profiles = collections.defaultdict(collections.Counter)
+        self.profiled_requests = 0
+        self.slow_traces = collections.deque(maxlen=SLOW_REQUEST_MAX_TRACES)
+        self._targets = {}
+        self._sampler = None
+
+    @property
+    def active(self):
+        return self.remaining > 0 or self.slow_threshold is not None
+
+    def configure(self, requests=None, match=None, interval_ms=None, slow_threshold_ms=None, clear=False):
+        """
+        Arm the sampling profiler and/or change the slow-request threshold
+
+        Args:
+            requests: Profile the next this many matching requests
+            match: Only profile requests whose endpoint equals, or whose path starts with, this
+            interval_ms: Sampling interval
+            slow_threshold_ms: Capture traces for requests slower than this; 0 disables capture
+            clear: Drop collected profiles and traces first
+        """
+        with self._lock:
+            if clear:
+                self.profiles.clear()
+                self.profiled_requests = 0
+                self.slow_traces.clear()
+            if requests is not None:
+                self.remaining = max(0, int(requests))
+                self.match = match
+            if interval_ms:
+                self.interval = max(0.001, interval_ms / 1000.0)
+            if slow_threshold_ms is not None:
+                self.slow_threshold = slow_threshold_ms / 1000.0 if slow_threshold_ms > 0 else None
+
+    def status(self):
+        with self._lock:
+            return {
+                'remaining_requests': self.remaining,
+                'match': self.match,
+                'sample_interval_ms': self.interval * 1000,
+                'slow_threshold_ms': self.slow_threshold * 1000 if self.slow_threshold else None,
+                'profiled_requests': self.profiled_requests,
+                'profiled_endpoints': {endpoint: sum(stacks.values()) for endpoint, stacks in self.profiles.items()},
+                'slow_traces': len(self.slow_traces),
+                'pid': os.getpid()
+            }
+
+    def start_request(self, endpoint, method, path):
+        """Called at the start of every request; a profiler fault never fails the request"""
+        _local.trace = None
+        if not self.active:
+            return
+        try:
+            self._start_trace(endpoint, method, path)
+        except Exception:
+            # Observe nothing rather than break the request
+            _local.trace = None
+            with self._lock:
+                self._targets.pop(threading.get_ident(), None)
+
+    def _start_trace(self, endpoint, method, path):
+        trace = {'endpoint': endpoint, 'method': method, 'path': path, 'start': time.perf_counter(),
+                 'sql': [], 'io': [], 'profiled': False}
+        _local.trace = trace
+
+        match = self.match
+        if self.remaining > 0 and (match is None or endpoint == match or path.startswith(match)):
+            with self._lock:
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    self.profiled_requests += 1
+                    trace['profiled'] = True
+                    self._targets[threading.get_ident()] = endpoint or path
+                    self._ensure_sampler()
+
+    def finish_request(self, status):
+        """Called when a request is done; keeps its trace if it was slow"""
+        try:
+            self._finish_trace(status)
+        except Exception:
+            _local.trace = None
+            with self._lock:
+                self._targets.pop(threading.get_ident(), None)
+
+    def _finish_trace(self, status):
+        trace = getattr(_local, 'trace', None)
+        if trace is None:
+            return
+        _local.trace = None
+
+        if trace['profiled']:
+            with self._lock:
+                self._targets.pop(threading.get_ident(), None)
+
+        duration = time.perf_counter() - trace.pop('start')
+        threshold = self.slow_threshold
+        if threshold is not None and duration >= threshold:
+            trace['status'] = status
+            trace['duration_ms'] = round(duration * 1000, 3)
+            trace['captured_at'] = time.time()
+            self.slow_traces.append(trace)
+
+    def _ensure_sampler(self):
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample_loop, name='request-profiler', daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        idle_since = None
+        while True:
+            with self._lock:
+                targets = dict(self._targets)
+            if not targets:
+                # Stop once nothing has been profiled for a second
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since > 1.0:
+                    with self._lock:
+                        if not self._targets:
+                            self._sampler = None
+                            return
+            else:
+                idle_since = None
+                frames = sys._current_frames()
+                for ident, endpoint in targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = _collapse(frame)
+                        with self._lock:
+                            self.profiles[endpoint][stack] += 1
+            time.sleep(self.interval)
+
+    def collapsed_profile(self, endpoint=None):
+        """Render collected samples as collapsed stacks ('frame;frame;frame count' per line)"""
+        with self._lock:
+            lines = []
+            for name, stacks in sorted(self.profiles.items()):
+                if endpoint and name != endpoint:
+                    continue
+                for stack, count in stacks.most_common():
+                    lines.append(f"{name};{stack} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def traces(self):
+        return list(self.slow_traces)
+
+def _collapse(frame):
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+def record_sql(sql, duration):
+    """Record a SQL statement in the current request's trace, if it has one"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None and len(trace['sql']) < MAX_TRACE_EVENTS:
+        trace['sql'].append({'sql': ' '.join(sql.split()), 'ms': round(duration * 1000, 3)})
+
+def record_io(op, node_id, duration, error=None):
+    """Record a node I/O operation in the current request's trace, if it has one"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None and len(trace['io']) < MAX_TRACE_EVENTS:
+        event = {'op': op, 'node': node_id, 'ms': round(duration * 1000, 3)}
+        if error:
+            event['error'] = error
+        trace['io'].append(event)
+
+profiler = Profiler()
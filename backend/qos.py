@@ -0,0 +1,373 @@
+"""
+Admission control and bandwidth shaping for transfers
+
+Every upload and download needs a slot before it starts: at most
+QOS_MAX_TRANSFERS run at once and QOS_MAX_TRANSFERS_PER_USER per user, so one
+user running many parallel transfers can't crowd out everyone else. A
+transfer that can't start waits in a queue until QOS_QUEUE_TIMEOUT_SECONDS
+have passed. If the queue (or the user's share of it) is already full, or
+the deadline passes, the transfer is rejected right away with a 429 and a
+Retry-After estimate. Freed slots go to the waiting transfer with the best
+priority class (admins first), oldest first.
+
+A transfer waiting through acquire() holds a worker thread, and a worker only
+has WORKER_THREADS of them, so at most QOS_MAX_WAITING_THREADS (and
+QOS_MAX_WAITING_THREADS_PER_USER per user) may wait that way; one user's flood
+of queued requests can't leave the worker without threads for anyone else.
+
+The bytes each transfer moves are paced by token buckets, one per user and
+one for the whole process, so bulk transfers can't saturate the node disks.
+Limits apply per worker process.
+"""
+import asyncio
+import collections
+import itertools
+import math
+import threading
+import time
+import db
+from metadata import is_admin_user
+from metrics import TRANSFERS_QUEUED, TRANSFERS_REJECTED, THROTTLE_SECONDS
+from config import (QOS_MAX_TRANSFERS, QOS_MAX_TRANSFERS_PER_USER, QOS_MAX_QUEUED, QOS_MAX_QUEUED_PER_USER,
+                    QOS_MAX_WAITING_THREADS, QOS_MAX_WAITING_THREADS_PER_USER, QOS_QUEUE_TIMEOUT_SECONDS, QOS_USER_BYTES_PER_SECOND, QOS_TOTAL_BYTES_PER_SECOND,
+                    QOS_BURST_BYTES)
+
+# Priority classes; lower is admitted first
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+
+# Bandwidth buckets kept for idle users before full ones are dropped
+MAX_IDLE_BUCKETS = 1024
+
+class Overloaded(Exception):
+    """A transfer was not admitted; retry_after is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def user_priority(user_id):
+    """Get the priority class of a user's transfers"""
+    conn = db.connect()
+    try:
+        return PRIORITY_ADMIN if is_admin_user(conn.cursor(), user_id) else PRIORITY_USER
+    finally:
+        conn.close()
+
+class Ticket:
+    """An admitted transfer's slot; release it (or leave the with block) when the transfer ends"""
+
+    def __init__(self, controller, user_id):
+        self.controller = controller
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class _Waiter:
+    __slots__ = ('user_id', 'priority', 'seq', 'granted', 'wake', 'blocking')
+
+    def __init__(self, user_id, priority, seq, wake, blocking):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+        self.wake = wake
+        self.blocking = blocking
+
+class AdmissionController:
+    """Per-user and global concurrency limits with a bounded, prioritized queue"""
+
+    def __init__(self, max_active=QOS_MAX_TRANSFERS, max_per_user=QOS_MAX_TRANSFERS_PER_USER,
+                 max_queued=QOS_MAX_QUEUED, max_queued_per_user=QOS_MAX_QUEUED_PER_USER,
+                 max_waiting_threads=QOS_MAX_WAITING_THREADS,
+                 max_waiting_threads_per_user=QOS_MAX_WAITING_THREADS_PER_USER,
+                 queue_timeout=QOS_QUEUE_TIMEOUT_SECONDS):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_waiting_threads = max_waiting_threads
+        self.max_waiting_threads_per_user = max_waiting_threads_per_user
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self.active = 0
+        self.active_by_user = collections.Counter()
+        self.waiting = []
+        self.queued_by_user = collections.Counter()
+        self.waiting_threads = 0
+        self.waiting_threads_by_user = collections.Counter()
+        # Moving average of how long a slot is held, for Retry-After
+        self.average_hold = 1.0
+
+    def acquire(self, user_id, priority=PRIORITY_USER, timeout=None):
+        """
+        Wait for a transfer slot, blocking the calling thread
+
+        Args:
+            user_id: ID of the user the transfer is for
+            priority: Priority class (PRIORITY_ADMIN or PRIORITY_USER)
+            timeout: Seconds to wait at most (default: the controller's queue timeout)
+
+        Returns:
+            Ticket for the slot
+
+        Raises:
+            Overloaded: if the queue or the threads allowed to wait are used up,
+                or no slot freed up in time
+        """
+        event = threading.Event()
+        waiter = self._enqueue(user_id, priority, event.set, blocking=True)
+        if waiter is None:
+            return Ticket(self, user_id)
+        event.wait(self.queue_timeout if timeout is None else timeout)
+        return self._finish_wait(waiter)
+
+    async def acquire_async(self, user_id, priority=PRIORITY_USER, timeout=None):
+        """Wait for a transfer slot without blocking the event loop (see acquire)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(user_id, priority, wake)
+        if waiter is None:
+            return Ticket(self, user_id)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Client went away while waiting; hand back the slot if it was granted meanwhile
+            ticket = self._finish_wait(waiter, raise_overloaded=False)
+            if ticket:
+                ticket.release()
+            raise
+        return self._finish_wait(waiter)
+
+    def retry_after(self):
+        """Estimate in seconds when a rejected transfer is worth retrying"""
+        with self._lock:
+            return self._retry_after()
+
+    def status(self):
+        with self._lock:
+            return {
+                'active': self.active,
+                'queued': len(self.waiting),
+                'waiting_threads': self.waiting_threads,
+                'max_active': self.max_active,
+                'max_per_user': self.max_per_user,
+                'max_queued': self.max_queued,
+                'max_waiting_threads': self.max_waiting_threads,
+                'average_hold_seconds': round(self.average_hold, 3)
+            }
+
+    def _retry_after(self):
+        waves = (len(self.waiting) + 1) / max(1, self.max_active)
+        return max(1, min(60, math.ceil(self.average_hold * waves)))
+
+    def _has_room(self, user_id):
+        return self.active < self.max_active and self.active_by_user[user_id] < self.max_per_user
+
+    def _grant(self, user_id):
+        self.active += 1
+        self.active_by_user[user_id] += 1
+
+    def _enqueue(self, user_id, priority, wake, blocking=False):
+        """
+        Take a slot right away (returns None) or join the queue (returns the waiter)
+
+        Blocking waiters hold a worker thread while they wait and are capped separately.
+        """
+        with self._lock:
+            # Every waiter that could run has already been handed a slot, so this doesn't overtake anyone
+            if self._has_room(user_id):
+                self._grant(user_id)
+                return None
+            if len(self.waiting) >= self.max_queued:
+                reason = 'queue_full'
+            elif self.queued_by_user[user_id] >= self.max_queued_per_user:
+                reason = 'user_queue_full'
+            elif blocking and self.waiting_threads >= self.max_waiting_threads:
+                reason = 'threads_busy'
+            elif blocking and self.waiting_threads_by_user[user_id] >= self.max_waiting_threads_per_user:
+                reason = 'user_threads_busy'
+            else:
+                waiter = _Waiter(user_id, priority, next(self._seq), wake, blocking)
+                self.waiting.append(waiter)
+                self.queued_by_user[user_id] += 1
+                if blocking:
+                    self.waiting_threads += 1
+                    self.waiting_threads_by_user[user_id] += 1
+                TRANSFERS_QUEUED.inc()
+                return waiter
+            retry_after = self._retry_after()
+        TRANSFERS_REJECTED.inc(reason=reason)
+        raise Overloaded('Too many transfers in progress, try again later', retry_after)
+
+    def _finish_wait(self, waiter, raise_overloaded=True):
+        with self._lock:
+            if waiter.granted:
+                return Ticket(self, waiter.user_id)
+            self._dequeue(waiter)
+            retry_after = self._retry_after()
+        if not raise_overloaded:
+            return None
+        TRANSFERS_REJECTED.inc(reason='timeout')
+        raise Overloaded('Timed out waiting for a transfer slot, try again later', retry_after)
+
+    def _dequeue(self, waiter):
+        self.waiting.remove(waiter)
+        self.queued_by_user[waiter.user_id] -= 1
+        if not self.queued_by_user[waiter.user_id]:
+            del self.queued_by_user[waiter.user_id]
+        if waiter.blocking:
+            self.waiting_threads -= 1
+            self.waiting_threads_by_user[waiter.user_id] -= 1
+            if not self.waiting_threads_by_user[waiter.user_id]:
+                del self.waiting_threads_by_user[waiter.user_id]
+        TRANSFERS_QUEUED.dec()
+
+    def _release(self, ticket):
+        with self._lock:
+            self.active -= 1
+            self.active_by_user[ticket.user_id] -= 1
+            if not self.active_by_user[ticket.user_id]:
+                del self.active_by_user[ticket.user_id]
+            self.average_hold = 0.9 * self.average_hold + 0.1 * (time.monotonic() - ticket.started)
+            self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting transfers, best priority class first, then oldest"""
+        for waiter in sorted(self.waiting, key=lambda waiter: (waiter.priority, waiter.seq)):
+            if self.active >= self.max_active:
+                break
+            if self.active_by_user[waiter.user_id] < self.max_per_user:
+                self._dequeue(waiter)
+                self._grant(waiter.user_id)
+                waiter.granted = True
+                waiter.wake()
+
+class TokenBucket:
+    """Token bucket refilled at rate bytes per second, holding at most burst bytes"""
+
+    def __init__(self, rate, burst=QOS_BURST_BYTES):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """
+        Take tokens for nbytes, going into debt if there aren't enough
+
+        Returns:
+            float: Seconds to wait before sending the bytes
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def is_full(self):
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class BandwidthShaper:
+    """Paces transfer bytes with a bucket per user and one for the whole process"""
+
+    def __init__(self, user_rate=QOS_USER_BYTES_PER_SECOND, total_rate=QOS_TOTAL_BYTES_PER_SECOND):
+        self.user_rate = user_rate
+        self.total = TokenBucket(total_rate) if total_rate else None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.user_rate or self.total)
+
+    def _user_bucket(self, user_id):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) >= MAX_IDLE_BUCKETS:
+                    # A full bucket behaves like a new one, so it's safe to forget
+                    self._buckets = {key: value for key, value in self._buckets.items() if not value.is_full()}
+                bucket = self._buckets[user_id] = TokenBucket(self.user_rate)
+            return bucket
+
+    def delay(self, user_id, nbytes):
+        """Account for nbytes of a user's transfer and return the seconds to wait before sending them"""
+        delay = 0.0
+        if self.user_rate:
+            delay = self._user_bucket(user_id).reserve(nbytes)
+        if self.total:
+            delay = max(delay, self.total.reserve(nbytes))
+        if delay:
+            THROTTLE_SECONDS.inc(delay)
+        return delay
+
+    def throttle(self, user_id, nbytes):
+        """Block the calling thread until nbytes of a user's transfer may be sent"""
+        delay = self.delay(user_id, nbytes)
+        if delay:
+            time.sleep(delay)
+
+    def iter_shaped(self, chunks, user_id):
+        """Wrap a response body iterable so its chunks are paced"""
+        return _ShapedIterable(self, chunks, user_id)
+
+    def wrap_stream(self, stream, user_id):
+        """Wrap an input stream (e.g. wsgi.input) so reads from it are paced"""
+        return _ShapedStream(self, stream, user_id)
+
+class _ShapedIterable:
+    def __init__(self, shaper, chunks, user_id):
+        self.shaper = shaper
+        self.chunks = chunks
+        self.user_id = user_id
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.shaper.throttle(self.user_id, len(chunk))
+            yield chunk
+
+    def close(self):
+        # Let the wrapped body release its file or reader
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+class _ShapedStream:
+    def __init__(self, shaper, stream, user_id):
+        self.shaper = shaper
+        self.stream = stream
+        self.user_id = user_id
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.shaper.throttle(self.user_id, len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.shaper.throttle(self.user_id, len(data))
+        return data
+
+admission = AdmissionController()
+bandwidth = BandwidthShaper()
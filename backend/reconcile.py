@@ -0,0 +1,343 @@
+"""
+Reconciliation between node directories and metadata
+
+Blobs can leak onto nodes when an upload fails after replicating, when a
+delete can't remove a replica, or when a write is interrupted and leaves its
+temp file behind; failed-node directories (nodeN_failed) can also outlive the
+repair that replaced them. Replicas can also go missing from a node.
+
+For each node, the blob names the metadata expects there (file_locations and
+chunk_locations) are loaded into a set of 64-bit hashes, and the node
+directory is streamed with os.scandir and checked against it, so memory stays
+proportional to the number of replicas on one node rather than to the names
+themselves. Unreferenced blobs are orphans; expected blobs that weren't seen
+are missing. Orphans can optionally be deleted, within a byte budget and at a
+bounded rate.
+
+Blobs whose inode changed recently (ctime, which also moves on hard links and
+renames) are left alone, since they may belong to writes whose metadata isn't
+committed yet. Before anything is deleted, the expected names are loaded
+again so blobs recorded during the scan are kept.
+
+    python reconcile.py            # report only
+    python reconcile.py --reclaim  # also delete orphans
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import db
+import node_layout
+from job_status import JobLock, save_status, load_status
+from node_client import blob_name
+from config import (NODES_DIR, NODE_COUNT, RECONCILE_MIN_AGE_SECONDS, RECONCILE_MAX_RECLAIM_BYTES,
+                    RECONCILE_OPS_PER_SECOND, RECONCILE_MAX_REPORTED)
+
+_FAILED_DIR_RE = re.compile(r'^node(\d+)_failed$')
+
+# Orphans collected before the expected names are reloaded and they are deleted
+RECLAIM_BATCH = 1000
+
+def _key(name):
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def _iter_expected(cursor, node_id):
+    """Stream the blob names the metadata expects on a node"""
+    for query in ("SELECT file_path FROM file_locations WHERE node_id = ?",
+                  "SELECT file_path FROM chunk_locations WHERE node_id = ?"):
+        cursor.execute(query, (node_id,))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield blob_name(row[0])
+
+def expected_keys(node_id):
+    """Load the hashed blob names the metadata expects on a node"""
+    conn = db.connect()
+    try:
+        return {_key(name) for name in _iter_expected(conn.cursor(), node_id)}
+    finally:
+        conn.close()
+
+class Budget:
+    """Paces directory operations and caps the bytes a run may reclaim"""
+
+    def __init__(self, ops_per_second=RECONCILE_OPS_PER_SECOND, max_bytes=RECONCILE_MAX_RECLAIM_BYTES):
+        self.interval = 1.0 / ops_per_second if ops_per_second else 0
+        self.max_bytes = max_bytes
+        self.reclaimed_bytes = 0
+        self._next = time.monotonic()
+
+    def op(self):
+        """Wait until another operation is allowed"""
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+    def allows(self, size):
+        return self.reclaimed_bytes + size <= self.max_bytes
+
+def _new_report():
+    return {'scanned': 0, 'orphans': 0, 'orphan_bytes': 0, 'temp_files': 0, 'temp_bytes': 0,
+            'missing': 0, 'too_recent': 0, 'reclaimed': 0, 'reclaimed_bytes': 0,
+            'orphan_names': [], 'missing_names': []}
+
+def reconcile_node(node_id, reclaim=False, budget=None, min_age=RECONCILE_MIN_AGE_SECONDS, should_stop=None):
+    """
+    Compare one node directory against the metadata
+
+    Args:
+        node_id: ID of the node
+        reclaim: Delete orphans and abandoned temp files
+        budget: Budget shared by the whole run
+        min_age: Seconds since a blob's last inode change before it can count as an orphan
+        should_stop: Optional callable; the scan stops early when it returns True
+
+    Returns:
+        dict report for the node
+    """
+    budget = budget or Budget()
+    node_root = os.path.join(NODES_DIR, f"node{node_id}")
+    report = _new_report()
+    if not os.path.isdir(node_root):
+        report['error'] = 'node unavailable'
+        return report
+
+    expected = expected_keys(node_id)
+    seen = set()
+    candidates = []
+    cutoff = time.time() - min_age
+
+    def reclaim_candidates():
+        # Keep anything that got recorded while we were scanning
+        current = expected_keys(node_id)
+        for path, key, size in candidates:
+            if key is not None and key in current:
+                continue
+            if not budget.allows(size):
+                report['budget_exhausted'] = True
+                break
+            budget.op()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                report.setdefault('errors', []).append(f"{os.path.basename(path)}: {e}")
+                continue
+            budget.reclaimed_bytes += size
+            report['reclaimed'] += 1
+            report['reclaimed_bytes'] += size
+        candidates.clear()
+
+    for entry in node_layout.iter_blobs(node_root, include_temp=True):
+        if should_stop and should_stop():
+            report['stopped'] = True
+            break
+        budget.op()
+        report['scanned'] += 1
+
+        is_temp = entry.name.startswith('.')
+        key = None if is_temp else _key(entry.name)
+        if key is not None and key in expected:
+            seen.add(key)
+            continue
+
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        if stat.st_ctime > cutoff:
+            report['too_recent'] += 1
+            continue
+
+        if is_temp:
+            report['temp_files'] += 1
+            report['temp_bytes'] += stat.st_size
+        else:
+            report['orphans'] += 1
+            report['orphan_bytes'] += stat.st_size
+            if len(report['orphan_names']) < RECONCILE_MAX_REPORTED:
+                report['orphan_names'].append(entry.name)
+
+        if reclaim and not report.get('budget_exhausted'):
+            candidates.append((entry.path, key, stat.st_size))
+            # Reclaim in batches so memory stays bounded however many orphans there are
+            if len(candidates) >= RECLAIM_BATCH:
+                reclaim_candidates()
+
+    if candidates:
+        reclaim_candidates()
+
+    # Missing replicas: expected names that weren't on disk
+    if not report.get('stopped'):
+        conn = db.connect()
+        try:
+            for name in _iter_expected(conn.cursor(), node_id):
+                key = _key(name)
+                # Names recorded after the scan started may not have been looked for
+                if key in expected and key not in seen:
+                    report['missing'] += 1
+                    if len(report['missing_names']) < RECONCILE_MAX_REPORTED:
+                        report['missing_names'].append(name)
+        finally:
+            conn.close()
+
+    return report
+
+def failed_node_dirs():
+    """
+    List leftover failed-node directories
+
+    Returns:
+        List of dicts with 'node_id', 'path', 'files', 'bytes' and whether the node itself exists again
+    """
+    leftovers = []
+    if not os.path.isdir(NODES_DIR):
+        return leftovers
+    with os.scandir(NODES_DIR) as entries:
+        for entry in entries:
+            match = _FAILED_DIR_RE.match(entry.name)
+            if not match or not entry.is_dir(follow_symlinks=False):
+                continue
+            node_id = int(match.group(1))
+            files = size = 0
+            for dirpath, _, filenames in os.walk(entry.path):
+                for filename in filenames:
+                    try:
+                        size += os.lstat(os.path.join(dirpath, filename)).st_size
+                        files += 1
+                    except OSError:
+                        pass
+            leftovers.append({
+                'node_id': node_id,
+                'path': entry.path,
+                'files': files,
+                'bytes': size,
+                'node_restored': os.path.isdir(os.path.join(NODES_DIR, f"node{node_id}"))
+            })
+    return leftovers
+
+def reconcile(reclaim=False, reclaim_failed=False, node_ids=None, min_age=RECONCILE_MIN_AGE_SECONDS,
+              budget=None, should_stop=None):
+    """
+    Reconcile every node and look for leftover failed-node directories
+
+    Args:
+        reclaim: Delete orphans and abandoned temp files
+        reclaim_failed: Delete failed-node directories whose node has been repaired
+                        (counted against the same byte budget)
+        node_ids: Nodes to check (default: all)
+        min_age: Seconds since a blob's last inode change before it can count as an orphan
+        budget: Budget for the run (default: from config)
+        should_stop: Optional callable; the run stops early when it returns True
+
+    Returns:
+        dict with a report per node and the failed-node directories found
+    """
+    budget = budget or Budget()
+    started = time.time()
+    nodes = {}
+    for node_id in node_ids or range(1, NODE_COUNT + 1):
+        if should_stop and should_stop():
+            break
+        nodes[node_id] = reconcile_node(node_id, reclaim, budget, min_age, should_stop)
+
+    failed = failed_node_dirs()
+    for leftover in failed:
+        # Only drop a failed directory once its node has been brought back
+        if reclaim_failed and leftover['node_restored'] and budget.allows(leftover['bytes']):
+            shutil.rmtree(leftover['path'], ignore_errors=True)
+            budget.reclaimed_bytes += leftover['bytes']
+            leftover['reclaimed'] = True
+
+    return {
+        'started_at': started,
+        'duration_seconds': round(time.time() - started, 3),
+        'reclaimed_bytes': budget.reclaimed_bytes,
+        'nodes': nodes,
+        'failed_node_dirs': failed
+    }
+
+class Reconciler:
+    """Runs reconcile on a background thread, one run at a time across worker processes"""
+
+    name = 'reconcile'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._job_lock = JobLock(self.name)
+
+    @property
+    def status(self):
+        """State and report of the last run, whichever worker ran it"""
+        return load_status(self.name, {'state': 'idle', 'report': None}, self._job_lock)
+
+    def start(self, **options):
+        """
+        Start a reconciliation run in the background
+
+        Returns:
+            bool: False if a run is already in progress
+        """
+        with self._lock:
+            if not self._job_lock.acquire():
+                return False
+            self._stop.clear()
+            try:
+                save_status(self.name, {'state': 'running', 'options': options, 'report': None})
+            except Exception:
+                self._job_lock.release()
+                raise
+            self._thread = threading.Thread(target=self._run, kwargs=options, daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, **options):
+        status = {'state': 'running', 'options': options, 'report': None}
+        try:
+            status['report'] = reconcile(should_stop=self._stop.is_set, **options)
+            status['state'] = 'stopped' if self._stop.is_set() else 'finished'
+        except Exception as e:
+            status['state'] = 'failed'
+            status['error'] = str(e)
+        try:
+            save_status(self.name, status)
+        finally:
+            self._job_lock.release()
+
+reconciler = Reconciler()
+
+def main():
+    parser = argparse.ArgumentParser(description='Find (and optionally reclaim) orphaned and missing replicas')
+    parser.add_argument('--reclaim', action='store_true', help='Delete orphans and abandoned temp files')
+    parser.add_argument('--reclaim-failed', action='store_true',
+                        help='Delete nodeN_failed directories whose node has been repaired')
+    parser.add_argument('--node', type=int, action='append', help='Only check this node (repeatable)')
+    parser.add_argument('--min-age', type=int, default=RECONCILE_MIN_AGE_SECONDS,
+                        help=f'Seconds before an unreferenced blob counts as an orphan (default: {RECONCILE_MIN_AGE_SECONDS})')
+    parser.add_argument('--max-bytes', type=int, default=RECONCILE_MAX_RECLAIM_BYTES, help='Bytes to reclaim at most')
+    parser.add_argument('--ops-per-second', type=int, default=RECONCILE_OPS_PER_SECOND,
+                        help='Directory entries examined per second (0 = unlimited)')
+    args = parser.parse_args()
+
+    report = reconcile(args.reclaim, args.reclaim_failed, args.node, args.min_age,
+                       Budget(args.ops_per_second, args.max_bytes))
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Per-file and per-user replica counts, plus adaptive read replicas
+
+A file's base replica count is its own replication_factor, else its owner's,
+else REPLICATION_FACTOR. On top of that, files whose decayed download count
+(file_access_stats.recent_count) crosses ADAPTIVE_REPLICA_THRESHOLD get extra
+replicas on the nodes currently serving the fewest downloads. Extra replicas
+are marked in file_locations.extra and are retired again once demand falls.
+"""
+import os
+import sqlite3
+import db
+from cache import metadata_cache, invalidate_file
+from metadata_writer import writer
+from conditional import bump, bump_file_owners, user_scope
+from node_client import get_node_client, blob_name
+import node_layout
+from file_utils import prefer_fast_nodes
+from config import (NODES_DIR, NODE_COUNT, REPLICATION_FACTOR, ADAPTIVE_REPLICATION, ADAPTIVE_REPLICA_THRESHOLD,
+                    ADAPTIVE_RETIRE_FRACTION, ADAPTIVE_MAX_EXTRA_REPLICAS, REPLICATION_MAX_CHANGES_PER_RUN)
+
+def add_replica(file_id, locations, target_node_id, extra=False):
+    """
+    Copy a file onto another node and record the new replica
+
+    Args:
+        file_id: ID of the file
+        locations: Current locations of the file
+        target_node_id: Node to add the replica on
+        extra: Mark the replica as an extra read replica
+
+    Returns:
+        bool: True if the replica was added (False if the file was deleted meanwhile)
+    """
+    client = get_node_client()
+    name = blob_name(locations[0]['file_path'])
+
+    # Copy from the first replica that works
+    for source in prefer_fast_nodes(locations):
+        try:
+            client.copy(source['node_id'], target_node_id, name)
+            break
+        except Exception:
+            continue
+    else:
+        raise Exception("Could not copy file from any node")
+
+    new_path = node_layout.blob_path(os.path.join(NODES_DIR, f"node{target_node_id}"), name)
+
+    def write(cursor):
+        cursor.execute("""
+            INSERT INTO file_locations (file_id, node_id, file_path, size, extra)
+            SELECT id, ?, ?, size, ? FROM files WHERE id = ?
+        """, (target_node_id, new_path, 1 if extra else 0, file_id))
+        if cursor.rowcount != 1:
+            return False
+        bump_file_owners(cursor, [file_id])
+        return True
+
+    if not writer.execute(write):
+        client.delete(target_node_id, name)
+        return False
+
+    invalidate_file(file_id)
+    return True
+
+def remove_replica(file_id, location):
+    """
+    Drop one replica of a file, never the last one
+
+    Returns:
+        bool: True if the replica was removed
+    """
+    def write(cursor):
+        cursor.execute("""
+            DELETE FROM file_locations
+            WHERE id = ? AND (SELECT COUNT(*) FROM file_locations WHERE file_id = ?) > 1
+        """, (location['id'], file_id))
+        if cursor.rowcount != 1:
+            return False
+        bump_file_owners(cursor, [file_id])
+        return True
+
+    if not writer.execute(write):
+        return False
+
+    invalidate_file(file_id)
+    try:
+        get_node_client().delete(location['node_id'], blob_name(location['file_path']))
+    except Exception:
+        # Leaves an orphan on the node, which reconciliation can reclaim
+        pass
+    return True
+
+def _read_load(cursor):
+    """Decayed downloads served per node, sharing each file's count among its replicas"""
+    cursor.execute("""
+        SELECT l.node_id, SUM(s.recent_count / n.replicas)
+        FROM file_locations l
+        JOIN file_access_stats s ON s.file_id = l.file_id
+        JOIN (SELECT file_id, COUNT(*) AS replicas FROM file_locations GROUP BY file_id) n ON n.file_id = l.file_id
+        GROUP BY l.node_id
+    """)
+    load = {node_id: 0.0 for node_id in range(1, NODE_COUNT + 1)}
+    load.update({row[0]: row[1] or 0.0 for row in cursor.fetchall()})
+    return load
+
+def _locations(cursor, file_id):
+    cursor.execute("SELECT id, node_id, file_path, size, extra FROM file_locations WHERE file_id = ?", (file_id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+def _effective_factor(cursor, file_id):
+    cursor.execute("""
+        SELECT COALESCE(f.replication_factor, u.replication_factor, ?)
+        FROM files f
+        JOIN users u ON u.id = f.user_id
+        WHERE f.id = ?
+    """, (REPLICATION_FACTOR, file_id))
+    row = cursor.fetchone()
+    return min(row[0], NODE_COUNT) if row else None
+
+def effective_replication_factor(file_id):
+    """Get how many replicas a file should have under its policy, or None if it doesn't exist"""
+    conn = db.connect()
+    try:
+        return _effective_factor(conn.cursor(), file_id)
+    finally:
+        conn.close()
+
+def _sync_base_replicas(cursor, file_id, load):
+    """
+    Add or remove base replicas of one file until they match its effective factor
+
+    Returns:
+        Tuple of (replicas added, replicas removed)
+    """
+    factor = _effective_factor(cursor, file_id)
+    locations = _locations(cursor, file_id)
+    if factor is None or not locations:
+        return 0, 0
+
+    added = removed = 0
+    base = [location for location in locations if not location['extra']]
+    extras = [location for location in locations if location['extra']]
+
+    while len(base) < factor:
+        if extras:
+            # An extra replica is already there; make it permanent
+            location = extras.pop()
+            def write(cursor):
+                cursor.execute("UPDATE file_locations SET extra = 0 WHERE id = ?", (location['id'],))
+                bump_file_owners(cursor, [file_id])
+            writer.execute(write)
+            invalidate_file(file_id)
+            base.append(location)
+            continue
+
+        holding = {location['node_id'] for location in locations}
+        options = [node_id for node_id in range(1, NODE_COUNT + 1) if node_id not in holding]
+        if not options:
+            break
+        target = min(options, key=lambda node_id: load[node_id])
+        if not add_replica(file_id, locations, target):
+            break
+        added += 1
+        locations = _locations(cursor, file_id)
+        base = [location for location in locations if not location['extra']]
+
+    while len(base) > max(1, factor):
+        # Drop the replica on the busiest node
+        location = max(base, key=lambda location: load[location['node_id']])
+        if not remove_replica(file_id, location):
+            break
+        removed += 1
+        base.remove(location)
+
+    return added, removed
+
+def apply_replication_factor(file_id):
+    """
+    Bring one file's replicas in line with its replication policy right away
+
+    Returns:
+        dict with the number of replicas added and removed
+    """
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        added, removed = _sync_base_replicas(cursor, file_id, _read_load(cursor))
+    finally:
+        conn.close()
+    return {'added': added, 'removed': removed}
+
+def adjust_replicas(max_changes=REPLICATION_MAX_CHANGES_PER_RUN):
+    """
+    Apply replication policies to existing files and add or retire extra read replicas
+
+    Returns:
+        dict with the number of base and extra replicas added and removed, and errors
+    """
+    result = {'added': 0, 'removed': 0, 'extra_added': 0, 'extra_removed': 0, 'errors': 0}
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    load = _read_load(cursor)
+    changes = 0
+
+    # Files whose base replica count doesn't match their policy (e.g. after a user's policy changed)
+    cursor.execute("""
+        SELECT f.id
+        FROM files f
+        JOIN users u ON u.id = f.user_id
+        JOIN (SELECT file_id, SUM(extra = 0) AS base FROM file_locations GROUP BY file_id) l ON l.file_id = f.id
+        WHERE l.base != MIN(COALESCE(f.replication_factor, u.replication_factor, ?), ?)
+        LIMIT ?
+    """, (REPLICATION_FACTOR, NODE_COUNT, max_changes))
+    for file_id in [row['id'] for row in cursor.fetchall()]:
+        if changes >= max_changes:
+            break
+        try:
+            added, removed = _sync_base_replicas(cursor, file_id, load)
+            result['added'] += added
+            result['removed'] += removed
+            changes += added + removed
+        except Exception:
+            result['errors'] += 1
+
+    if ADAPTIVE_REPLICATION:
+        # Hot files, and files holding extra replicas that may no longer be needed
+        cursor.execute("""
+            SELECT s.file_id, s.recent_count, SUM(l.extra) AS extras
+            FROM file_access_stats s
+            JOIN file_locations l ON l.file_id = s.file_id
+            GROUP BY s.file_id
+            HAVING s.recent_count >= ? OR SUM(l.extra) > 0
+            ORDER BY s.recent_count DESC
+        """, (ADAPTIVE_REPLICA_THRESHOLD,))
+        candidates = [dict(row) for row in cursor.fetchall()]
+
+        for candidate in candidates:
+            if changes >= max_changes:
+                break
+            file_id, demand, extras = candidate['file_id'], candidate['recent_count'], candidate['extras']
+            wanted = min(ADAPTIVE_MAX_EXTRA_REPLICAS, int(demand // ADAPTIVE_REPLICA_THRESHOLD))
+            # Only retire once demand is well below what earned the replica, so counts don't flap
+            keep = min(ADAPTIVE_MAX_EXTRA_REPLICAS, int(demand // (ADAPTIVE_REPLICA_THRESHOLD * ADAPTIVE_RETIRE_FRACTION)))
+
+            try:
+                locations = _locations(cursor, file_id)
+                if extras < wanted:
+                    holding = {location['node_id'] for location in locations}
+                    options = [node_id for node_id in range(1, NODE_COUNT + 1) if node_id not in holding]
+                    if not options:
+                        continue
+                    target = min(options, key=lambda node_id: load[node_id])
+                    if add_replica(file_id, locations, target, extra=True):
+                        load[target] += demand / (len(locations) + 1)
+                        result['extra_added'] += 1
+                        changes += 1
+                elif extras > keep:
+                    extra_locations = [location for location in locations if location['extra']]
+                    location = max(extra_locations, key=lambda location: load[location['node_id']])
+                    if remove_replica(file_id, location):
+                        result['extra_removed'] += 1
+                        changes += 1
+            except Exception:
+                result['errors'] += 1
+
+    conn.close()
+    return result
+
+def set_file_replication_factor(file_id, replication_factor):
+    """Set (or with None, clear) a file's replication policy"""
+    def write(cursor):
+        cursor.execute("UPDATE files SET replication_factor = ? WHERE id = ?", (replication_factor, file_id))
+        bump_file_owners(cursor, [file_id])
+    writer.execute(write)
+    invalidate_file(file_id)
+
+def set_user_replication_factor(user_id, replication_factor):
+    """Set (or with None, clear) the default replication policy of a user's files"""
+    def write(cursor):
+        cursor.execute("UPDATE users SET replication_factor = ? WHERE id = ?", (replication_factor, user_id))
+        # Tells other worker processes their cached policy is stale
+        bump(cursor, user_scope(user_id))
+    writer.execute(write)
+    metadata_cache.invalidate(('replication', user_id))
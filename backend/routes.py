@@ -1,17 +1,115 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response, make_response
+from functools import wraps, partial
+import datetime
+import io
 import os
 import sqlite3
+import db
 import uuid
 import werkzeug
 from auth import token_required, admin_required, get_jwt_identity
-from file_utils import store_file_with_replication, retrieve_file, simulate_node_failure, restore_node, repair_node as repair_node_files
-from config import DATABASE_PATH, MAX_FILE_SIZE, NODE_COUNT, NODES_DIR
+from file_utils import store_file_with_replication, hash_file, retrieve_file, stream_zip, delete_replicas, simulate_node_failure, restore_node, repair_node as repair_node_files
+from config import (DATABASE_PATH, MAX_FILE_SIZE, NODE_COUNT, NODES_DIR, NODE_BACKEND,
+                    BATCH_MAX_ITEMS, BATCH_IO_WORKERS)
+from cache import file_cache, metadata_cache, cache_stats
+from metadata import (is_admin_user, get_file_record, get_file_locations, get_user_replication_factor, record_file,
+                      record_files, delete_file_records)
 import tempfile
+import node_layout
+from node_layout import migrator as layout_migrator
+from metrics import TRANSFERS_IN_FLIGHT
+from profiling import profiler
+from access_stats import access_stats
+from tiering import tiering_job
+from replication import (apply_replication_factor, effective_replication_factor, set_file_replication_factor,
+                         set_user_replication_factor)
+from versions import add_version, list_versions, open_version
+from chunking import MAX_VERSION_SIZE
+from reconcile import reconciler
+from qos import admission, bandwidth, user_priority, Overloaded
+from conditional import (get_counter, make_etag, file_etag, parse_timestamp, is_not_modified, user_scope,
+                         GLOBAL_SCOPE)
+from concurrent.futures import ThreadPoolExecutor
 
 file_bp = Blueprint('file', __name__)
 
+def call_when_sent(response, callback):
+    """Run a callback once a response has been sent (or the client went away), whatever its body"""
+    # The server hands send_file bodies straight to wsgi.file_wrapper and never
+    # closes the response itself, so call_on_close wouldn't run for downloads
+    response.direct_passthrough = False
+    response.call_on_close(callback)
+    return response
+
+def track_transfer(direction):
+    """Decorator counting a route as an in-flight transfer until its response is closed"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            TRANSFERS_IN_FLIGHT.inc(direction=direction)
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                TRANSFERS_IN_FLIGHT.dec(direction=direction)
+                raise
+            # Downloads keep streaming after the view returns
+            return call_when_sent(response, partial(TRANSFERS_IN_FLIGHT.dec, direction=direction))
+        return decorated
+    return decorator
+
+def not_modified(etag, last_modified=None):
+    """
+    Get a 304 response if the client's copy matches, else None
+
+    Only pass last_modified for bodies that never change once written. HTTP
+    dates have one-second resolution, so a listing changed twice within a
+    second would look unmodified to If-Modified-Since; listings are
+    revalidated by ETag alone.
+    """
+    if is_not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'),
+                       etag, last_modified):
+        return with_validators(Response(status=304), etag, last_modified)
+    return None
+
+def with_validators(response, etag, last_modified=None):
+    """Tag a response with its ETag and Last-Modified time, and have clients revalidate before reuse"""
+    response = make_response(response)
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def admission_control(f):
+    """Decorator admitting a transfer through QoS admission control and pacing its bytes until the response is closed"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user_id = get_jwt_identity()
+        try:
+            ticket = admission.acquire(user_id, user_priority(user_id))
+        except Overloaded as e:
+            response = jsonify({'message': str(e)})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+        
+        if bandwidth.enabled:
+            # Nothing has read the body yet, so uploads are paced as they are parsed
+            request.environ['wsgi.input'] = bandwidth.wrap_stream(request.environ['wsgi.input'], user_id)
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            ticket.release()
+            raise
+        if bandwidth.enabled and response.is_streamed:
+            response.response = bandwidth.iter_shaped(response.response, user_id)
+        # Downloads keep the slot until they finish streaming
+        return call_when_sent(response, ticket.release)
+    return decorated
+
 @file_bp.route('/upload', methods=['POST'])
 @token_required
+@admission_control
+@track_transfer('upload')
 def upload_file():
     """Upload a file to the distributed storage system"""
     user_id = get_jwt_identity()
@@ -46,28 +144,11 @@ def upload_file():
     
     try:
         # Store the file with replication
-        storage_info = store_file_with_replication(temp_path, unique_filename, user_id)
+        storage_info = store_file_with_replication(temp_path, unique_filename, user_id,
+                                                   get_user_replication_factor(user_id))
         
         # Store file metadata in database
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Insert file record
-        cursor.execute(
-            "INSERT INTO files (filename, original_filename, user_id, size) VALUES (?, ?, ?, ?)",
-            (unique_filename, orig_filename, user_id, file_size)
-        )
-        file_id = cursor.lastrowid
-        
-        # Insert file location records
-        for location in storage_info:
-            cursor.execute(
-                "INSERT INTO file_locations (file_id, node_id, file_path, size) VALUES (?, ?, ?, ?)",
-                (file_id, location['node_id'], location['file_path'], location['size'])
-            )
-        
-        conn.commit()
-        conn.close()
+        file_id = record_file(unique_filename, orig_filename, user_id, file_size, storage_info, hash_file(temp_path))
         
         return jsonify({
             'message': 'File uploaded successfully',
@@ -82,13 +163,101 @@ def upload_file():
         if os.path.exists(temp_path):
             os.remove(temp_path)
 
+@file_bp.route('/upload/batch', methods=['POST'])
+@token_required
+@admission_control
+@track_transfer('upload')
+def upload_batch():
+    """Upload many files in one request, recording their metadata in a single transaction"""
+    user_id = get_jwt_identity()
+    
+    uploads = request.files.getlist('files') + request.files.getlist('file')
+    if not uploads:
+        return jsonify({'message': 'No file part in the request'}), 400
+    if len(uploads) > BATCH_MAX_ITEMS:
+        return jsonify({'message': f'Too many files. Maximum per batch: {BATCH_MAX_ITEMS}'}), 400
+    
+    results = []
+    pending = []
+    
+    # Validate and stage every part
+    for index, file in enumerate(uploads):
+        result = {'index': index, 'filename': file.filename}
+        results.append(result)
+        
+        if file.filename == '':
+            result.update(status='error', message='No file selected')
+            continue
+        
+        file.seek(0, os.SEEK_END)
+        file_size = file.tell()
+        file.seek(0)
+        
+        if file_size > MAX_FILE_SIZE:
+            result.update(status='error', message=f'File too large. Maximum size: {MAX_FILE_SIZE/1024/1024:.2f} MB')
+            continue
+        
+        orig_filename = werkzeug.utils.secure_filename(file.filename)
+        unique_filename = f"{uuid.uuid4()}_{orig_filename}"
+        temp_path = os.path.join(tempfile.gettempdir(), unique_filename)
+        file.save(temp_path)
+        
+        pending.append({
+            'result': result,
+            'temp_path': temp_path,
+            'filename': unique_filename,
+            'original_filename': orig_filename,
+            'user_id': user_id,
+            'size': file_size,
+            'content_hash': hash_file(temp_path)
+        })
+    
+    try:
+        # Replicate all files concurrently
+        replication_factor = get_user_replication_factor(user_id)
+        with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+            futures = [executor.submit(store_file_with_replication, item['temp_path'], item['filename'], user_id,
+                                       replication_factor)
+                       for item in pending]
+            stored = []
+            for item, future in zip(pending, futures):
+                try:
+                    item['storage_info'] = future.result()
+                    stored.append(item)
+                except Exception as e:
+                    item['result'].update(status='error', message=f'Error uploading file: {str(e)}')
+        
+        # Record every stored file in one transaction
+        try:
+            file_ids = record_files(stored)
+        except Exception as e:
+            # Don't leave replicas behind for files that have no metadata
+            for item in stored:
+                delete_replicas(item['storage_info'])
+                item['result'].update(status='error', message=f'Error uploading file: {str(e)}')
+            file_ids = []
+        
+        for item, file_id in zip(stored, file_ids):
+            item['result'].update(status='uploaded', file_id=file_id, replicas=len(item['storage_info']))
+    finally:
+        # Clean up temporary files
+        for item in pending:
+            if os.path.exists(item['temp_path']):
+                os.remove(item['temp_path'])
+    
+    uploaded = sum(1 for result in results if result['status'] == 'uploaded')
+    return jsonify({
+        'message': f'{uploaded} of {len(results)} files uploaded',
+        'results': results
+    }), 201 if uploaded else 400
+
 @file_bp.route('/files', methods=['GET'])
 @token_required
 def get_files():
     """Get list of files for current user or all files for admin"""
     user_id = get_jwt_identity()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -97,8 +266,17 @@ def get_files():
     user = cursor.fetchone()
     is_admin = user and user['role'] == 'admin'
     
+    # Answer polls from the change counter before running the listing queries
+    list_all = bool(is_admin and request.args.get('all') == 'true')
+    counter, _ = get_counter(GLOBAL_SCOPE if list_all else user_scope(user_id))
+    etag = make_etag('files', user_id, 'all' if list_all else 'own', counter)
+    response = not_modified(etag)
+    if response:
+        conn.close()
+        return response
+    
     # Get files based on role
-    if is_admin and request.args.get('all') == 'true':
+    if list_all:
         cursor.execute("""
             SELECT f.*, u.username 
             FROM files f
@@ -126,7 +304,7 @@ def get_files():
     
     conn.close()
     
-    return jsonify(files)
+    return with_validators(jsonify(files), etag)
 
 @file_bp.route('/files/<int:file_id>', methods=['GET'])
 @token_required
@@ -134,7 +312,7 @@ def get_file_info(file_id):
     """Get detailed information about a specific file"""
     user_id = get_jwt_identity()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -144,13 +322,7 @@ def get_file_info(file_id):
     is_admin = user and user['role'] == 'admin'
     
     # Get file info
-    cursor.execute("""
-        SELECT f.*, u.username 
-        FROM files f
-        JOIN users u ON f.user_id = u.id
-        WHERE f.id = ?
-    """, (file_id,))
-    file = cursor.fetchone()
+    file = get_file_record(cursor, file_id)
     
     if not file:
         conn.close()
@@ -161,28 +333,140 @@ def get_file_info(file_id):
         conn.close()
         return jsonify({'message': 'Access denied'}), 403
     
+    # Replica changes bump the owner's counter too
+    counter, _ = get_counter(user_scope(file['user_id']))
+    etag = make_etag('file', file_id, counter)
+    response = not_modified(etag)
+    if response:
+        conn.close()
+        return response
+    
     # Get location info
-    cursor.execute("""
-        SELECT id, node_id, file_path, size
-        FROM file_locations
-        WHERE file_id = ?
-    """, (file_id,))
-    locations = [dict(row) for row in cursor.fetchall()]
+    locations = get_file_locations(cursor, file_id)
     
     file_info = dict(file)
     file_info['locations'] = locations
     
     conn.close()
     
-    return jsonify(file_info)
+    return with_validators(jsonify(file_info), etag)
+
+def stream_reader(reader, filename, chunk_size=64 * 1024):
+    """Build a download response that streams a reader with a known size"""
+    def generate():
+        with reader:
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    
+    response = Response(generate(), mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str(reader.size)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    return response
+
+@file_bp.route('/files/<int:file_id>/versions', methods=['POST'])
+@token_required
+@admission_control
+@track_transfer('upload')
+def upload_version(file_id):
+    """Upload a new version of a file, storing only the chunks that changed"""
+    user_id = get_jwt_identity()
+    
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    file = get_file_record(cursor, file_id)
+    is_admin = is_admin_user(cursor, user_id)
+    conn.close()
+    
+    if not file:
+        return jsonify({'message': 'File not found'}), 404
+    
+    # Check if user has permission to change this file
+    if not is_admin and file['user_id'] != user_id:
+        return jsonify({'message': 'Access denied'}), 403
+    
+    if 'file' not in request.files:
+        return jsonify({'message': 'No file part in the request'}), 400
+    
+    upload = request.files['file']
+    upload.seek(0, os.SEEK_END)
+    file_size = upload.tell()
+    upload.seek(0)
+    
+    # Versions are chunked on this thread, so the limit depends on how fast that is
+    max_size = min(MAX_FILE_SIZE, MAX_VERSION_SIZE)
+    if file_size > max_size:
+        return jsonify({
+            'message': f'File too large. Maximum size: {max_size/1024/1024:.2f} MB'
+        }), 400
+    if file['current_version'] is None and file['size'] > max_size:
+        # Its current content would be chunked into version 1 too
+        return jsonify({
+            'message': f'File too large to version. Maximum size: {max_size/1024/1024:.2f} MB'
+        }), 400
+    
+    temp_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}_version")
+    upload.save(temp_path)
+    
+    try:
+        # New chunks follow the file's own policy, then its owner's
+        result = add_version(file_id, temp_path, effective_replication_factor(file_id))
+        return jsonify({
+            'message': 'Version uploaded successfully',
+            'file_id': file_id,
+            'version': result['version'],
+            'size': result['size'],
+            'stored_bytes': result['stored_bytes']
+        }), 201
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found'}), 404
+    except Exception as e:
+        return jsonify({'message': f'Error uploading version: {str(e)}'}), 500
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@file_bp.route('/files/<int:file_id>/versions', methods=['GET'])
+@token_required
+def get_versions(file_id):
+    """List the versions of a file"""
+    user_id = get_jwt_identity()
+    
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    file = get_file_record(cursor, file_id)
+    
+    if not file:
+        conn.close()
+        return jsonify({'message': 'File not found'}), 404
+    
+    # Check if user has permission to access this file
+    if not is_admin_user(cursor, user_id) and file['user_id'] != user_id:
+        conn.close()
+        return jsonify({'message': 'Access denied'}), 403
+    
+    versions = list_versions(cursor, file)
+    conn.close()
+    
+    return jsonify({
+        'file_id': file_id,
+        'current_version': file['current_version'] or 1,
+        'versions': versions
+    })
 
 @file_bp.route('/download/<int:file_id>', methods=['GET'])
 @token_required
+@admission_control
+@track_transfer('download')
 def download_file(file_id):
     """Download a file by retrieving it from any available node"""
     user_id = get_jwt_identity()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -192,8 +476,7 @@ def download_file(file_id):
     is_admin = user and user['role'] == 'admin'
     
     # Get file info
-    cursor.execute("SELECT * FROM files WHERE id = ?", (file_id,))
-    file = cursor.fetchone()
+    file = get_file_record(cursor, file_id)
     
     if not file:
         conn.close()
@@ -204,35 +487,200 @@ def download_file(file_id):
         conn.close()
         return jsonify({'message': 'Access denied'}), 403
     
+    version = request.args.get('version')
+    if version is not None and not (version.isascii() and version.isdigit()):
+        conn.close()
+        return jsonify({'message': 'Invalid version'}), 400
+    version = int(version) if version is not None else None
+    
+    # Content never changes under an ETag, so a client holding it needs no replica read
+    etag = file_etag(cursor, file, version)
+    if etag is None:
+        conn.close()
+        return jsonify({'message': 'Version not found'}), 404
+    last_modified = parse_timestamp(file['upload_date']) if file['current_version'] is None else None
+    response = not_modified(etag, last_modified)
+    if response:
+        conn.close()
+        return response
+    
+    # Count the download for storage tiering
+    access_stats.record(file_id)
+    
+    # Versioned files (and older versions) are reassembled from their chunks
+    if file['current_version'] is not None:
+        conn.close()
+        try:
+            reader = open_version(file_id, version)
+        except Exception as e:
+            return jsonify({'message': f'Error retrieving file: {str(e)}'}), 500
+        if reader is None:
+            return jsonify({'message': 'Version not found'}), 404
+        return with_validators(stream_reader(reader, file['original_filename']), etag)
+    
+    # Serve hot files straight from memory
+    body = file_cache.get(file_id)
+    if body is not None:
+        conn.close()
+        return with_validators(send_file(
+            io.BytesIO(body),
+            as_attachment=True,
+            download_name=file['original_filename'],
+            mimetype='application/octet-stream',
+            etag=etag.strip('"'),
+            last_modified=last_modified
+        ), etag, last_modified)
+    
     # Get file locations
-    cursor.execute("""
-        SELECT node_id, file_path, size
-        FROM file_locations
-        WHERE file_id = ?
-    """, (file_id,))
-    locations = [dict(row) for row in cursor.fetchall()]
+    locations = get_file_locations(cursor, file_id)
     
     conn.close()
     
     if not locations:
         return jsonify({'message': 'File has no storage locations'}), 404
     
-    # Prepare temp file for download
-    temp_dir = tempfile.gettempdir()
-    output_path = os.path.join(temp_dir, file['original_filename'])
+    # Stage the file under a private name; it is removed once the response is sent
+    fd, output_path = tempfile.mkstemp(prefix='dfss_download_')
+    os.close(fd)
     
     try:
         # Retrieve the file from any available node
         retrieve_file(locations, output_path)
         
-        return send_file(
+        # Keep small, hot files in memory for the next download
+        if file_cache.admits(file_id, file['size']):
+            with open(output_path, 'rb') as f:
+                file_cache.put(file_id, f.read())
+        
+        # send_file also answers Range requests against the same validators
+        response = with_validators(send_file(
             output_path,
             as_attachment=True,
             download_name=file['original_filename'],
-            mimetype='application/octet-stream'
-        )
+            mimetype='application/octet-stream',
+            etag=etag.strip('"'),
+            last_modified=last_modified
+        ), etag, last_modified)
     except Exception as e:
+        os.remove(output_path)
         return jsonify({'message': f'Error retrieving file: {str(e)}'}), 500
+    return call_when_sent(response, partial(os.remove, output_path))
+
+@file_bp.route('/download/zip', methods=['GET', 'POST'])
+@token_required
+@admission_control
+@track_transfer('download')
+def download_zip():
+    """Download many files as one ZIP archive streamed on the fly
+    
+    Files are selected by `file_ids` (JSON body, or comma-separated `ids`
+    query parameter) or by a filter: `name` (substring of the original
+    filename) and, for admins, `all`.
+    """
+    user_id = get_jwt_identity()
+    params = (request.get_json(silent=True) if request.method == 'POST' else None) or {}
+    
+    file_ids = params.get('file_ids')
+    if file_ids is None and request.args.get('ids'):
+        try:
+            file_ids = [int(i) for i in request.args['ids'].split(',') if i]
+        except ValueError:
+            return jsonify({'message': 'Invalid file ID list'}), 400
+    name_filter = params.get('name', request.args.get('name'))
+    all_files = params.get('all', request.args.get('all') == 'true')
+    compress = params.get('compress', request.args.get('compress') == 'true')
+    
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    
+    # Check if user is admin
+    cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
+    user = cursor.fetchone()
+    is_admin = user and user['role'] == 'admin'
+    
+    # Select the files in one query
+    if file_ids is not None:
+        if not isinstance(file_ids, list) or not all(isinstance(i, int) for i in file_ids):
+            conn.close()
+            return jsonify({'message': 'file_ids must be a list of integers'}), 400
+        file_ids = list(dict.fromkeys(file_ids))
+        if not file_ids:
+            conn.close()
+            return jsonify({'message': 'No files selected'}), 400
+        placeholders = ','.join('?' * len(file_ids))
+        cursor.execute(f"SELECT * FROM files WHERE id IN ({placeholders})", file_ids)
+        files = {row['id']: dict(row) for row in cursor.fetchall()}
+        
+        missing = [i for i in file_ids if i not in files]
+        if missing:
+            conn.close()
+            return jsonify({'message': 'File not found', 'file_ids': missing}), 404
+        
+        # Check if user has permission to access every file
+        if not is_admin and any(f['user_id'] != user_id for f in files.values()):
+            conn.close()
+            return jsonify({'message': 'Access denied'}), 403
+        files = [files[i] for i in file_ids]
+    else:
+        query = "SELECT * FROM files WHERE 1 = 1"
+        args = []
+        if not (is_admin and all_files):
+            query += " AND user_id = ?"
+            args.append(user_id)
+        if name_filter:
+            query += " AND original_filename LIKE ?"
+            args.append(f"%{name_filter}%")
+        cursor.execute(query + " ORDER BY upload_date DESC", args)
+        files = [dict(row) for row in cursor.fetchall()]
+    
+    if not files:
+        conn.close()
+        return jsonify({'message': 'No files matched'}), 404
+    
+    # Get locations for all selected files at once
+    locations = {f['id']: [] for f in files}
+    placeholders = ','.join('?' * len(files))
+    cursor.execute(f"""
+        SELECT file_id, node_id, file_path
+        FROM file_locations
+        WHERE file_id IN ({placeholders})
+    """, list(locations))
+    for row in cursor.fetchall():
+        locations[row['file_id']].append(dict(row))
+    
+    conn.close()
+    
+    # Build archive members, keeping names unique
+    members = []
+    used_names = set()
+    for f in files:
+        arcname = f['original_filename']
+        if arcname in used_names:
+            arcname = f"{f['id']}_{arcname}"
+        used_names.add(arcname)
+        
+        try:
+            date_time = datetime.datetime.strptime(f['upload_date'], '%Y-%m-%d %H:%M:%S').timetuple()[:6]
+        except (TypeError, ValueError):
+            date_time = (1980, 1, 1, 0, 0, 0)
+        
+        member = {
+            'arcname': arcname,
+            'size': f['size'],
+            'date_time': date_time,
+            'locations': locations[f['id']]
+        }
+        if f['current_version'] is not None:
+            # Pin the version now so the size matches what gets streamed
+            member['open'] = partial(open_version, f['id'], f['current_version'])
+        members.append(member)
+    
+    return Response(
+        stream_zip(members, compress=bool(compress)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename="files.zip"'}
+    )
 
 @file_bp.route('/files/<int:file_id>', methods=['DELETE'])
 @token_required
@@ -240,7 +688,7 @@ def delete_file(file_id):
     """Delete a file and all its replicas"""
     user_id = get_jwt_identity()
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -263,32 +711,143 @@ def delete_file(file_id):
         return jsonify({'message': 'Access denied'}), 403
     
     # Get file locations
-    cursor.execute("SELECT file_path FROM file_locations WHERE file_id = ?", (file_id,))
+    cursor.execute("SELECT node_id, file_path FROM file_locations WHERE file_id = ?", (file_id,))
     locations = cursor.fetchall()
     
-    # Delete all file replicas from storage nodes
-    for location in locations:
-        file_path = location['file_path']
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass  # Continue even if delete fails
+    # Delete all file replicas from storage nodes (continue even if some deletes fail)
+    delete_replicas(locations)
+    
+    conn.close()
     
     # Delete database records
-    cursor.execute("DELETE FROM file_locations WHERE file_id = ?", (file_id,))
-    cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    delete_file_records([file_id])
     
-    conn.commit()
+    return jsonify({'message': 'File deleted successfully'})
+
+def parse_replication_factor(data):
+    """
+    Read 'replication_factor' from a request body
+    
+    Returns:
+        Tuple of (factor or None to inherit, error message or None)
+    """
+    if 'replication_factor' not in data:
+        return None, 'Missing required field: replication_factor'
+    factor = data['replication_factor']
+    if factor is None:
+        return None, None
+    if not isinstance(factor, int) or isinstance(factor, bool) or factor < 1 or factor > NODE_COUNT:
+        return None, f'Invalid replication_factor. Must be between 1 and {NODE_COUNT}, or null to inherit'
+    return factor, None
+
+@file_bp.route('/files/<int:file_id>/replication', methods=['PUT'])
+@token_required
+def set_file_replication(file_id):
+    """Set how many replicas a file keeps, adding or removing replicas right away"""
+    user_id = get_jwt_identity()
+    factor, error = parse_replication_factor(request.get_json(silent=True) or {})
+    if error:
+        return jsonify({'message': error}), 400
+    
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    file = get_file_record(cursor, file_id)
+    is_admin = is_admin_user(cursor, user_id)
     conn.close()
     
-    return jsonify({'message': 'File deleted successfully'})
+    if not file:
+        return jsonify({'message': 'File not found'}), 404
+    
+    # Check if user has permission to change this file
+    if not is_admin and file['user_id'] != user_id:
+        return jsonify({'message': 'Access denied'}), 403
+    
+    # Versions live in shared chunks, which keep the replica count they were stored with
+    if file['current_version'] is not None:
+        return jsonify({
+            'message': 'Replication of versioned files cannot be changed: their chunks are shared with other '
+                       'versions and files and keep the replica count they were stored with'
+        }), 409
+    
+    try:
+        set_file_replication_factor(file_id, factor)
+        changes = apply_replication_factor(file_id)
+    except Exception as e:
+        return jsonify({'message': f'Error changing replication: {str(e)}'}), 500
+    
+    return jsonify({
+        'message': 'Replication policy updated',
+        'replication_factor': factor,
+        'added': changes['added'],
+        'removed': changes['removed']
+    })
+
+@file_bp.route('/files/batch-delete', methods=['POST'])
+@token_required
+def delete_batch():
+    """Delete many files and their replicas, removing their metadata in a single transaction"""
+    user_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    
+    file_ids = data.get('file_ids')
+    if not isinstance(file_ids, list) or not file_ids or not all(isinstance(i, int) for i in file_ids):
+        return jsonify({'message': 'file_ids must be a non-empty list of integers'}), 400
+    if len(file_ids) > BATCH_MAX_ITEMS:
+        return jsonify({'message': f'Too many files. Maximum per batch: {BATCH_MAX_ITEMS}'}), 400
+    file_ids = list(dict.fromkeys(file_ids))
+    
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    
+    # Check if user is admin
+    cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
+    user = cursor.fetchone()
+    is_admin = user and user['role'] == 'admin'
+    
+    # Check ownership of every file in one query
+    placeholders = ','.join('?' * len(file_ids))
+    cursor.execute(f"SELECT id, user_id FROM files WHERE id IN ({placeholders})", file_ids)
+    owners = {row['id']: row['user_id'] for row in cursor.fetchall()}
+    
+    results = []
+    allowed = []
+    for file_id in file_ids:
+        if file_id not in owners:
+            results.append({'file_id': file_id, 'status': 'not_found'})
+        elif not is_admin and owners[file_id] != user_id:
+            results.append({'file_id': file_id, 'status': 'access_denied'})
+        else:
+            results.append({'file_id': file_id, 'status': 'deleted'})
+            allowed.append(file_id)
+    
+    locations = []
+    if allowed:
+        placeholders = ','.join('?' * len(allowed))
+        cursor.execute(f"SELECT node_id, file_path FROM file_locations WHERE file_id IN ({placeholders})", allowed)
+        locations = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    
+    # Delete all replicas concurrently (continue even if some deletes fail)
+    if locations:
+        with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+            list(executor.map(lambda location: delete_replicas([location]), locations))
+    
+    # Delete database records in one transaction
+    delete_file_records(allowed)
+    
+    return jsonify({
+        'message': f'{len(allowed)} of {len(file_ids)} files deleted',
+        'results': results
+    })
 
 @file_bp.route('/users/<int:user_id>/files', methods=['GET'])
 @admin_required
 def get_user_files(user_id):
     """Admin endpoint to get all files for a specific user"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -323,6 +882,37 @@ def get_user_files(user_id):
     
     return jsonify(files)
 
+@file_bp.route('/users/<int:user_id>/replication', methods=['PUT'])
+@admin_required
+def set_user_replication(user_id):
+    """Admin endpoint to set how many replicas a user's files keep by default"""
+    factor, error = parse_replication_factor(request.get_json(silent=True) or {})
+    if error:
+        return jsonify({'message': error}), 400
+    
+    conn = db.connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+    user = cursor.fetchone()
+    conn.close()
+    
+    if not user:
+        return jsonify({'message': 'User not found'}), 404
+    
+    # New uploads use it right away; existing files are brought in line by the background job
+    set_user_replication_factor(user_id, factor)
+    
+    return jsonify({'message': 'Replication policy updated', 'replication_factor': factor})
+
+def node_usage(node_path):
+    """Count the blobs on a node directory and their total size in one scan"""
+    files_count = 0
+    total_size = 0
+    for entry in node_layout.iter_blobs(node_path):
+        files_count += 1
+        total_size += entry.stat().st_size
+    return files_count, total_size
+
 @file_bp.route('/admin/system/nodes', methods=['GET'])
 @admin_required
 def get_system_nodes():
@@ -337,11 +927,11 @@ def get_system_nodes():
             # Look for failed node directory
             failed_node_path = os.path.join(NODES_DIR, f"node{i}_failed")
             if os.path.exists(failed_node_path):
+                files_count, total_size = node_usage(failed_node_path)
                 nodes_info.append({
                     "node_id": i,
-                    "files_count": len([f for f in os.listdir(failed_node_path) if os.path.isfile(os.path.join(failed_node_path, f))]),
-                    "size_bytes": sum(os.path.getsize(os.path.join(failed_node_path, f)) 
-                                    for f in os.listdir(failed_node_path) if os.path.isfile(os.path.join(failed_node_path, f))),
+                    "files_count": files_count,
+                    "size_bytes": total_size,
                     "status": "failed"
                 })
             else:
@@ -355,9 +945,7 @@ def get_system_nodes():
             continue
         
         # Normal healthy node
-        files_count = len([f for f in os.listdir(node_path) if os.path.isfile(os.path.join(node_path, f))])
-        total_size = sum(os.path.getsize(os.path.join(node_path, f)) 
-                        for f in os.listdir(node_path) if os.path.isfile(os.path.join(node_path, f)))
+        files_count, total_size = node_usage(node_path)
         
         nodes_info.append({
             "node_id": i,
@@ -368,6 +956,73 @@ def get_system_nodes():
     
     return jsonify(nodes_info)
 
+@file_bp.route('/admin/system/migrate-layout', methods=['POST'])
+@admin_required
+def migrate_layout():
+    """Admin endpoint to start moving flat node directories into the sharded layout"""
+    node_roots = {i: os.path.join(NODES_DIR, f"node{i}") for i in range(1, NODE_COUNT + 1)}
+    if not layout_migrator.start(node_roots):
+        return jsonify({'message': 'Layout migration already running', 'status': layout_migrator.status}), 409
+    return jsonify({'message': 'Layout migration started', 'status': layout_migrator.status}), 202
+
+@file_bp.route('/admin/system/migrate-layout', methods=['GET'])
+@admin_required
+def migrate_layout_status():
+    """Admin endpoint to get the progress of the layout migration"""
+    return jsonify(layout_migrator.status)
+
+@file_bp.route('/admin/system/reconcile', methods=['POST'])
+@admin_required
+def start_reconcile():
+    """Admin endpoint to start comparing node directories against metadata in the background"""
+    if NODE_BACKEND != 'local':
+        return jsonify({
+            'message': 'Reconciliation scans node directories next to the metadata database; run reconcile.py '
+                       'on a host with the database and every node directory mounted under DFSS_NODES_DIR (nodeN)'
+        }), 400
+    
+    data = request.get_json(silent=True) or {}
+    options = {'reclaim': bool(data.get('reclaim')), 'reclaim_failed': bool(data.get('reclaim_failed'))}
+    if data.get('nodes'):
+        nodes = data['nodes']
+        if not isinstance(nodes, list) or not all(
+                isinstance(node_id, int) and not isinstance(node_id, bool) and 1 <= node_id <= NODE_COUNT
+                for node_id in nodes):
+            return jsonify({'message': f'Invalid nodes. Must be a list of node IDs between 1 and {NODE_COUNT}'}), 400
+        options['node_ids'] = nodes
+    
+    if not reconciler.start(**options):
+        return jsonify({'message': 'Reconciliation already running', 'status': reconciler.status}), 409
+    return jsonify({'message': 'Reconciliation started', 'status': reconciler.status}), 202
+
+@file_bp.route('/admin/system/reconcile', methods=['GET'])
+@admin_required
+def reconcile_status():
+    """Admin endpoint to get the state and report of the last reconciliation"""
+    return jsonify(reconciler.status)
+
+@file_bp.route('/admin/system/tiering', methods=['GET'])
+@admin_required
+def tiering_status():
+    """Admin endpoint to get node classes and the result of the last tiering run"""
+    return jsonify(tiering_job.status())
+
+@file_bp.route('/admin/system/qos', methods=['GET'])
+@admin_required
+def qos_status():
+    """Admin endpoint to get transfer admission slots and queue length in this worker"""
+    return jsonify(admission.status())
+
+@file_bp.route('/admin/system/tiering/run', methods=['POST'])
+@admin_required
+def run_tiering():
+    """Admin endpoint to promote hot files and demote cold files right now"""
+    try:
+        result = tiering_job.run_now()
+        return jsonify({'message': 'Tiering run completed', 'result': result})
+    except Exception as e:
+        return jsonify({'message': f'Error running tiering: {str(e)}'}), 500
+
 @file_bp.route('/admin/system/fail-node/<int:node_id>', methods=['POST'])
 @admin_required
 def fail_node(node_id):
@@ -375,6 +1030,10 @@ def fail_node(node_id):
     if node_id < 1 or node_id > NODE_COUNT:
         return jsonify({'message': f'Invalid node ID. Must be between 1 and {NODE_COUNT}'}), 400
     
+    if NODE_BACKEND != 'local':
+        return jsonify({'message': 'Failures are simulated by renaming local node directories; '
+                                   'stop the node daemon instead'}), 400
+    
     try:
         failed_path = simulate_node_failure(node_id)
         return jsonify({
@@ -392,12 +1051,15 @@ def repair_node(node_id):
         return jsonify({'message': f'Invalid node ID. Must be between 1 and {NODE_COUNT}'}), 400
     
     try:
-        # First restore the node
-        node_path = restore_node(node_id)
+        # First restore the node (a node daemon is brought back by restarting it)
+        node_path = restore_node(node_id) if NODE_BACKEND == 'local' else None
         
         # Then repair missing files
         files_repaired = repair_node_files(node_id, DATABASE_PATH)
         
+        # Locations may have been rewritten, so drop cached metadata
+        metadata_cache.clear()
+        
         return jsonify({
             'message': f'Node {node_id} repaired successfully',
             'node_path': node_path,
@@ -410,7 +1072,7 @@ def repair_node(node_id):
 @admin_required
 def get_system_info():
     """Admin endpoint to get overall system information"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Get user count
@@ -441,4 +1103,60 @@ def get_system_info():
         'total_size_bytes': total_size,
         'node_count': NODE_COUNT,
         'node_distribution': node_distribution
-    })
\ No newline at end of file
+    })
+
+@file_bp.route('/admin/system/cache', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    """Admin endpoint to get hit/miss/eviction counters for the in-memory caches"""
+    return jsonify(cache_stats())
+
+@file_bp.route('/admin/profiling', methods=['GET'])
+@admin_required
+def get_profiling_status():
+    """Admin endpoint to get the profiler state in this worker process"""
+    return jsonify(profiler.status())
+
+@file_bp.route('/admin/profiling', methods=['POST'])
+@admin_required
+def configure_profiling():
+    """Admin endpoint to arm the sampling profiler and/or set the slow-request threshold
+    
+    Body fields (all optional): `requests` (profile the next N requests),
+    `match` (endpoint name such as `file.get_files`, or a path prefix),
+    `interval_ms`, `slow_threshold_ms` (0 turns capture off) and `clear`.
+    """
+    data = request.get_json(silent=True) or {}
+    requests_count, match = data.get('requests'), data.get('match')
+    if requests_count is not None and (isinstance(requests_count, bool) or not isinstance(requests_count, int)
+                                       or requests_count < 0):
+        return jsonify({'message': '`requests` must be a non-negative integer'}), 400
+    if match is not None and not isinstance(match, str):
+        return jsonify({'message': '`match` must be a string'}), 400
+    try:
+        profiler.configure(
+            requests=requests_count,
+            match=match or None,
+            interval_ms=float(data['interval_ms']) if data.get('interval_ms') else None,
+            slow_threshold_ms=float(data['slow_threshold_ms']) if data.get('slow_threshold_ms') is not None else None,
+            clear=bool(data.get('clear'))
+        )
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid profiling settings'}), 400
+    return jsonify(profiler.status())
+
+@file_bp.route('/admin/profiling/profile', methods=['GET'])
+@admin_required
+def download_profile():
+    """Admin endpoint to download aggregated stack samples in collapsed-stack format"""
+    return Response(
+        profiler.collapsed_profile(request.args.get('endpoint')),
+        mimetype='text/plain',
+        headers={'Content-Disposition': 'attachment; filename="profile.collapsed"'}
+    )
+
+@file_bp.route('/admin/profiling/slow', methods=['GET'])
+@admin_required
+def download_slow_traces():
+    """Admin endpoint to download captured slow-request traces"""
+    return jsonify(profiler.traces())
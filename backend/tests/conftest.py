@@ -0,0 +1,53 @@
+"""
+Settings are read when config is imported, so point them at a throwaway
+directory before any test module imports the backend.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='dfss-tests-')
+
+os.environ['DFSS_DATABASE_PATH'] = os.path.join(WORK_DIR, 'metadata.sqlite')
+os.environ['DFSS_NODES_DIR'] = os.path.join(WORK_DIR, 'nodes')
+os.environ['JWT_SECRET_KEY'] = 'test-secret'
+os.environ.pop('DFSS_NODE_SECRET', None)
+sys.path.insert(0, BACKEND_DIR)
+
+@pytest.fixture(scope='session')
+def app():
+    # Only API tests need Flask and the auth libraries; the rest run without them
+    for module in ('flask', 'jwt', 'bcrypt'):
+        pytest.importorskip(module)
+    from app import create_app
+    return create_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def login(client, username, password):
+    """Log in and get request headers carrying the token"""
+    with client.post('/login', json={'username': username, 'password': password}) as response:
+        assert response.status_code == 200
+        return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+@pytest.fixture
+def admin_headers(client):
+    return login(client, 'admin', 'admin123')
+
+@pytest.fixture
+def new_user(client, admin_headers):
+    """Create users with the 'user' role; call with a unique name to get their request headers"""
+    def create(username):
+        data = {'username': username, 'email': f'{username}@dfss.test', 'password': 'secret', 'role': 'user'}
+        with client.post('/register', json=data, headers=admin_headers) as response:
+            assert response.status_code == 201
+        return login(client, username, 'secret')
+    return create
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
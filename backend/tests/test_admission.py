@@ -0,0 +1,39 @@
+"""
+Admission slots and the in-flight transfer gauge must be given back once a
+response has been sent, including send_file downloads, which the server
+streams straight from the file.
+"""
+import io
+import pytest
+
+@pytest.fixture
+def file_id(client, admin_headers):
+    data = {'file': (io.BytesIO(b'hello world' * 100), 'hello.txt')}
+    with client.post('/upload', data=data, headers=admin_headers, content_type='multipart/form-data') as response:
+        assert response.status_code == 201
+        return response.get_json()['file_id']
+
+def test_downloads_release_admission_slots(client, admin_headers, file_id):
+    from qos import admission
+    from metrics import TRANSFERS_IN_FLIGHT
+
+    # More downloads than one user may run at once; a leaked slot would make them queue and fail
+    for _ in range(admission.max_per_user + 4):
+        with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+            assert response.status_code == 200
+            assert response.get_data() == b'hello world' * 100
+
+    assert admission.status()['active'] == 0
+    assert TRANSFERS_IN_FLIGHT._values.get(('download',), 0) == 0
+
+def test_not_modified_downloads_release_admission_slots(client, admin_headers, file_id):
+    from qos import admission
+
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        etag = response.headers['ETag']
+
+    for _ in range(admission.max_per_user + 4):
+        with client.get(f'/download/{file_id}', headers={**admin_headers, 'If-None-Match': etag}) as response:
+            assert response.status_code == 304
+
+    assert admission.status()['active'] == 0
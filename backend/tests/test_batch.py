@@ -0,0 +1,94 @@
+"""
+Batch uploads and deletes report each item on its own: items that fail don't
+stop the others, and failed uploads leave no metadata or replicas behind.
+"""
+import io
+import os
+import pytest
+import db
+from config import NODES_DIR
+
+def parts(*files):
+    return {'files': [(io.BytesIO(data), name) for name, data in files]}
+
+def upload_batch(client, headers, *files):
+    with client.post('/upload/batch', data=parts(*files), headers=headers,
+                     content_type='multipart/form-data') as response:
+        return response.status_code, response.get_json()
+
+def stored_blobs():
+    return {name for _, _, names in os.walk(NODES_DIR) for name in names}
+
+def file_count():
+    conn = db.connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_batch_upload_partial_failure(client, admin_headers, monkeypatch):
+    import routes
+    store = routes.store_file_with_replication
+    def store_unless_broken(temp_path, filename, *args):
+        if filename.endswith('broken.txt'):
+            raise OSError('disk full')
+        return store(temp_path, filename, *args)
+    monkeypatch.setattr(routes, 'store_file_with_replication', store_unless_broken)
+    monkeypatch.setattr(routes, 'MAX_FILE_SIZE', 100)
+    files_before = file_count()
+
+    status, body = upload_batch(client, admin_headers, ('good.txt', b'good'), ('broken.txt', b'broken'),
+                                ('', b''), ('big.txt', b'x' * 101), ('also-good.txt', b'also good'))
+    assert status == 201
+    assert body['message'] == '2 of 5 files uploaded'
+    results = body['results']
+    assert [result['status'] for result in results] == ['uploaded', 'error', 'error', 'error', 'uploaded']
+    assert 'disk full' in results[1]['message']
+    assert results[2]['message'] == 'No file selected'
+    assert results[3]['message'].startswith('File too large')
+    assert file_count() == files_before + 2
+
+    for result, content in ((results[0], b'good'), (results[4], b'also good')):
+        with client.get(f"/download/{result['file_id']}", headers=admin_headers) as response:
+            assert response.get_data() == content
+
+def test_batch_upload_metadata_failure_removes_replicas(client, admin_headers, monkeypatch):
+    import routes
+    def fail(items):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(routes, 'record_files', fail)
+    blobs_before = stored_blobs()
+    files_before = file_count()
+
+    status, body = upload_batch(client, admin_headers, ('a.txt', b'a'), ('b.txt', b'b'))
+    assert status == 400
+    assert all(result['status'] == 'error' for result in body['results'])
+    assert stored_blobs() == blobs_before
+    assert file_count() == files_before
+
+def test_batch_delete_partial(client, admin_headers, new_user):
+    other = new_user('batch-other')
+    _, mine = upload_batch(client, admin_headers, ('one.txt', b'1'), ('two.txt', b'2'))
+    _, theirs = upload_batch(client, other, ('theirs.txt', b'3'))
+    mine = [result['file_id'] for result in mine['results']]
+    theirs = theirs['results'][0]['file_id']
+
+    # A user can't delete an admin's file, and unknown IDs are reported
+    with client.post('/files/batch-delete', json={'file_ids': [theirs, mine[0], 999999]}, headers=other) as response:
+        assert response.status_code == 200
+        assert [result['status'] for result in response.get_json()['results']] == \
+            ['deleted', 'access_denied', 'not_found']
+    with client.get(f'/files/{mine[0]}', headers=admin_headers) as response:
+        assert response.status_code == 200
+
+    with client.post('/files/batch-delete', json={'file_ids': mine + [mine[0]]}, headers=admin_headers) as response:
+        body = response.get_json()
+        assert body['message'] == '2 of 2 files deleted'
+    for file_id in mine + [theirs]:
+        with client.get(f'/files/{file_id}', headers=admin_headers) as response:
+            assert response.status_code == 404
+
+@pytest.mark.parametrize('file_ids', [[], 'all', [1, '2'], None])
+def test_batch_delete_rejects_bad_ids(client, admin_headers, file_ids):
+    with client.post('/files/batch-delete', json={'file_ids': file_ids}, headers=admin_headers) as response:
+        assert response.status_code == 400
@@ -0,0 +1,48 @@
+"""
+Content-defined chunking: boundaries follow content, so chunks away from an
+edit come out identical, and the numpy scan cuts exactly where the pure
+Python one does.
+"""
+import io
+import random
+import pytest
+import chunking
+from chunking import find_cut, iter_chunks
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+def chunks_of(data, **kwargs):
+    return list(iter_chunks(io.BytesIO(data), **kwargs))
+
+def test_chunks_reassemble_within_limits():
+    data = random_bytes(500000)
+    chunks = chunks_of(data, min_size=1024, avg_size=4096, max_size=16384)
+    assert b''.join(chunks) == data
+    assert all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1])
+
+def test_insertion_only_changes_nearby_chunks():
+    data = random_bytes(500000)
+    edited = data[:250000] + b'inserted bytes' + data[250000:]
+    before = chunks_of(data, min_size=1024, avg_size=4096, max_size=16384)
+    after = chunks_of(edited, min_size=1024, avg_size=4096, max_size=16384)
+    shared = set(before) & set(after)
+    assert len(shared) >= len(before) - 3
+
+@pytest.fixture
+def pure_python(monkeypatch):
+    monkeypatch.setattr(chunking, 'numpy', None)
+
+@pytest.mark.parametrize('data', [random_bytes(300000, seed=1), b'\0' * 200000,
+                                  bytes(random.Random(2).choice(b'ab') for _ in range(100000))])
+@pytest.mark.parametrize('sizes', [{}, {'min_size': 64, 'avg_size': 256, 'max_size': 1024},
+                                   {'min_size': 0, 'avg_size': 64, 'max_size': 100000}])
+def test_numpy_scan_matches_pure_python(data, sizes, monkeypatch):
+    pytest.importorskip('numpy')
+    fast = chunks_of(data, **sizes)
+    monkeypatch.setattr(chunking, 'numpy', None)
+    assert chunks_of(data, **sizes) == fast
+
+def test_short_buffers(pure_python):
+    assert find_cut(b'', min_size=4, avg_size=8, max_size=16) == 0
+    assert find_cut(b'abc', min_size=4, avg_size=8, max_size=16) == 3
@@ -0,0 +1,72 @@
+"""
+Listings and file info answer polls with 304 while nothing changed, and a
+change by the owner (or to any file, for the admin's all-files view) gives
+a new ETag. Listings are revalidated by ETag only.
+"""
+import io
+
+def upload(client, headers, name):
+    data = {'file': (io.BytesIO(b'content of ' + name.encode()), name)}
+    with client.post('/upload', data=data, headers=headers, content_type='multipart/form-data') as response:
+        assert response.status_code == 201
+        return response.get_json()['file_id']
+
+def get(client, path, headers, etag=None):
+    if etag:
+        headers = {**headers, 'If-None-Match': etag}
+    with client.get(path, headers=headers) as response:
+        return response.status_code, response.headers.get('ETag'), response
+
+def test_listing_revalidates_until_owner_changes(client, new_user):
+    alice = new_user('etag-alice')
+    bob = new_user('etag-bob')
+    upload(client, alice, 'a.txt')
+
+    status, etag, response = get(client, '/files', alice)
+    assert status == 200 and etag
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert 'Last-Modified' not in response.headers
+    assert get(client, '/files', alice, etag)[0] == 304
+
+    # Someone else's upload doesn't change Alice's listing
+    upload(client, bob, 'b.txt')
+    assert get(client, '/files', alice, etag)[0] == 304
+
+    upload(client, alice, 'c.txt')
+    status, new_etag, response = get(client, '/files', alice, etag)
+    assert status == 200 and new_etag != etag
+    assert sorted(f['original_filename'] for f in response.get_json()) == ['a.txt', 'c.txt']
+
+def test_listing_ignores_if_modified_since(client, new_user):
+    carol = new_user('etag-carol')
+    upload(client, carol, 'a.txt')
+    headers = {**carol, 'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}
+    with client.get('/files', headers=headers) as response:
+        assert response.status_code == 200
+
+def test_admin_all_listing_changes_with_any_user(client, admin_headers, new_user):
+    dave = new_user('etag-dave')
+    _, etag, _ = get(client, '/files?all=true', admin_headers)
+    assert get(client, '/files?all=true', admin_headers, etag)[0] == 304
+    upload(client, dave, 'd.txt')
+    assert get(client, '/files?all=true', admin_headers, etag)[0] == 200
+
+def test_listing_etag_changes_on_delete(client, new_user):
+    erin = new_user('etag-erin')
+    file_id = upload(client, erin, 'e.txt')
+    _, etag, _ = get(client, '/files', erin)
+    _, info_etag, _ = get(client, f'/files/{file_id}', erin)
+    assert get(client, f'/files/{file_id}', erin, info_etag)[0] == 304
+
+    with client.delete(f'/files/{file_id}', headers=erin) as response:
+        assert response.status_code == 200
+    status, _, response = get(client, '/files', erin, etag)
+    assert status == 200 and response.get_json() == []
+    assert get(client, f'/files/{file_id}', erin, info_etag)[0] == 404
+
+def test_etags_are_per_user(client, new_user):
+    frank = new_user('etag-frank')
+    grace = new_user('etag-grace')
+    _, etag, _ = get(client, '/files', frank)
+    # An ETag from another user's listing never matches
+    assert get(client, '/files', grace, etag)[0] == 200
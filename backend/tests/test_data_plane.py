@@ -0,0 +1,63 @@
+"""
+The data plane answers malformed lengths and numbers from clients with 400
+instead of an internal error.
+"""
+import asyncio
+import io
+import json
+import socket
+import threading
+import pytest
+from test_node_client import free_port
+
+@pytest.fixture
+def data_plane(app):
+    from data_plane import DataPlaneServer
+    server = DataPlaneServer('127.0.0.1', free_port())
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    serving = asyncio.run_coroutine_threadsafe(server.serve(), loop)
+    for _ in range(100):
+        try:
+            socket.create_connection((server.host, server.port), timeout=0.1).close()
+            break
+        except OSError:
+            threading.Event().wait(0.05)
+    yield server
+    serving.cancel()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+def send(server, head, body=b''):
+    """Send a raw request and get the status and JSON body of the reply"""
+    with socket.create_connection((server.host, server.port), timeout=5) as conn:
+        conn.sendall(head.encode('latin-1') + b'\r\n\r\n' + body)
+        reply = b''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            reply += data
+    status_line, _, rest = reply.partition(b'\r\n')
+    return int(status_line.split()[1]), json.loads(rest.partition(b'\r\n\r\n')[2] or b'null')
+
+@pytest.mark.parametrize('length', ['abc', '-1', '1_0', '+5', '²'])
+def test_invalid_content_length(data_plane, admin_headers, length):
+    head = (f"POST /upload HTTP/1.1\r\nHost: x\r\nAuthorization: {admin_headers['Authorization']}\r\n"
+            f"Content-Type: multipart/form-data; boundary=b\r\nContent-Length: {length}\r\nConnection: close")
+    status, body = send(data_plane, head)
+    assert status == 400
+    assert body['message'] == 'Invalid Content-Length'
+
+def test_invalid_version(data_plane, client, admin_headers):
+    data = {'file': (io.BytesIO(b'hello'), 'hello.txt')}
+    with client.post('/upload', data=data, headers=admin_headers, content_type='multipart/form-data') as response:
+        file_id = response.get_json()['file_id']
+
+    for version in ['%C2%B2', '-1', 'x']:
+        head = (f"GET /download/{file_id}?version={version} HTTP/1.1\r\nHost: x\r\n"
+                f"Authorization: {admin_headers['Authorization']}\r\nConnection: close")
+        assert send(data_plane, head) == (400, {'message': 'Invalid version'})
+        with client.get(f'/download/{file_id}?version={version}', headers=admin_headers) as response:
+            assert response.status_code == 400
@@ -0,0 +1,63 @@
+"""
+Downloads stage node copies under private temp names that are removed once
+sent, and only read a body into the file cache when the cache would keep it.
+"""
+import io
+import os
+import tempfile
+import pytest
+from cache import LRUCache
+
+def test_admits_follows_admission_filter():
+    cache = LRUCache(100, max_item_size=10, admission_hits=2)
+    assert not cache.admits('a', 5)
+    assert cache.admits('a', 5)
+    assert cache.put('a', b'12345')
+    assert cache.admits('a', 5)
+    assert not cache.admits('b', 11)
+
+def test_admits_without_filter():
+    cache = LRUCache(100, max_item_size=10)
+    assert cache.admits('a', 10)
+    assert not cache.admits('a', 11)
+
+@pytest.fixture
+def staging_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+def upload(client, headers, data, filename):
+    data = {'file': (io.BytesIO(data), filename)}
+    with client.post('/upload', data=data, headers=headers, content_type='multipart/form-data') as response:
+        assert response.status_code == 201
+        return response.get_json()['file_id']
+
+def test_download_staging_is_removed(client, admin_headers, staging_dir):
+    from cache import file_cache
+    file_id = upload(client, admin_headers, b'x' * 1000, 'report.txt')
+    file_cache.invalidate(file_id)
+
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        assert response.status_code == 200
+        assert response.get_data() == b'x' * 1000
+    # One download does not pass the admission filter
+    assert file_cache.get(file_id) is None
+    assert os.listdir(staging_dir) == []
+
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        assert response.get_data() == b'x' * 1000
+    assert file_cache.get(file_id) == b'x' * 1000
+    assert os.listdir(staging_dir) == []
+
+def test_concurrent_downloads_of_same_name_do_not_share_staging(client, admin_headers, staging_dir):
+    first = upload(client, admin_headers, b'first', 'same.txt')
+    second = upload(client, admin_headers, b'second', 'same.txt')
+    a = client.get(f'/download/{first}', headers=admin_headers)
+    b = client.get(f'/download/{second}', headers=admin_headers)
+    try:
+        assert a.get_data() == b'first'
+        assert b.get_data() == b'second'
+    finally:
+        a.close()
+        b.close()
+    assert os.listdir(staging_dir) == []
@@ -0,0 +1,63 @@
+"""
+The layout migration job moves blobs of a flat node directory into shard
+directories while the files stay downloadable, one run at a time.
+"""
+import io
+import os
+import time
+import db
+import node_layout
+from config import NODES_DIR
+
+def wait_for_migration(client, headers):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with client.get('/admin/system/migrate-layout', headers=headers) as response:
+            status = response.get_json()
+        if status['state'] != 'running':
+            return status
+        time.sleep(0.05)
+    raise AssertionError('layout migration did not finish')
+
+def test_migration_moves_flat_replicas(client, admin_headers):
+    data = {'file': (io.BytesIO(b'legacy'), 'legacy.txt')}
+    with client.post('/upload', data=data, headers=admin_headers, content_type='multipart/form-data') as response:
+        file_id = response.get_json()['file_id']
+    conn = db.connect()
+    try:
+        replicas = conn.execute("SELECT node_id, file_path FROM file_locations WHERE file_id = ?", (file_id,)).fetchall()
+    finally:
+        conn.close()
+
+    # Put every replica where the old flat layout kept it
+    flat = []
+    for node_id, file_path in replicas:
+        node_root = os.path.join(NODES_DIR, f'node{node_id}')
+        name = os.path.basename(file_path)
+        os.replace(node_layout.blob_path(node_root, name), os.path.join(node_root, name))
+        flat.append((node_root, name))
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        assert response.get_data() == b'legacy'
+
+    with client.post('/admin/system/migrate-layout', headers=admin_headers) as response:
+        assert response.status_code == 202
+    status = wait_for_migration(client, admin_headers)
+    assert status['state'] == 'finished'
+    assert sum(status['moved'].values()) >= len(flat)
+
+    for node_root, name in flat:
+        assert not os.path.exists(os.path.join(node_root, name))
+        assert os.path.exists(node_layout.blob_path(node_root, name))
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        assert response.get_data() == b'legacy'
+
+def test_one_migration_at_a_time(client, admin_headers):
+    from node_layout import migrator
+    # Another worker's run holds the job lock
+    other_run = node_layout.JobLock(migrator.name)
+    assert other_run.acquire()
+    try:
+        with client.post('/admin/system/migrate-layout', headers=admin_headers) as response:
+            assert response.status_code == 409
+    finally:
+        other_run.release()
@@ -0,0 +1,104 @@
+"""
+LocalNodeClient against node directories in a temp dir: writes replace blobs
+atomically, and lookups find blobs in either layout.
+"""
+import os
+import pytest
+import node_layout
+from node_client import LocalNodeClient, NodeError
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    client = LocalNodeClient()
+    monkeypatch.setattr(client, 'node_path', lambda node_id: str(tmp_path / f'node{node_id}'))
+    os.mkdir(client.node_path(1))
+    os.mkdir(client.node_path(2))
+    return client
+
+def test_overwrite_does_not_truncate_open_readers(client, tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(b'a' * 100000)
+    client.put(1, 'blob', str(src))
+    with client.open(1, 'blob') as reader:
+        src.write_bytes(b'b' * 10)
+        client.put(1, 'blob', str(src))
+        # The reader keeps the old blob rather than a truncated or mixed one
+        assert reader.read() == b'a' * 100000
+    with client.open(1, 'blob') as reader:
+        assert reader.read() == b'b' * 10
+
+def test_writes_leave_no_temp_files(client, tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(b'hello')
+    client.put(1, 'a', str(src))
+    client.put_bytes(1, 'b', b'world')
+    client.copy(1, 2, 'a')
+    names = [entry.name for node in (1, 2) for entry in node_layout.iter_blobs(client.node_path(node), include_temp=True)]
+    assert sorted(names) == ['a', 'a', 'b']
+
+def test_failed_copy_leaves_no_temp_file(client, tmp_path):
+    with pytest.raises(OSError):
+        client.put(1, 'a', str(tmp_path / 'missing'))
+    assert list(node_layout.iter_blobs(client.node_path(1), include_temp=True)) == []
+    assert client.stat(1, 'a') is None
+
+def test_put_on_failed_node(client, tmp_path):
+    os.rename(client.node_path(1), client.node_path(1) + '_failed')
+    with pytest.raises(NodeError):
+        client.put_bytes(1, 'a', b'x')
+
+def put_flat(client, node_id, name, data):
+    """Store a blob in the legacy flat layout"""
+    with open(os.path.join(client.node_path(node_id), name), 'wb') as f:
+        f.write(data)
+
+def test_reads_and_deletes_find_both_layouts(client):
+    put_flat(client, 1, 'old', b'flat')
+    client.put_bytes(1, 'new', b'sharded')
+    assert client.stat(1, 'old') == 4
+    with client.open(1, 'old') as reader:
+        assert reader.read() == b'flat'
+    with client.open(1, 'new') as reader:
+        assert reader.read() == b'sharded'
+    assert client.delete(1, 'old')
+    assert client.delete(1, 'new')
+    assert not client.delete(1, 'old')
+
+def test_blob_moved_after_resolve_is_still_found(client, monkeypatch):
+    put_flat(client, 1, 'a', b'data')
+    root = client.node_path(1)
+    resolve = node_layout.resolve
+
+    def migrate_after_resolve(node_root, name):
+        # The migrator moves the blob right after the lookup found it flat
+        path = resolve(node_root, name)
+        if path == os.path.join(root, name):
+            node_layout.migrate_node(root)
+        return path
+
+    monkeypatch.setattr(node_layout, 'resolve', migrate_after_resolve)
+    with client.open(1, 'a') as reader:
+        assert reader.read() == b'data'
+    monkeypatch.setattr(node_layout, 'resolve', resolve)
+
+    put_flat(client, 1, 'b', b'data')
+    monkeypatch.setattr(node_layout, 'resolve', migrate_after_resolve)
+    assert client.delete(1, 'b')
+    assert client.stat(1, 'b') is None
+
+def test_migration_moves_flat_blobs_into_shards(client):
+    for i in range(20):
+        put_flat(client, 1, f'user_1_blob{i}', str(i).encode())
+    put_flat(client, 1, '.tmp_partial', b'x')
+    root = client.node_path(1)
+
+    assert node_layout.migrate_node(root) == 20
+    assert node_layout.migrate_node(root) == 0
+    # Only the temp file is left at the top level
+    assert [entry.name for entry in os.scandir(root) if entry.is_file()] == ['.tmp_partial']
+    for i in range(20):
+        name = f'user_1_blob{i}'
+        assert node_layout.resolve(root, name) == node_layout.blob_path(root, name)
+        with client.open(1, name) as reader:
+            assert reader.read() == str(i).encode()
+    assert len(list(node_layout.iter_blobs(root))) == 20
@@ -0,0 +1,84 @@
+"""
+A writer thread that fails to start or dies must fail the writes it holds
+rather than leave their callers waiting, and the next write starts a new one.
+"""
+import concurrent.futures
+import sqlite3
+import threading
+import pytest
+import db
+import metadata_writer
+from metadata_writer import MetadataWriter
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / 'writer.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (value INTEGER)")
+    conn.commit()
+    conn.close()
+    connect = db.connect
+    monkeypatch.setattr(db, 'connect', lambda database_path=None: connect(path))
+    monkeypatch.setattr(metadata_writer, 'METADATA_GROUP_COMMIT', True)
+    return path
+
+def insert(value):
+    return lambda cursor: cursor.execute("INSERT INTO t VALUES (?)", (value,)).rowcount
+
+def count(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_writes_commit(database):
+    writer = MetadataWriter()
+    assert writer.execute(insert(1)) == 1
+    assert count(database) == 1
+
+def test_failed_startup_fails_writes_and_restarts(database, monkeypatch):
+    connect = db.connect
+    def broken(database_path=None):
+        raise sqlite3.OperationalError('unable to open database file')
+    monkeypatch.setattr(db, 'connect', broken)
+    writer = MetadataWriter()
+    with pytest.raises(sqlite3.OperationalError):
+        writer.execute(insert(1), timeout=5)
+
+    monkeypatch.setattr(db, 'connect', connect)
+    assert writer.execute(insert(2), timeout=5) == 1
+    assert count(database) == 1
+
+def test_dead_writer_fails_queued_writes_and_restarts(database):
+    writer = MetadataWriter(max_delay_ms=0)
+    entered, release = threading.Event(), threading.Event()
+    def blocking(cursor):
+        entered.set()
+        release.wait(5)
+        return 0
+    first = writer.submit(blocking)
+    assert entered.wait(5)
+    # Queued behind the running batch when the writer dies
+    queued = writer.submit(insert(1))
+
+    def crash_once(conn, batch):
+        del writer._commit
+        raise RuntimeError('writer crashed')
+    writer._commit = crash_once
+    release.set()
+    first.result(timeout=5)
+    with pytest.raises(RuntimeError):
+        queued.result(timeout=5)
+
+    assert writer.execute(insert(2), timeout=5) == 1
+    assert count(database) == 1
+
+def test_execute_times_out(database):
+    writer = MetadataWriter()
+    release = threading.Event()
+    try:
+        with pytest.raises(concurrent.futures.TimeoutError):
+            writer.execute(lambda cursor: release.wait(5), timeout=0.1)
+    finally:
+        release.set()
@@ -0,0 +1,141 @@
+"""
+HttpNodeClient against real node_server.py daemons: pooled connections must
+survive a daemon restart, and error replies must not leave request bodies
+behind on kept-alive connections.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+from conftest import BACKEND_DIR
+from node_client import HttpNodeClient, NodeError
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Daemon:
+    """A node_server.py process that can be restarted on the same port"""
+
+    def __init__(self, root, port, secret=None):
+        self.root = root
+        self.port = port
+        self.secret = secret
+        self.process = None
+
+    def start(self):
+        env = {**os.environ, 'PYTHONPATH': BACKEND_DIR}
+        if self.secret:
+            env['DFSS_NODE_SECRET'] = self.secret
+        code = f"import node_server; node_server.run_node(1, port={self.port}, root={self.root!r})"
+        self.process = subprocess.Popen([sys.executable, '-c', code], env=env, cwd=BACKEND_DIR,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('node daemon did not start')
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+@pytest.fixture
+def daemon(tmp_path):
+    root = tmp_path / 'node1'
+    root.mkdir()
+    daemon = Daemon(str(root), free_port())
+    daemon.start()
+    yield daemon
+    daemon.stop()
+
+def make_client(daemon, **kwargs):
+    return HttpNodeClient({1: f'http://127.0.0.1:{daemon.port}'}, timeout=5, **kwargs)
+
+def fill_pool(client, count):
+    """Leave count idle keep-alive connections in node 1's pool"""
+    readers = [client.open(1, 'a') for _ in range(count)]
+    for reader in readers:
+        reader.read()
+        reader.close()
+    assert client.pools[1].qsize() == count
+
+def test_pooled_connections_survive_restart(daemon):
+    client = make_client(daemon, pool_size=8, retries=2)
+    client.put_bytes(1, 'a', b'hello')
+    fill_pool(client, 8)
+
+    daemon.stop()
+    daemon.start()
+
+    assert client.health(1) == 'healthy'
+    assert client.stat(1, 'a') == 5
+    client.put_bytes(1, 'b', b'world')
+    with client.open(1, 'b') as reader:
+        assert reader.read() == b'world'
+
+def test_health_survives_restart(daemon):
+    client = make_client(daemon)
+    client.put_bytes(1, 'a', b'hello')
+    fill_pool(client, 4)
+
+    daemon.stop()
+    daemon.start()
+
+    assert client.health(1) == 'healthy'
+
+def test_stat_raises_when_node_unreachable(daemon):
+    client = make_client(daemon, retries=0)
+    daemon.stop()
+    try:
+        with pytest.raises(NodeError):
+            client.stat(1, 'a')
+        assert client.health(1) == 'unreachable'
+    finally:
+        daemon.start()
+
+def test_stat_of_missing_blob_is_none(daemon):
+    assert make_client(daemon).stat(1, 'missing') is None
+
+def test_rejected_put_does_not_poison_connection(daemon):
+    client = make_client(daemon, pool_size=1, retries=0)
+    client.put_bytes(1, 'a', b'hello')
+    # A body that is itself an HTTP request must not be run as the next request
+    body = b'DELETE /blobs/a HTTP/1.1\r\nHost: x\r\nContent-Length: 0\r\n\r\n'
+    response, _ = client.request(1, 'PUT', '../etc', body=body, headers={'Content-Length': str(len(body))})
+    assert response.status == 400
+    assert client.stat(1, 'a') == 5
+
+def test_failed_node_rejects_put_and_keeps_serving(daemon):
+    client = make_client(daemon, pool_size=1, retries=0)
+    os.rename(daemon.root, daemon.root + '_failed')
+    with pytest.raises(NodeError):
+        client.put_bytes(1, 'a', b'PUT /blobs/x HTTP/1.1\r\n\r\n')
+    os.rename(daemon.root + '_failed', daemon.root)
+    client.put_bytes(1, 'a', b'hello')
+    assert client.stat(1, 'a') == 5
+
+def test_wrong_secret_is_rejected(tmp_path):
+    root = tmp_path / 'node1'
+    root.mkdir()
+    daemon = Daemon(str(root), free_port(), secret='s3cret')
+    daemon.start()
+    try:
+        good = make_client(daemon, secret='s3cret')
+        bad = make_client(daemon, secret='nope')
+        good.put_bytes(1, 'a', b'hello')
+        with pytest.raises(NodeError):
+            bad.put_bytes(1, 'b', b'x' * 100000)
+        with pytest.raises(NodeError):
+            bad.stat(1, 'a')
+        # /health needs no secret
+        assert bad.health(1) == 'healthy'
+        assert good.stat(1, 'a') == 5
+    finally:
+        daemon.stop()
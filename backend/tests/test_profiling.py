@@ -0,0 +1,39 @@
+"""
+Profiling settings are validated, and a profiler fault never fails the
+request being observed.
+"""
+import pytest
+from profiling import profiler
+
+@pytest.fixture(autouse=True)
+def disarm():
+    yield
+    profiler.configure(requests=0, slow_threshold_ms=0, clear=True)
+
+@pytest.mark.parametrize('body', [
+    {'requests': 5, 'match': 7},
+    {'requests': 5, 'match': ['/files']},
+    {'requests': -1},
+    {'requests': '5'},
+    {'requests': 2.5},
+    {'requests': True},
+])
+def test_invalid_settings_are_rejected(client, admin_headers, body):
+    with client.post('/admin/profiling', json=body, headers=admin_headers) as response:
+        assert response.status_code == 400
+    assert profiler.status()['remaining_requests'] == 0
+
+def test_valid_settings_arm_the_profiler(client, admin_headers):
+    with client.post('/admin/profiling', json={'requests': 3, 'match': '/files'}, headers=admin_headers) as response:
+        assert response.status_code == 200
+        assert response.get_json()['remaining_requests'] == 3
+        assert response.get_json()['match'] == '/files'
+
+def test_profiler_fault_does_not_fail_request(client, admin_headers):
+    # A match that cannot be compared with the path makes the profiler itself raise
+    profiler.remaining, profiler.match = 1, object()
+    with client.get('/files', headers=admin_headers) as response:
+        assert response.status_code == 200
+    profiler.remaining, profiler.match = 0, None
+    with client.get('/files', headers=admin_headers) as response:
+        assert response.status_code == 200
@@ -0,0 +1,80 @@
+"""
+Transfers waiting for an admission slot on the API hold a worker thread, so
+one user's flood must be turned away at once instead of taking every thread.
+"""
+import threading
+import time
+import pytest
+from qos import AdmissionController, Overloaded
+
+def flood(controller, user_id, count):
+    """Start count blocking acquires; returns the threads and what each got"""
+    results = []
+    def attempt():
+        start = time.monotonic()
+        try:
+            ticket = controller.acquire(user_id)
+            ticket.release()
+            results.append(('admitted', time.monotonic() - start))
+        except Overloaded:
+            results.append(('rejected', time.monotonic() - start))
+    threads = [threading.Thread(target=attempt) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def test_flood_does_not_block_other_users():
+    controller = AdmissionController(max_active=8, max_per_user=2, max_waiting_threads=3,
+                                     max_waiting_threads_per_user=1, queue_timeout=2)
+    held = [controller.acquire('flooder') for _ in range(2)]
+
+    threads, results = flood(controller, 'flooder', 8)
+    time.sleep(0.2)
+    # One flood request waits; the rest were rejected without waiting
+    assert controller.status()['waiting_threads'] == 1
+    assert sum(1 for outcome, _ in results if outcome == 'rejected') == 7
+    assert all(elapsed < 0.5 for outcome, elapsed in results if outcome == 'rejected')
+
+    start = time.monotonic()
+    with controller.acquire('other'):
+        assert time.monotonic() - start < 0.1
+
+    for ticket in held:
+        ticket.release()
+    for thread in threads:
+        thread.join()
+    assert [outcome for outcome, _ in results].count('admitted') == 1
+    assert controller.status()['active'] == 0
+    assert controller.status()['waiting_threads'] == 0
+
+def test_waiting_threads_are_capped_in_total():
+    controller = AdmissionController(max_active=1, max_per_user=1, max_waiting_threads=2,
+                                     max_waiting_threads_per_user=1, queue_timeout=2)
+    ticket = controller.acquire('a')
+    threads, results = flood(controller, 'b', 1)
+    more, more_results = flood(controller, 'c', 1)
+    time.sleep(0.2)
+    assert controller.status()['waiting_threads'] == 2
+
+    with pytest.raises(Overloaded) as rejected:
+        controller.acquire('d')
+    assert rejected.value.retry_after >= 1
+
+    ticket.release()
+    for thread in threads + more:
+        thread.join()
+    assert [outcome for outcome, _ in results + more_results] == ['admitted', 'admitted']
+
+def test_async_waiters_do_not_count_as_threads():
+    import asyncio
+    controller = AdmissionController(max_active=1, max_per_user=1, max_waiting_threads=0,
+                                     max_waiting_threads_per_user=0, queue_timeout=0.1)
+    ticket = controller.acquire('a')
+
+    async def wait():
+        with pytest.raises(Overloaded) as timed_out:
+            await controller.acquire_async('b')
+        return str(timed_out.value)
+
+    assert 'Timed out' in asyncio.run(wait())
+    ticket.release()
@@ -0,0 +1,87 @@
+"""
+Reconciliation reports orphans, temp files and missing replicas without
+touching anything unless asked to reclaim, and never deletes recorded blobs.
+"""
+import io
+import os
+import pytest
+import db
+import node_layout
+from config import NODES_DIR
+
+@pytest.fixture
+def stored_file(client, admin_headers):
+    """Upload a file and return its ID and (node ID, path) of its first replica"""
+    data = {'file': (io.BytesIO(b'keep me'), 'keep.txt')}
+    with client.post('/upload', data=data, headers=admin_headers, content_type='multipart/form-data') as response:
+        file_id = response.get_json()['file_id']
+    conn = db.connect()
+    try:
+        node_id, file_path = conn.execute(
+            "SELECT node_id, file_path FROM file_locations WHERE file_id = ? ORDER BY node_id", (file_id,)).fetchone()
+    finally:
+        conn.close()
+    node_root = os.path.join(NODES_DIR, f'node{node_id}')
+    return file_id, node_id, node_layout.resolve(node_root, os.path.basename(file_path))
+
+def litter(node_id, tag):
+    """Put an orphan blob and an abandoned temp file on a node"""
+    node_root = os.path.join(NODES_DIR, f'node{node_id}')
+    orphan = node_layout.prepare(node_root, f'user_1_orphan_{tag}')
+    with open(orphan, 'wb') as f:
+        f.write(b'orphan')
+    temp = os.path.join(node_root, f'.tmp_{tag}')
+    with open(temp, 'wb') as f:
+        f.write(b'partial')
+    return orphan, temp
+
+def test_dry_run_reports_without_deleting(stored_file):
+    from reconcile import reconcile_node
+    _, node_id, replica = stored_file
+    orphan, temp = litter(node_id, 'dry')
+
+    report = reconcile_node(node_id, min_age=0)
+    assert os.path.basename(orphan) in report['orphan_names']
+    assert report['temp_files'] >= 1
+    assert report['reclaimed'] == 0
+    assert os.path.exists(orphan) and os.path.exists(temp) and os.path.exists(replica)
+
+def test_reclaim_deletes_only_unreferenced_blobs(client, admin_headers, stored_file):
+    from reconcile import reconcile_node
+    file_id, node_id, replica = stored_file
+    orphan, temp = litter(node_id, 'reclaim')
+
+    report = reconcile_node(node_id, reclaim=True, min_age=0)
+    assert report['reclaimed'] >= 2
+    assert not os.path.exists(orphan) and not os.path.exists(temp)
+    assert os.path.exists(replica)
+    with client.get(f'/download/{file_id}', headers=admin_headers) as response:
+        assert response.get_data() == b'keep me'
+
+def test_recent_blobs_are_left_alone(stored_file):
+    from reconcile import reconcile_node
+    _, node_id, _ = stored_file
+    orphan, temp = litter(node_id, 'recent')
+
+    report = reconcile_node(node_id, reclaim=True, min_age=3600)
+    assert report['too_recent'] >= 2
+    assert os.path.exists(orphan) and os.path.exists(temp)
+    reconcile_node(node_id, reclaim=True, min_age=0)
+
+def test_reclaim_respects_byte_budget(stored_file):
+    from reconcile import reconcile_node, Budget
+    _, node_id, _ = stored_file
+    orphan, temp = litter(node_id, 'budget')
+
+    report = reconcile_node(node_id, reclaim=True, min_age=0, budget=Budget(ops_per_second=0, max_bytes=0))
+    assert report['budget_exhausted']
+    assert os.path.exists(orphan) and os.path.exists(temp)
+    reconcile_node(node_id, reclaim=True, min_age=0)
+
+def test_missing_replica_is_reported(stored_file):
+    from reconcile import reconcile_node
+    _, node_id, replica = stored_file
+    os.remove(replica)
+
+    report = reconcile_node(node_id, min_age=0)
+    assert os.path.basename(replica) in report['missing_names']
@@ -0,0 +1,103 @@
+"""
+Versions share unchanged chunks, and deleting files gives back chunk
+references so the last one to go removes the chunk blobs.
+"""
+import io
+import os
+import random
+import db
+from config import NODES_DIR
+
+def random_bytes(size, seed):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+def upload(client, headers, data, filename='data.bin'):
+    data = {'file': (io.BytesIO(data), filename)}
+    with client.post('/upload', data=data, headers=headers, content_type='multipart/form-data') as response:
+        assert response.status_code == 201
+        return response.get_json()['file_id']
+
+def add_version(client, headers, file_id, data):
+    data = {'file': (io.BytesIO(data), 'data.bin')}
+    with client.post(f'/files/{file_id}/versions', data=data, headers=headers,
+                     content_type='multipart/form-data') as response:
+        return response.status_code, response.get_json()
+
+def download(client, headers, file_id, version=None):
+    query = f'?version={version}' if version else ''
+    with client.get(f'/download/{file_id}{query}', headers=headers) as response:
+        assert response.status_code == 200
+        return response.get_data()
+
+def query(sql, params=()):
+    conn = db.connect()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def chunk_blob_hashes():
+    """Hashes of the chunks that have blobs on any node"""
+    return {name.split('_')[1] for _, _, names in os.walk(NODES_DIR) for name in names if name.startswith('chunk_')}
+
+def refcounts(hashes):
+    placeholders = ','.join('?' * len(hashes))
+    return dict(query(f"SELECT hash, refcount FROM chunks WHERE hash IN ({placeholders})", list(hashes)))
+
+def file_chunks(file_id):
+    return {row[0] for row in query("""
+        SELECT vc.chunk_hash FROM version_chunks vc JOIN file_versions v ON v.id = vc.version_id
+        WHERE v.file_id = ?""", (file_id,))}
+
+def test_versions_share_unchanged_chunks(client, admin_headers):
+    original = random_bytes(400000, seed=1)
+    edited = original[:200000] + b'edit' + original[200000:]
+    edited_again = edited[:100000] + b'again' + edited[100000:]
+    file_id = upload(client, admin_headers, original)
+
+    # The first version also stores the original's chunks
+    status, converted = add_version(client, admin_headers, file_id, edited)
+    assert status == 201
+    assert converted['version'] == 2
+    status, result = add_version(client, admin_headers, file_id, edited_again)
+    assert status == 201
+    # Only the chunks around the edit are new; the rest are shared with earlier versions
+    assert result['stored_bytes'] < converted['stored_bytes'] / 4
+
+    assert download(client, admin_headers, file_id, 1) == original
+    assert download(client, admin_headers, file_id, 2) == edited
+    assert download(client, admin_headers, file_id) == edited_again
+
+def test_deleting_files_releases_shared_chunks(client, admin_headers):
+    content = random_bytes(200000, seed=2)
+    first = upload(client, admin_headers, content)
+    second = upload(client, admin_headers, content)
+    assert add_version(client, admin_headers, first, content + b'one')[0] == 201
+    assert add_version(client, admin_headers, second, content + b'two')[0] == 201
+
+    shared = file_chunks(first) & file_chunks(second)
+    assert shared
+    before = refcounts(shared)
+    with client.delete(f'/files/{first}', headers=admin_headers) as response:
+        assert response.status_code == 200
+    after = refcounts(shared)
+    assert set(after) == shared
+    assert all(after[chunk_hash] < before[chunk_hash] for chunk_hash in shared)
+    assert download(client, admin_headers, second, 1) == content
+
+    remaining = file_chunks(second)
+    with client.delete(f'/files/{second}', headers=admin_headers) as response:
+        assert response.status_code == 200
+    assert refcounts(remaining) == {}
+    assert not query("SELECT 1 FROM chunk_locations WHERE chunk_hash IN (%s)" % ','.join('?' * len(remaining)),
+                     list(remaining))
+    assert not chunk_blob_hashes() & remaining
+
+def test_version_size_cap(client, admin_headers, monkeypatch):
+    import routes
+    file_id = upload(client, admin_headers, random_bytes(5000, seed=3))
+    monkeypatch.setattr(routes, 'MAX_VERSION_SIZE', 4096)
+    assert add_version(client, admin_headers, file_id, b'small')[0] == 400
+    monkeypatch.setattr(routes, 'MAX_VERSION_SIZE', 10000)
+    assert add_version(client, admin_headers, file_id, random_bytes(20000, seed=4))[0] == 400
+    assert add_version(client, admin_headers, file_id, b'small')[0] == 201
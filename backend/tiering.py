@@ -0,0 +1,233 @@
+import fcntl
+import threading
+import time
+import sqlite3
+import db
+from access_stats import access_stats
+from cache import invalidate_file
+from metadata_writer import writer
+from conditional import bump_file_owners
+from job_status import save_status, load_status
+from node_client import get_node_client, blob_name
+from replication import adjust_replicas
+import node_layout
+import os
+from config import (DATABASE_PATH, NODES_DIR, NODE_COUNT, NODE_CLASSES, FAST_NODE_CLASS, TIERING_INTERVAL_SECONDS,
+                    TIERING_HOT_THRESHOLD, TIERING_COLD_AGE_DAYS, TIERING_DECAY, TIERING_MAX_MOVES_PER_RUN)
+
+def fast_nodes():
+    return [node_id for node_id in range(1, NODE_COUNT + 1) if NODE_CLASSES.get(node_id) == FAST_NODE_CLASS]
+
+def bulk_nodes():
+    return [node_id for node_id in range(1, NODE_COUNT + 1) if NODE_CLASSES.get(node_id) != FAST_NODE_CLASS]
+
+def move_replica(location, target_node_id):
+    """
+    Move one replica of a file to another node, keeping the replication factor
+
+    The blob is copied first, then the location row is repointed in a single
+    UPDATE that only succeeds if the row still points at the old node, and
+    only then is the old blob deleted. If anything changed underneath (the
+    file was deleted or the replica moved), the new copy is removed instead.
+
+    Args:
+        location: Dict with 'id', 'file_id', 'node_id' and 'file_path' of the replica to move
+        target_node_id: Node to move it to
+
+    Returns:
+        bool: True if the replica was moved
+    """
+    client = get_node_client()
+    name = blob_name(location['file_path'])
+    client.copy(location['node_id'], target_node_id, name)
+    new_path = node_layout.blob_path(os.path.join(NODES_DIR, f"node{target_node_id}"), name)
+
+    def write(cursor):
+        cursor.execute(
+            "UPDATE file_locations SET node_id = ?, file_path = ? WHERE id = ? AND node_id = ?",
+            (target_node_id, new_path, location['id'], location['node_id'])
+        )
+        if cursor.rowcount != 1:
+            return False
+        bump_file_owners(cursor, [location['file_id']])
+        return True
+
+    if not writer.execute(write):
+        client.delete(target_node_id, name)
+        return False
+
+    invalidate_file(location['file_id'])
+    try:
+        client.delete(location['node_id'], name)
+    except Exception:
+        # Leaves an orphan on the old node, which reconciliation can reclaim
+        pass
+    return True
+
+def _node_load(cursor):
+    cursor.execute("SELECT node_id, COUNT(*) FROM file_locations GROUP BY node_id")
+    load = {node_id: 0 for node_id in range(1, NODE_COUNT + 1)}
+    load.update({row[0]: row[1] for row in cursor.fetchall()})
+    return load
+
+def _pick_target(candidates, holding, load):
+    """Pick the least loaded candidate node that doesn't already hold the file"""
+    options = [node_id for node_id in candidates if node_id not in holding]
+    if not options:
+        return None
+    return min(options, key=lambda node_id: load[node_id])
+
+def run_tiering(max_moves=TIERING_MAX_MOVES_PER_RUN):
+    """
+    Promote hot files to fast nodes and demote cold files to bulk nodes
+
+    Returns:
+        dict with the number of promoted and demoted replicas and errors
+    """
+    access_stats.flush()
+    fast, bulk = fast_nodes(), bulk_nodes()
+    result = {'promoted': 0, 'demoted': 0, 'errors': 0}
+    if not fast or not bulk:
+        return result
+
+    conn = db.connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    load = _node_load(cursor)
+    fast_placeholders = ','.join('?' * len(fast))
+
+    # Hot files with no replica on a fast node
+    cursor.execute(f"""
+        SELECT s.file_id
+        FROM file_access_stats s
+        WHERE s.recent_count >= ?
+          AND NOT EXISTS (
+              SELECT 1 FROM file_locations l
+              WHERE l.file_id = s.file_id AND l.node_id IN ({fast_placeholders})
+          )
+        ORDER BY s.recent_count DESC
+        LIMIT ?
+    """, [TIERING_HOT_THRESHOLD] + fast + [max_moves])
+    hot_files = [row['file_id'] for row in cursor.fetchall()]
+
+    # Cold files still holding a fast replica
+    cursor.execute(f"""
+        SELECT DISTINCT l.file_id
+        FROM file_locations l
+        JOIN files f ON f.id = l.file_id
+        LEFT JOIN file_access_stats s ON s.file_id = l.file_id
+        WHERE l.node_id IN ({fast_placeholders})
+          AND COALESCE(s.last_access, f.upload_date) < datetime('now', ?)
+        LIMIT ?
+    """, fast + [f'-{TIERING_COLD_AGE_DAYS} days', max_moves])
+    cold_files = [row['file_id'] for row in cursor.fetchall()]
+
+    def locations_of(file_id):
+        cursor.execute("SELECT id, file_id, node_id, file_path FROM file_locations WHERE file_id = ?", (file_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+    moves = 0
+    for file_id in hot_files:
+        if moves >= max_moves:
+            break
+        locations = locations_of(file_id)
+        holding = {location['node_id'] for location in locations}
+        target = _pick_target(fast, holding, load)
+        if target is None or not locations:
+            continue
+        # Move the replica from the busiest bulk node
+        source = max(locations, key=lambda location: load[location['node_id']])
+        try:
+            if move_replica(source, target):
+                load[source['node_id']] -= 1
+                load[target] += 1
+                result['promoted'] += 1
+                moves += 1
+        except Exception:
+            result['errors'] += 1
+
+    for file_id in cold_files:
+        if moves >= max_moves:
+            break
+        locations = locations_of(file_id)
+        holding = {location['node_id'] for location in locations}
+        for source in [location for location in locations if location['node_id'] in fast]:
+            target = _pick_target(bulk, holding, load)
+            if target is None:
+                break
+            try:
+                if move_replica(source, target):
+                    holding.add(target)
+                    load[source['node_id']] -= 1
+                    load[target] += 1
+                    result['demoted'] += 1
+                    moves += 1
+            except Exception:
+                result['errors'] += 1
+
+    conn.close()
+    return result
+
+class TieringJob:
+    """Runs run_tiering and adjust_replicas periodically on a background thread"""
+
+    def __init__(self, interval=TIERING_INTERVAL_SECONDS):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._leader_file = None
+
+    def start(self):
+        """Start the periodic job in this process (no-op if disabled or already running)"""
+        if not self.interval:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._leader_file = None
+            self._thread = threading.Thread(target=self._loop, name='tiering', daemon=True)
+            self._thread.start()
+
+    def run_now(self):
+        with self._lock:
+            result = {'tiering': run_tiering(), 'replication': adjust_replicas()}
+            # Let old popularity fade so files can cool down again
+            access_stats.decay(TIERING_DECAY)
+            # Stored, since the leader is rarely the worker answering the status request
+            save_status('tiering', {'last_run': time.time(), 'last_result': result})
+            return result
+
+    def status(self):
+        return {
+            'interval_seconds': self.interval,
+            **load_status('tiering', {'last_run': None, 'last_result': None}),
+            'node_classes': {node_id: NODE_CLASSES.get(node_id) for node_id in range(1, NODE_COUNT + 1)}
+        }
+
+    def _is_leader(self):
+        """
+        With several worker processes, only the one holding the lock file runs
+        the periodic job (otherwise counts would decay once per worker). The
+        lock is released when that process exits, and another worker takes over.
+        """
+        if self._leader_file is None:
+            self._leader_file = open(f"{DATABASE_PATH}.tiering.lock", 'a')
+        try:
+            fcntl.flock(self._leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self._is_leader():
+                    self.run_now()
+            except Exception:
+                # Try again next interval
+                pass
+
+tiering_job = TieringJob()
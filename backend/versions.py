@@ -0,0 +1,358 @@
+"""
+File versioning on top of content-defined chunks
+
+The first time a new version of a file is uploaded, the existing whole-file
+blob is split into chunks and becomes version 1; from then on every version
+is a list of chunks (version_chunks) and only chunks that aren't stored yet
+are written to the nodes. Chunks are shared between versions and files and
+reference-counted, and are replicated like files are (chunk_locations).
+
+Each stored copy of a chunk gets its own blob name (chunk_<sha256>_<uuid>),
+so a blob is only ever referenced by the upload that wrote it. That makes it
+safe to delete blobs of an upload that failed, or of chunks whose last
+reference was just dropped, without racing concurrent uploads.
+"""
+import collections
+import hashlib
+import os
+import random
+import sqlite3
+import uuid
+import db
+import node_layout
+from cache import invalidate_file
+from chunking import iter_chunks
+from conditional import bump_file_owners
+from file_utils import prefer_fast_nodes, delete_replicas
+from metadata_writer import writer
+from metrics import REPLICA_FALLBACKS
+from node_client import get_node_client, blob_name
+from config import NODES_DIR, NODE_COUNT, REPLICATION_FACTOR
+
+CHUNK_BLOB_PREFIX = 'chunk_'
+
+class VersionConflict(Exception):
+    """A chunk an upload meant to share was deleted, or the file was converted, before the upload was recorded"""
+
+def chunk_blob_name(chunk_hash):
+    """Get a new, unique blob name for a stored copy of a chunk"""
+    return f"{CHUNK_BLOB_PREFIX}{chunk_hash}_{uuid.uuid4()}"
+
+def store_chunks(f, cursor, replication_factor, new_chunks, digest=None):
+    """
+    Split a file into chunks and store the ones that aren't stored yet
+
+    Args:
+        f: File-like object to read
+        cursor: Database cursor used to look up existing chunks
+        replication_factor: Number of nodes each new chunk is stored on
+        new_chunks: Dict of chunks stored by this upload so far, updated in place
+                    with {hash: {'size', 'locations'}} for every chunk written
+        digest: Optional hashlib object updated with the whole content
+
+    Returns:
+        List of (hash, size) tuples making up the file, in order
+    """
+    client = get_node_client()
+    manifest = []
+
+    for data in iter_chunks(f):
+        if digest is not None:
+            digest.update(data)
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        manifest.append((chunk_hash, len(data)))
+
+        if chunk_hash in new_chunks:
+            continue
+        cursor.execute("SELECT 1 FROM chunks WHERE hash = ?", (chunk_hash,))
+        if cursor.fetchone():
+            continue
+
+        entry = {'size': len(data), 'locations': []}
+        new_chunks[chunk_hash] = entry
+        for node_id in random.sample(range(1, NODE_COUNT + 1), min(replication_factor, NODE_COUNT)):
+            name = chunk_blob_name(chunk_hash)
+            client.put_bytes(node_id, name, data)
+            entry['locations'].append({
+                'node_id': node_id,
+                'file_path': node_layout.blob_path(os.path.join(NODES_DIR, f"node{node_id}"), name)
+            })
+
+    return manifest
+
+def _open_whole_file(locations):
+    """Open the first readable replica of an unversioned file"""
+    client = get_node_client()
+    for location in prefer_fast_nodes(locations):
+        try:
+            return client.open(location['node_id'], blob_name(location['file_path']))
+        except Exception:
+            REPLICA_FALLBACKS.inc()
+    raise Exception("Could not retrieve file from any node")
+
+def _record_versions(file_id, manifests, content_hashes, new_chunks, was_versioned):
+    """
+    Record new versions of a file in one transaction
+
+    Returns:
+        Tuple of (latest version number, locations of blobs that are no longer needed)
+    """
+    def write(cursor):
+        cursor.execute("SELECT current_version FROM files WHERE id = ?", (file_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise FileNotFoundError(f"File {file_id} no longer exists")
+        if (row[0] is not None) != was_versioned:
+            # Someone else converted the file meanwhile; start over
+            raise VersionConflict('file was converted concurrently')
+
+        unused = []
+        if not was_versioned:
+            # Version 1 now lives in chunks, so the whole-file replicas can go
+            cursor.execute("SELECT node_id, file_path FROM file_locations WHERE file_id = ?", (file_id,))
+            unused.extend({'node_id': r[0], 'file_path': r[1]} for r in cursor.fetchall())
+            cursor.execute("DELETE FROM file_locations WHERE file_id = ?", (file_id,))
+
+        counts = collections.Counter(chunk_hash for manifest in manifests for chunk_hash, _ in manifest)
+        for chunk_hash, count in counts.items():
+            cursor.execute("UPDATE chunks SET refcount = refcount + ? WHERE hash = ?", (count, chunk_hash))
+            if cursor.rowcount:
+                # Another upload stored it first; our copies aren't needed
+                if chunk_hash in new_chunks:
+                    unused.extend(new_chunks[chunk_hash]['locations'])
+                continue
+            if chunk_hash not in new_chunks:
+                raise VersionConflict(chunk_hash)
+            entry = new_chunks[chunk_hash]
+            cursor.execute("INSERT INTO chunks (hash, size, refcount) VALUES (?, ?, ?)",
+                           (chunk_hash, entry['size'], count))
+            cursor.executemany(
+                "INSERT INTO chunk_locations (chunk_hash, node_id, file_path) VALUES (?, ?, ?)",
+                [(chunk_hash, location['node_id'], location['file_path']) for location in entry['locations']]
+            )
+
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM file_versions WHERE file_id = ?", (file_id,))
+        number = cursor.fetchone()[0]
+        size = 0
+        for manifest, content_hash in zip(manifests, content_hashes):
+            number += 1
+            size = sum(chunk_size for _, chunk_size in manifest)
+            cursor.execute("INSERT INTO file_versions (file_id, version, size, content_hash) VALUES (?, ?, ?, ?)",
+                           (file_id, number, size, content_hash))
+            version_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO version_chunks (version_id, seq, chunk_hash) VALUES (?, ?, ?)",
+                [(version_id, seq, chunk_hash) for seq, (chunk_hash, _) in enumerate(manifest)]
+            )
+
+        cursor.execute("UPDATE files SET current_version = ?, size = ?, content_hash = ? WHERE id = ?",
+                       (number, size, content_hashes[-1], file_id))
+        bump_file_owners(cursor, [file_id])
+        return number, unused
+
+    return writer.execute(write)
+
+def add_version(file_id, upload_path, replication_factor=None, attempts=3):
+    """
+    Store a new version of a file, writing only chunks that aren't stored yet
+
+    Args:
+        file_id: ID of the file
+        upload_path: Path to the new content
+        replication_factor: Number of nodes new chunks are stored on (default: REPLICATION_FACTOR)
+        attempts: Times to retry when chunks it meant to share are deleted meanwhile
+
+    Returns:
+        dict with the new 'version' number, its 'size' and the 'stored_bytes' actually written
+    """
+    replication_factor = replication_factor or REPLICATION_FACTOR
+
+    for attempt in range(attempts):
+        new_chunks = {}
+        try:
+            conn = db.connect()
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT current_version FROM files WHERE id = ?", (file_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise FileNotFoundError(f"File {file_id} not found")
+                was_versioned = row['current_version'] is not None
+
+                manifests = []
+                content_hashes = []
+                if not was_versioned:
+                    # Turn the existing whole-file blob into version 1
+                    cursor.execute("SELECT node_id, file_path FROM file_locations WHERE file_id = ?", (file_id,))
+                    locations = [dict(r) for r in cursor.fetchall()]
+                    digest = hashlib.sha256()
+                    with _open_whole_file(locations) as reader:
+                        manifests.append(store_chunks(reader, cursor, replication_factor, new_chunks, digest))
+                    content_hashes.append(digest.hexdigest())
+
+                digest = hashlib.sha256()
+                with open(upload_path, 'rb') as f:
+                    manifests.append(store_chunks(f, cursor, replication_factor, new_chunks, digest))
+                content_hashes.append(digest.hexdigest())
+            finally:
+                conn.close()
+
+            number, unused = _record_versions(file_id, manifests, content_hashes, new_chunks, was_versioned)
+        except Exception as e:
+            # Nothing references the chunks this attempt wrote
+            delete_replicas([location for entry in new_chunks.values() for location in entry['locations']])
+            if isinstance(e, VersionConflict):
+                continue
+            raise
+
+        delete_replicas(unused)
+        invalidate_file(file_id)
+        return {
+            'version': number,
+            'size': sum(chunk_size for _, chunk_size in manifests[-1]),
+            'stored_bytes': sum(entry['size'] * len(entry['locations']) for entry in new_chunks.values())
+        }
+
+    raise Exception("Could not store version: chunks changed concurrently, try again")
+
+def list_versions(cursor, file):
+    """List the versions of a file (an unversioned file has just version 1)"""
+    if file['current_version'] is None:
+        return [{'version': 1, 'size': file['size'], 'created_at': file['upload_date']}]
+    cursor.execute("""
+        SELECT version, size, created_at
+        FROM file_versions
+        WHERE file_id = ?
+        ORDER BY version
+    """, (file['id'],))
+    return [{'version': row[0], 'size': row[1], 'created_at': row[2]} for row in cursor.fetchall()]
+
+class VersionReader:
+    """File-like reader that reassembles a version from its chunks"""
+
+    def __init__(self, size, chunks):
+        self.size = size
+        self._chunks = chunks
+        self._next = 0
+        self._buffer = bytearray()
+        self._client = get_node_client()
+
+    def _fetch(self, chunk_hash, locations):
+        # Try each replica, checking content against the chunk's hash
+        for location in prefer_fast_nodes(locations):
+            try:
+                with self._client.open(location['node_id'], blob_name(location['file_path'])) as reader:
+                    data = reader.read()
+                if hashlib.sha256(data).hexdigest() == chunk_hash:
+                    return data
+            except Exception:
+                pass
+            REPLICA_FALLBACKS.inc()
+        raise Exception("Could not retrieve chunk from any node")
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._next < len(self._chunks):
+            self._buffer += self._fetch(*self._chunks[self._next])
+            self._next += 1
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self._buffer = bytearray()
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_version(file_id, version=None):
+    """
+    Open a version of a versioned file for streaming reads
+
+    Args:
+        file_id: ID of the file
+        version: Version number (default: the latest)
+
+    Returns:
+        VersionReader, or None if there is no such version
+    """
+    conn = db.connect()
+    cursor = conn.cursor()
+    try:
+        if version is None:
+            cursor.execute("""
+                SELECT v.id, v.size
+                FROM file_versions v
+                JOIN files f ON f.id = v.file_id AND f.current_version = v.version
+                WHERE v.file_id = ?
+            """, (file_id,))
+        else:
+            cursor.execute("SELECT id, size FROM file_versions WHERE file_id = ? AND version = ?", (file_id, version))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        version_id, size = row
+
+        cursor.execute("""
+            SELECT vc.seq, vc.chunk_hash, l.node_id, l.file_path
+            FROM version_chunks vc
+            LEFT JOIN chunk_locations l ON l.chunk_hash = vc.chunk_hash
+            WHERE vc.version_id = ?
+            ORDER BY vc.seq
+        """, (version_id,))
+        chunks = []
+        for seq, chunk_hash, node_id, file_path in cursor.fetchall():
+            if not chunks or chunks[-1][2] != seq:
+                chunks.append((chunk_hash, [], seq))
+            if node_id is not None:
+                chunks[-1][1].append({'node_id': node_id, 'file_path': file_path})
+    finally:
+        conn.close()
+
+    return VersionReader(size, [(chunk_hash, locations) for chunk_hash, locations, _ in chunks])
+
+def release_chunks(cursor, file_ids):
+    """
+    Drop the versions of files being deleted and the chunks nothing references anymore
+
+    Runs inside the caller's transaction.
+
+    Returns:
+        Locations of chunk blobs to delete once the transaction has committed
+    """
+    placeholders = ','.join('?' * len(file_ids))
+    cursor.execute(f"""
+        SELECT vc.chunk_hash, COUNT(*)
+        FROM version_chunks vc
+        JOIN file_versions v ON v.id = vc.version_id
+        WHERE v.file_id IN ({placeholders})
+        GROUP BY vc.chunk_hash
+    """, file_ids)
+    counts = cursor.fetchall()
+    if not counts:
+        return []
+
+    cursor.executemany("UPDATE chunks SET refcount = refcount - ? WHERE hash = ?",
+                       [(count, chunk_hash) for chunk_hash, count in counts])
+    cursor.execute(f"""
+        DELETE FROM version_chunks
+        WHERE version_id IN (SELECT id FROM file_versions WHERE file_id IN ({placeholders}))
+    """, file_ids)
+    cursor.execute(f"DELETE FROM file_versions WHERE file_id IN ({placeholders})", file_ids)
+
+    unused = []
+    for chunk_hash, _ in counts:
+        cursor.execute("SELECT refcount FROM chunks WHERE hash = ?", (chunk_hash,))
+        row = cursor.fetchone()
+        if row and row[0] <= 0:
+            cursor.execute("SELECT node_id, file_path FROM chunk_locations WHERE chunk_hash = ?", (chunk_hash,))
+            unused.extend({'node_id': r[0], 'file_path': r[1]} for r in cursor.fetchall())
+            cursor.execute("DELETE FROM chunk_locations WHERE chunk_hash = ?", (chunk_hash,))
+            cursor.execute("DELETE FROM chunks WHERE hash = ?", (chunk_hash,))
+    return unused